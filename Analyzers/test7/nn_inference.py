@@ -0,0 +1 @@
+../test8/nn_inference.py
\ No newline at end of file
@@ -0,0 +1,162 @@
+import numpy as np
+
+
+# ______________________________________________________________________________
+# Rate curves from the per-event tracks
+#
+# The rates analysis (see RatesAnalysis in rootpy_trackbuilding9.py) saves the
+# tracks of every minbias event as compact arrays: one array per track variable
+# (pt, eta, ...) with the tracks of all the events concatenated, plus the number
+# of tracks in each event. The files from different jobs are merged by simply
+# concatenating the arrays.
+#
+# The region definitions (eta ranges, zones, modes, ...) are applied afterwards
+# as track masks. The leading pT of each event in a region is found with a
+# segmented max, and the rate above any set of pT thresholds is computed exactly
+# (without binning) with a sort and a cumulative sum.
+#
+# Example:
+#   tracks = load_track_arrays(['rates_tbb.npz'])['emtf2026']
+#   abs_eta = np.abs(tracks['eta'])
+#   select = (1.24 <= abs_eta) & (abs_eta <= 2.4) & (tracks['zone'] != 6)
+#   rate, rate_err = make_rate_curve(find_leading_pt(tracks, select), np.arange(1., 61.))
+
+# Same as make_rate() in perf_rates.py
+orbit_freq = 11246.
+ncoll_bunches = 2808  # assume lumi=8e34, PU=200, xsec_pp=80mb
+
+def find_conversion_to_khz(nevents):
+  return orbit_freq * ncoll_bunches / float(nevents) / 1000.
+
+class TrackArrays(object):
+  # The tracks of a set of events, with one array per track variable
+  def __init__(self, ntracks, columns):
+    self.ntracks = np.asarray(ntracks, dtype=np.int32)  # number of tracks in each event
+    self.columns = columns  # name -> array of all the tracks
+    self.row_splits = np.zeros(len(self.ntracks)+1, dtype=np.int64)
+    np.cumsum(self.ntracks, out=self.row_splits[1:])
+    for column in self.columns.itervalues():
+      assert(len(column) == self.row_splits[-1])
+
+  def __len__(self):
+    return len(self.ntracks)  # number of events
+
+  def __getitem__(self, name):
+    return self.columns[name]
+
+  @property
+  def nevents(self):
+    return len(self.ntracks)
+
+class TrackArraysCollector(object):
+  # Collects the tracks of each event, given as a numpy record array (or
+  # anything else that returns a column by name)
+  def __init__(self, names):
+    self.names = names
+    self.ntracks = []
+    self.columns = {name: [] for name in names}
+    self.nsegments = 0  # number of segments saved by save_checkpoint()
+    self.nsaved = (0, 0)  # number of events and column arrays saved
+
+  def append(self, tracks):
+    self.ntracks.append(len(tracks))
+    for name in self.names:
+      self.columns[name].append(np.asarray(tracks[name]))
+
+  def save_checkpoint(self, prefix):
+    # Only the events added since the last checkpoint are saved, as a new segment
+    (nevents, narrays) = self.nsaved
+    if len(self.ntracks) > nevents:
+      arrays = {'ntracks': np.asarray(self.ntracks[nevents:], dtype=np.int32)}
+      for name in self.names:
+        arrays[name] = np.concatenate(self.columns[name][narrays:])
+      np.savez('%s.%i.npz' % (prefix, self.nsegments), **arrays)
+      self.nsegments += 1
+      self.nsaved = (len(self.ntracks), len(self.columns[self.names[0]]))
+    return {'nsegments': self.nsegments}
+
+  def load_checkpoint(self, prefix, meta):
+    self.ntracks = []
+    self.columns = {name: [] for name in self.names}
+    self.nsegments = meta['nsegments']
+    for isegment in range(self.nsegments):
+      with np.load('%s.%i.npz' % (prefix, isegment)) as data:
+        self.ntracks.extend(data['ntracks'].tolist())
+        for name in self.names:
+          self.columns[name].append(data[name])
+    self.nsaved = (len(self.ntracks), len(self.columns[self.names[0]]))
+
+  def to_track_arrays(self):
+    columns = {}
+    for name in self.names:
+      if self.columns[name]:
+        columns[name] = np.concatenate(self.columns[name])
+      else:
+        columns[name] = np.zeros(0, dtype=np.float32)
+    return TrackArrays(self.ntracks, columns)
+
+def save_track_arrays(outfile, track_arrays):
+  # Takes a dict of prefix -> TrackArrays. The arrays are saved as '<prefix>_ntracks'
+  # and '<prefix>_<name>', which can be concatenated across the jobs.
+  arrays = {}
+  for prefix, tracks in track_arrays.iteritems():
+    arrays['%s_ntracks' % prefix] = tracks.ntracks
+    for name, column in tracks.columns.iteritems():
+      arrays['%s_%s' % (prefix, name)] = column
+  np.savez_compressed(outfile, **arrays)
+
+def load_track_arrays(infiles):
+  # Returns a dict of prefix -> TrackArrays, with the events of all the files concatenated
+  arrays = {}
+  for infile in infiles:
+    with np.load(infile) as data:
+      for k in data.files:
+        arrays.setdefault(k, []).append(data[k])
+  arrays = {k: np.concatenate(v) for (k, v) in arrays.iteritems()}
+
+  track_arrays = {}
+  for k in arrays:
+    if k.endswith('_ntracks'):
+      prefix = k[:-len('_ntracks')]
+      columns = {name[len(prefix)+1:]: column for (name, column) in arrays.iteritems()
+                 if name.startswith(prefix + '_') and name != k}
+      track_arrays[prefix] = TrackArrays(arrays[k], columns)
+  return track_arrays
+
+def find_leading_pt(tracks, select=None):
+  # Returns the highest pT of the selected tracks in each event, or 0 if there
+  # is no selected track
+  pt = np.asarray(tracks['pt'], dtype=np.float64)
+  if select is not None:
+    pt = np.where(select, pt, 0.)
+  leading_pt = np.zeros(tracks.nevents, dtype=np.float64)
+  nonempty = (tracks.ntracks > 0)
+  if nonempty.any():
+    leading_pt[nonempty] = np.maximum.reduceat(pt, tracks.row_splits[:-1][nonempty])
+  return leading_pt
+
+def make_rate_curve(leading_pt, thresholds, nevents=None, weights=None):
+  # Returns the rate [kHz] of events with leading pT >= threshold for each
+  # threshold, and its statistical error. This is the same as make_ptcut() and
+  # make_rate() in perf_rates.py, but without the binning. The events without
+  # a track must have a leading pT of 0, and are counted in 'nevents'.
+  leading_pt = np.asarray(leading_pt, dtype=np.float64)
+  thresholds = np.asarray(thresholds, dtype=np.float64)
+  if nevents is None:
+    nevents = len(leading_pt)
+  if weights is None:
+    weights = np.ones_like(leading_pt)
+  weights = np.asarray(weights, dtype=np.float64)
+
+  # Sort by pT, then sum the weights from the highest pT down
+  ind = np.argsort(leading_pt, kind='mergesort')
+  sorted_pt = leading_pt[ind]
+  sumw = np.concatenate((np.cumsum(weights[ind][::-1])[::-1], [0.]))
+  sumw2 = np.concatenate((np.cumsum((weights*weights)[ind][::-1])[::-1], [0.]))
+
+  # Number of events with pT below each threshold
+  n = np.searchsorted(sorted_pt, thresholds, side='left')
+  conv = find_conversion_to_khz(nevents)
+  rate = sumw[n] * conv
+  rate_err = np.sqrt(sumw2[n]) * conv
+  return (rate, rate_err)
@@ -1,7 +1,7 @@
 import numpy as np
 np.random.seed(2026)
 
-import os, sys, datetime
+import os, sys, datetime, bisect
 from six.moves import range, zip, map, filter
 
 from rootpy.plotting import Hist, Hist2D, Graph, Efficiency
@@ -213,6 +213,12 @@ class EMTFLayer(object):
     emtf_layer = self.lut[index]
     return emtf_layer
 
+  def array(self, hits):
+    # Same as __call__(), but takes the columnar hits
+    index = (hits['type'], hits['station'], hits['ring'])
+    emtf_layer = self.lut[index]
+    return emtf_layer
+
 # Decide EMTF hit zones
 class EMTFZone(object):
   def __init__(self):
@@ -308,6 +314,17 @@ class EMTFZone(object):
       zones = zones[0]
     return zones
 
+  def array(self, hits, emtf_theta=None):
+    # Same as __call__(), but takes the columnar hits, returns a boolean array
+    # with shape (n, 7), True if the hit is in the zone
+    if emtf_theta is None:
+      emtf_theta = hits['emtf_theta']
+    emtf_theta = emtf_theta[:, np.newaxis]
+    index = (hits['type'], hits['station'], hits['ring'])
+    entry = self.lut[index]
+    answer = (entry[...,0] <= emtf_theta) & (emtf_theta <= entry[...,1])
+    return answer
+
 # Decide EMTF hit bend
 class EMTFBend(object):
   def __call__(self, hit):
@@ -334,6 +351,23 @@ class EMTFBend(object):
       emtf_bend = np.int32(0)
     return emtf_bend
 
+  def array(self, hits):
+    # Same as __call__(), but takes the columnar hits
+    (_type, station, ring, endcap) = (hits['type'], hits['station'], hits['ring'], hits['endcap'])
+    bend = hits['bend'].astype(np.int32)
+    # CSC: rescale ME1/1a, then from 1/32-strip unit to 1/16-strip unit
+    # (the rescaling is done in double precision, as in the scalar version)
+    csc_bend = np.round(bend.astype(np.float64) * 0.026331/0.014264).astype(np.int32)
+    csc_bend = np.clip(csc_bend, -32, 31)
+    csc_bend = np.where((station == 1) & (ring == 4), csc_bend, bend)
+    csc_bend *= endcap
+    csc_bend = np.sign(csc_bend) * (np.abs(csc_bend)//2)
+    emtf_bend = np.select(
+        [_type == kCSC, _type == kME0, _type == kDT],
+        [csc_bend, np.clip(bend, -64, 63), np.clip(bend, -512, 511)],
+        default=0).astype(np.int32)
+    return emtf_bend
+
 # Decide EMTF hit bend (old version)
 class EMTFOldBend(object):
   def __init__(self):
@@ -355,6 +389,17 @@ class EMTFOldBend(object):
       bend = np.int32(0)
     return bend
 
+  def array(self, hits):
+    # Same as __call__(), but takes the columnar hits
+    (_type, endcap) = (hits['type'], hits['endcap'])
+    is_csc = (_type == kCSC)
+    clct = np.where(is_csc, hits['pattern'], 0)
+    bend = np.select(
+        [is_csc, (_type == kME0) | (_type == kDT)],
+        [self.lut[clct] * endcap, hits['bend']],
+        default=0).astype(np.int32)
+    return bend
+
 # Decide EMTF hit phi (integer unit)
 class EMTFPhi(object):
   def __call__(self, hit):
@@ -379,6 +424,21 @@ class EMTFPhi(object):
       pass
     return emtf_phi
 
+  def array(self, hits):
+    # Same as __call__(), but takes the columnar hits
+    (_type, station, ring, fr) = (hits['type'], hits['station'], hits['ring'], hits['fr'])
+    bend_corr_lut = np.zeros((5,2), dtype=np.float64)  # (ring, fr)
+    bend_corr_lut[1] = (-2.0832, 2.0497)  # ME1/1b (r,f)
+    bend_corr_lut[4] = (-2.4640, 2.3886)  # ME1/1a (r,f)
+    bend_corr_lut[2] = (-1.3774, 1.2447)  # ME1/2 (r,f)
+    is_me1 = (_type == kCSC) & (station == 1)
+    bend_corr = bend_corr_lut[np.where(is_me1, ring, 0), np.where(is_me1, fr, 0)]
+    bend_corr *= hits['bend']
+    bend_corr *= hits['endcap']
+    bend_corr = np.sign(bend_corr) * np.floor(np.abs(bend_corr) + 0.5)  # round half away from zero, like round()
+    emtf_phi = hits['emtf_phi'].astype(np.int32) + bend_corr.astype(np.int32)
+    return emtf_phi
+
 # Decide EMTF hit phi (integer unit) (old version)
 class EMTFOldPhi(object):
   def __init__(self):
@@ -413,6 +473,62 @@ class EMTFOldPhi(object):
     ], dtype=np.int32)
     assert(len(self.ph_init_lut) == 2*6*61)
 
+    # Chamber addressing with (station, ring, neighbor, subsector, cscid) for the array version, -1 if invalid
+    self.pc_lut_id_lut = np.zeros((5,5,2,3,10), dtype=np.int32) - 1
+    for index in np.ndindex(self.pc_lut_id_lut.shape):
+      self.pc_lut_id_lut[index] = self._find_pc_lut_id(*index)
+
+    # Multiplicative factor for eighth_strip with (station, ring)
+    self.factor_lut = np.zeros((5,5), dtype=np.int32) + 1024
+    self.factor_lut[1,4] = 1707
+    self.factor_lut[1,1] = 1301
+    self.factor_lut[1,3] = 947
+
+  def _find_pc_lut_id(self, station, ring, neighbor, subsector, cscid):
+    # Returns -1 if the chamber address is invalid
+    pc_station = -1
+    pc_chamber = -1
+    if neighbor == 0:
+      if station == 1:  # ME1: 0 - 8, 9 - 17
+        pc_station = subsector-1
+        pc_chamber = cscid-1
+      else:             # ME2,3,4: 18 - 26, 27 - 35, 36 - 44
+        pc_station = station
+        pc_chamber = cscid-1
+    else:
+      if station == 1:  # ME1n: 45 - 47
+        pc_station = 5
+        pc_chamber = (cscid-1)/3
+      else:             # ME2n,3n,4n: 48 - 53
+        pc_station = 5
+        pc_chamber = (station) * 2 - 1 + (0 if (cscid-1 < 3) else 1)
+    if not (0 <= pc_station <= 5 and pc_chamber >= 0):
+      return -1
+
+    pc_lut_id = pc_chamber
+    if pc_station == 0:    # ME1 sub 1: 0 - 11
+      pc_lut_id = pc_lut_id + 9 if (ring == 4) else pc_lut_id
+    elif pc_station == 1:  # ME1 sub 2: 16 - 27
+      pc_lut_id += 16
+      pc_lut_id = pc_lut_id + 9 if (ring == 4) else pc_lut_id
+    elif pc_station == 2:  # ME2: 28 - 36
+      pc_lut_id += 28
+    elif pc_station == 3:  # ME3: 39 - 47
+      pc_lut_id += 39
+    elif pc_station == 4:  # ME4 : 50 - 58
+      pc_lut_id += 50
+    elif pc_station == 5 and pc_chamber < 3:  # neighbor ME1: 12 - 15
+      pc_lut_id = pc_lut_id + 15 if (ring == 4) else pc_lut_id + 12
+    elif pc_station == 5 and pc_chamber < 5:  # neighbor ME2: 37 - 38
+      pc_lut_id += 28 + 9 - 3
+    elif pc_station == 5 and pc_chamber < 7:  # neighbor ME3: 48 - 49
+      pc_lut_id += 39 + 9 - 5
+    elif pc_station == 5 and pc_chamber < 9:  # neighbor ME4: 59 - 60
+      pc_lut_id += 50 + 9 - 7
+    if not (0 <= pc_lut_id < 61):
+      return -1
+    return pc_lut_id
+
   def __call__(self, hit):
     emtf_phi = np.int32(hit.emtf_phi)
     clct_pattern = np.int32(hit.pattern)
@@ -424,46 +540,8 @@ class EMTFOldPhi(object):
       # Is this 10-deg or 20-deg chamber?
       is_10degree = (hit.station == 1) or (hit.station >= 2 and hit.ring == 2)  # ME1 and ME2,3,4/2
 
-      pc_station = -1
-      pc_chamber = -1
-      if hit.neighbor == 0:
-        if hit.station == 1:  # ME1: 0 - 8, 9 - 17
-          pc_station = hit.subsector-1
-          pc_chamber = hit.cscid-1
-        else:                 # ME2,3,4: 18 - 26, 27 - 35, 36 - 44
-          pc_station = hit.station
-          pc_chamber = hit.cscid-1
-      else:
-        if hit.station == 1:  # ME1n: 45 - 47
-          pc_station = 5
-          pc_chamber = (hit.cscid-1)/3
-        else:                 # ME2n,3n,4n: 48 - 53
-          pc_station = 5
-          pc_chamber = (hit.station) * 2 - 1 + (0 if (hit.cscid-1 < 3) else 1)
-      assert(pc_station != -1)
-      assert(pc_chamber != -1)
-
-      pc_lut_id = pc_chamber
-      if pc_station == 0:    # ME1 sub 1: 0 - 11
-        pc_lut_id = pc_lut_id + 9 if (hit.ring == 4) else pc_lut_id
-      elif pc_station == 1:  # ME1 sub 2: 16 - 27
-        pc_lut_id += 16
-        pc_lut_id = pc_lut_id + 9 if (hit.ring == 4) else pc_lut_id
-      elif pc_station == 2:  # ME2: 28 - 36
-        pc_lut_id += 28
-      elif pc_station == 3:  # ME3: 39 - 47
-        pc_lut_id += 39
-      elif pc_station == 4:  # ME4 : 50 - 58
-        pc_lut_id += 50
-      elif pc_station == 5 and pc_chamber < 3:  # neighbor ME1: 12 - 15
-        pc_lut_id = pc_lut_id + 15 if (hit.ring == 4) else pc_lut_id + 12
-      elif pc_station == 5 and pc_chamber < 5:  # neighbor ME2: 37 - 38
-        pc_lut_id += 28 + 9 - 3
-      elif pc_station == 5 and pc_chamber < 7:  # neighbor ME3: 48 - 49
-        pc_lut_id += 39 + 9 - 5
-      elif pc_station == 5 and pc_chamber < 9:  # neighbor ME4: 59 - 60
-        pc_lut_id += 50 + 9 - 7
-      assert(pc_lut_id < 61)
+      pc_lut_id = self._find_pc_lut_id(hit.station, hit.ring, hit.neighbor, hit.subsector, hit.cscid)
+      assert(pc_lut_id != -1)
 
       fw_sector = hit.sector-1
       fw_endcap = 0 if (hit.endcap == 1) else 1
@@ -505,6 +583,48 @@ class EMTFOldPhi(object):
       pass
     return emtf_phi
 
+  def array(self, hits):
+    # Same as __call__(), but takes the columnar hits
+    (_type, station, ring, endcap) = (hits['type'], hits['station'], hits['ring'], hits['endcap'])
+    is_csc = (_type == kCSC)
+    emtf_phi = hits['emtf_phi'].astype(np.int32)
+    if not is_csc.any():
+      return emtf_phi
+
+    # Only the CSC hits from now on
+    (station, ring, endcap) = (station[is_csc], ring[is_csc], endcap[is_csc])
+    ph_reverse = ((endcap == 1) & (station >= 3)) | ((endcap == -1) & (station < 3))
+    is_10degree = (station == 1) | ((station >= 2) & (ring == 2))  # ME1 and ME2,3,4/2
+
+    pc_lut_id = self.pc_lut_id_lut[station, ring, hits['neighbor'][is_csc], hits['subsector'][is_csc], hits['cscid'][is_csc]]
+    if np.any(pc_lut_id == -1):
+      raise RuntimeError('Cannot find the chamber address of the CSC hits')
+
+    fw_sector = hits['sector'][is_csc].astype(np.int32) - 1
+    fw_endcap = np.where(endcap == 1, 0, 1)
+    fw_strip = hits['strip'][is_csc].astype(np.int32)  # already starts from 0
+
+    # Apply phi correction from CLCT pattern number
+    clct_pattern = hits['pattern'][is_csc]
+    clct_pat_corr = self.ph_pattern_corr_lut[clct_pattern]
+    clct_pat_corr_sign = np.where(self.ph_pattern_corr_sign_lut[clct_pattern] == 0, 1, -1)
+    clct_pat_corr = np.where((fw_strip == 0) & (clct_pat_corr_sign == -1), 0, clct_pat_corr)
+
+    eighth_strip = np.where(is_10degree,
+        (fw_strip << 2) + clct_pat_corr_sign * (clct_pat_corr >> 1),
+        (fw_strip << 3) + clct_pat_corr_sign * (clct_pat_corr >> 0))
+    assert(np.all(eighth_strip >= 0))
+
+    factor = self.factor_lut[station, ring]
+    ph_tmp = (eighth_strip * factor) >> 10
+    ph_tmp_sign = np.where(ph_reverse, -1, 1)
+
+    endsec_pc_lut_id = (fw_endcap * 6 + fw_sector) * 61 + pc_lut_id
+    fph = self.ph_init_lut[endsec_pc_lut_id] + ph_tmp_sign * ph_tmp
+    assert(np.all((0 <= fph) & (fph < 5000)))
+    emtf_phi[is_csc] = fph
+    return emtf_phi
+
 # Decide EMTF hit theta (integer unit)
 class EMTFTheta(object):
   def __call__(self, hit):
@@ -525,6 +645,17 @@ class EMTFTheta(object):
       pass
     return emtf_theta
 
+  def array(self, hits):
+    # Same as __call__(), but takes the columnar hits
+    (_type, station) = (hits['type'], hits['station'])
+    emtf_theta = hits['emtf_theta'].astype(np.int32)
+    no_theta = (_type == kDT) & ((hits['wire'] == -1) | (hits['quality'] < 2))
+    emtf_theta = np.select(
+        [no_theta & (station == 1), no_theta & (station == 2), no_theta & (station == 3)],
+        [112, 122, 131],
+        default=emtf_theta).astype(np.int32)
+    return emtf_theta
+
 # Decide EMTF hit z-position (floating-point)
 class EMTFZee(object):
   def __init__(self):
@@ -551,6 +682,16 @@ class EMTFQuality(object):
       pass
     return emtf_qual
 
+  def array(self, hits):
+    # Same as __call__(), but takes the columnar hits
+    _type = hits['type']
+    emtf_qual = hits['quality'].astype(np.int32)
+    emtf_qual = np.select(
+        [(_type == kCSC) | (_type == kME0), (_type == kRPC) | (_type == kGEM)],
+        [np.where(hits['fr'] == 1, emtf_qual, -emtf_qual), 0],
+        default=emtf_qual).astype(np.int32)
+    return emtf_qual
+
 # Decide EMTF hit time (integer unit)
 class EMTFTime(object):
   def __call__(self, hit):
@@ -558,6 +699,11 @@ class EMTFTime(object):
     emtf_time = np.int32(hit.bx)
     return emtf_time
 
+  def array(self, hits):
+    # Same as __call__(), but takes the columnar hits
+    emtf_time = hits['bx'].astype(np.int32)
+    return emtf_time
+
 # Decide EMTF road quality (by pattern straightness)
 class EMTFRoadQuality(object):
   def __init__(self):
@@ -594,6 +740,225 @@ class EMTFRoadSortCode(object):
     sort_code |= road_quality
     return sort_code
 
+  def from_layer_mask(self, road_quality, road_layer_mask):
+    # Same as __call__(), but takes arrays of road qualities and layer bitmasks
+    sort_code = np.zeros(road_layer_mask.shape, dtype=np.int32)
+    for hit_lay in xrange(nlayers):
+      has_lay = ((road_layer_mask >> hit_lay) & 1).astype(np.bool)
+      sort_code[has_lay] |= (1 << self.lut[hit_lay])
+    sort_code |= road_quality
+    return sort_code
+
+# Decide EMTF road modes
+class EMTFRoadMode(object):
+  def __init__(self):
+    # The road modes are (mode, mode_csc, mode_me0, mode_me12, mode_csc_me12,
+    # mode_mb1, mode_mb2, mode_me13). Each hit contributes some bits to each
+    # road mode, depending on (type, station, ring, bx==0). The road modes are
+    # found by OR-ing the contributions from all the road hits.
+    nmodes = 8
+    hit_lut = np.zeros((5,5,5,2,nmodes), dtype=np.int32)  # (type, station, ring, bx==0) -> [mode] bits
+    for index in np.ndindex(hit_lut.shape[:-1]):
+      (_type, station, ring, bx_zero) = index
+      if find_emtf_layer.lut[_type, station, ring] == -99:  # not a valid detector
+        continue
+      hit_lut[index] = self._find_hit_mode_bits(_type, station, ring, bx_zero)
+    self.hit_lut = hit_lut
+
+    # Each road mode fits in 4 bits, so all the road modes can be packed into a
+    # single word, and OR-ed together in one go.
+    self.mode_shifts = 4 * np.arange(nmodes, dtype=np.uint32)
+    hit_word_lut = np.bitwise_or.reduce(hit_lut.astype(np.uint32) << self.mode_shifts, axis=-1)
+    assert(np.all(hit_lut < 16))
+    self.hit_word_lut = hit_word_lut
+    self.hit_word_dict = {index: int(hit_word_lut[index]) for index in np.ndindex(hit_word_lut.shape)}
+
+    # The road occupancy is a uint32 bitmask. The lower 16 bits indicate the
+    # emtf_layer's that have hits. The upper 16 bits are layer flags:
+    # - ME1/1 (0), ME0 (11)          : has hit with BX=0
+    # - ME2,3,4 (2,3,4), RE3,4 (7,8) : has hit in ring 2 or 3
+    # In terms of the road occupancy, each layer contributes some bits to each
+    # road mode if the layer has hits (lut0), and some more if the layer flag
+    # is set (lut1).
+    lay_station = np.array([1,1,2,3,4,1,2,3,4,1,2,1,1,2,3,4], dtype=np.int32)
+    lay_station_bit = (1 << (4 - lay_station))
+    lut0 = np.zeros((nmodes, nlayers), dtype=np.int32)  # (mode, layer) -> bits if the layer has hits
+    lut1 = np.zeros((nmodes, nlayers), dtype=np.int32)  # (mode, layer) -> bits if the layer flag is set
+    lut0[0] = lay_station_bit                      # mode
+    lut0[1, [0,1,2,3,4,11]] = lay_station_bit[[0,1,2,3,4,11]]  # mode_csc
+    lut1[2, 0] = (1 << 0)                          # mode_me0: ME1/1
+    lut1[2, 11] = (1 << 1)                         # mode_me0: ME0
+    lut0[3] = lay_station_bit                      # mode_me12
+    lut0[3, [1,5]] = (1 << (4 - 2))                # mode_me12: ME1/2, RE1/2 as station 2
+    lut0[4, [0,2,3,4]] = lay_station_bit[[0,2,3,4]]  # mode_csc_me12
+    lut0[4, 1] = (1 << (4 - 2))                    # mode_csc_me12: ME1/2 as station 2
+    lut0[5, 12] = (1 << 1)                         # mode_mb1: MB1
+    lut0[5, [13,14,15,1,5,6]] = (1 << 0)           # mode_mb1: MB2,3,4, ME1/2, RE1, RE2
+    lut1[5, [2,3,4,7,8]] = (1 << 0)                # mode_mb1: ME2,3,4/2, RE3,4/2,3
+    lut0[6, 13] = (1 << 1)                         # mode_mb2: MB2
+    lut0[6, [14,15,1,5,6]] = (1 << 0)              # mode_mb2: MB3,4, ME1/2, RE1, RE2
+    lut1[6, [2,3,4,7,8]] = (1 << 0)                # mode_mb2: ME2,3,4/2, RE3,4/2,3
+    lut0[7, [1,5]] = (1 << 1)                      # mode_me13: ME1/2, RE1
+    lut0[7, 6] = (1 << 0)                          # mode_me13: RE2
+    lut1[7, [2,3,4,7,8]] = (1 << 0)                # mode_me13: ME2,3,4/2, RE3,4/2,3
+    self.lut0 = lut0
+    self.lut1 = lut1
+
+    occupancy_lut = np.zeros((5,5,5,2), dtype=np.uint32)  # (type, station, ring, bx==0) -> occupancy bits
+    for index in np.ndindex(occupancy_lut.shape):
+      (_type, station, ring, bx_zero) = index
+      hit_lay = find_emtf_layer.lut[_type, station, ring]
+      if hit_lay == -99:
+        continue
+      if hit_lay in (0,11):  # ME1/1, ME0
+        hit_flag = bx_zero
+      elif hit_lay in (2,3,4,7,8):  # ME2,3,4, RE3,4
+        hit_flag = (ring == 2 or ring == 3)
+      else:
+        hit_flag = False
+      occupancy_lut[index] = (1 << hit_lay) | ((1 << (16 + hit_lay)) if hit_flag else 0)
+      # Sanity check
+      hit_mode_bits = lut0[:, hit_lay] | (lut1[:, hit_lay] if hit_flag else 0)
+      assert(np.array_equal(hit_lut[index], hit_mode_bits))
+    self.occupancy_lut = occupancy_lut
+
+    # Apply SingleMu requirement
+    # + (zones 0,1) any road with ME0 and ME1
+    # + (zone 4) any road with ME1/1, ME1/2 + one more station
+    # + (zone 5) any road with 2 stations
+    # + (zone 6) any road with MB1+MB2, MB1+MB3, MB1+ME1/3, MB1+ME2/2, MB2+MB3, MB2+ME1/3, MB2+ME2/2, ME1/3+ME2/2
+    nzones = len(eta_bins)-1
+    singlemu = np.array([is_emtf_singlemu(mode) for mode in xrange(16)], dtype=np.bool)
+    doublemu = np.array([is_emtf_doublemu(mode) for mode in xrange(16)], dtype=np.bool)
+    muopen = np.array([is_emtf_muopen(mode) for mode in xrange(16)], dtype=np.bool)
+    select_csc = np.zeros((nzones,16,16), dtype=np.bool)  # (ieta, mode, mode_csc) -> pass
+    select_csc[:] = np.outer(singlemu, muopen)
+    select_csc[5] |= np.outer(doublemu, muopen)
+    select_me0 = np.zeros((nzones,4), dtype=np.bool)  # (ieta, mode_me0) -> pass
+    select_me0[(0,1), 3] = True
+    select_me12 = np.zeros((nzones,16,16), dtype=np.bool)  # (ieta, mode_me12, mode_csc_me12) -> pass
+    select_me12[4] = np.outer(singlemu, muopen)
+    select_mb = np.zeros((nzones,4,4,4), dtype=np.bool)  # (ieta, mode_mb1, mode_mb2, mode_me13) -> pass
+    (mode_mb1, mode_mb2, mode_me13) = np.indices((4,4,4))
+    select_mb[6] = (mode_mb1 == 3) | (mode_mb2 == 3) | (mode_me13 == 3)
+    self.select_csc = select_csc
+    self.select_me0 = select_me0
+    self.select_me12 = select_me12
+    self.select_mb = select_mb
+    self.select_word_cache = dict()  # (ieta, packed road modes) -> pass
+
+  def _find_hit_mode_bits(self, _type, station, ring, bx_zero):
+    road_mode = 0
+    road_mode_csc = 0
+    road_mode_me0 = 0  # zones 0,1
+    road_mode_me12 = 0 # zone 4
+    road_mode_csc_me12 = 0 # zone 4
+    road_mode_mb1 = 0  # zone 6
+    road_mode_mb2 = 0  # zone 6
+    road_mode_me13 = 0 # zone 6
+    #road_mode_me22 = 0 # zone 6
+
+    road_mode |= (1 << (4 - station))
+
+    if _type == kCSC or _type == kME0:
+      road_mode_csc |= (1 << (4 - station))
+
+    if _type == kME0 and bx_zero:
+      road_mode_me0 |= (1 << 1)
+    elif _type == kCSC and station == 1 and (ring == 1 or ring == 4) and bx_zero:
+      road_mode_me0 |= (1 << 0)
+
+    if _type == kCSC and station == 1 and (ring == 2 or ring == 3):  # pretend as station 2
+      road_mode_me12 |= (1 << (4 - 2))
+    elif _type == kRPC and station == 1 and (ring == 2 or ring == 3):  # pretend as station 2
+      road_mode_me12 |= (1 << (4 - 2))
+    else:
+      road_mode_me12 |= (1 << (4 - station))
+
+    if _type == kCSC and station == 1 and (ring == 2 or ring == 3):  # pretend as station 2
+      road_mode_csc_me12 |= (1 << (4 - 2))
+    elif _type == kCSC:
+      road_mode_csc_me12 |= (1 << (4 - station))
+
+    if _type == kDT and station == 1:
+      road_mode_mb1 |= (1 << 1)
+    elif _type == kDT and station >= 2:
+      road_mode_mb1 |= (1 << 0)
+    elif _type == kCSC and station >= 1 and (ring == 2 or ring == 3):
+      road_mode_mb1 |= (1 << 0)
+    elif _type == kRPC and station >= 1 and (ring == 2 or ring == 3):
+      road_mode_mb1 |= (1 << 0)
+
+    if _type == kDT and station == 2:
+      road_mode_mb2 |= (1 << 1)
+    elif _type == kDT and station >= 3:
+      road_mode_mb2 |= (1 << 0)
+    elif _type == kCSC and station >= 1 and (ring == 2 or ring == 3):
+      road_mode_mb2 |= (1 << 0)
+    elif _type == kRPC and station >= 1 and (ring == 2 or ring == 3):
+      road_mode_mb2 |= (1 << 0)
+
+    if _type == kCSC and station == 1 and (ring == 2 or ring == 3):
+      road_mode_me13 |= (1 << 1)
+    elif _type == kCSC and station >= 2 and (ring == 2 or ring == 3):
+      road_mode_me13 |= (1 << 0)
+    elif _type == kRPC and station == 1 and (ring == 2 or ring == 3):
+      road_mode_me13 |= (1 << 1)
+    elif _type == kRPC and station >= 2 and (ring == 2 or ring == 3):
+      road_mode_me13 |= (1 << 0)
+
+    #if _type == kCSC and station == 2 and (ring == 2 or ring == 3):
+    #  road_mode_me22 |= (1 << 1)
+    #elif _type == kCSC and station >= 3 and (ring == 2 or ring == 3):
+    #  road_mode_me22 |= (1 << 0)
+    #elif _type == kRPC and station == 2 and (ring == 2 or ring == 3):
+    #  road_mode_me22 |= (1 << 1)
+    #elif _type == kRPC and station >= 3 and (ring == 2 or ring == 3):
+    #  road_mode_me22 |= (1 << 0)
+
+    return (road_mode, road_mode_csc, road_mode_me0, road_mode_me12, road_mode_csc_me12,
+            road_mode_mb1, road_mode_mb2, road_mode_me13)
+
+  def __call__(self, road_hits_id):
+    # Takes the (type, station, ring, endsec, fr, bx) of the road hits, returns the packed road modes
+    road_word = 0
+    for hit_id in road_hits_id:
+      road_word |= self.hit_word_dict[(hit_id[0], hit_id[1], hit_id[2], hit_id[5] == 0)]
+    return road_word
+
+  def unpack(self, road_word):
+    # Takes the packed road modes, returns the road modes with shape (nmodes,) + road_word.shape
+    road_word = np.asarray(road_word, dtype=np.uint32)
+    road_modes = (road_word[np.newaxis, ...] >> self.mode_shifts.reshape((-1,) + (1,) * road_word.ndim)) & 0xf
+    return road_modes.astype(np.int32)
+
+  def from_occupancy(self, road_occupancy):
+    # Takes an array of road occupancies, returns the road modes with shape (nmodes, nroads)
+    road_modes = np.zeros((self.lut0.shape[0],) + road_occupancy.shape, dtype=np.int32)
+    for hit_lay in xrange(nlayers):
+      has_lay = ((road_occupancy >> hit_lay) & 1).astype(np.bool)
+      has_flag = ((road_occupancy >> (16 + hit_lay)) & 1).astype(np.bool)
+      road_modes[:, has_lay] |= self.lut0[:, hit_lay][:, np.newaxis]
+      road_modes[:, has_flag] |= self.lut1[:, hit_lay][:, np.newaxis]
+    return road_modes
+
+  def select(self, ieta, road_modes):
+    # Works with scalars or arrays
+    (road_mode, road_mode_csc, road_mode_me0, road_mode_me12, road_mode_csc_me12,
+     road_mode_mb1, road_mode_mb2, road_mode_me13) = road_modes
+    return self.select_csc[ieta, road_mode, road_mode_csc] | \
+        self.select_me0[ieta, road_mode_me0] | \
+        self.select_me12[ieta, road_mode_me12, road_mode_csc_me12] | \
+        self.select_mb[ieta, road_mode_mb1, road_mode_mb2, road_mode_me13]
+
+  def select_word(self, ieta, road_word):
+    # Same as select(), but takes the packed road modes of a single road
+    result = self.select_word_cache.get((ieta, road_word), None)
+    if result is None:
+      result = bool(self.select(ieta, self.unpack(road_word)))
+      self.select_word_cache[(ieta, road_word)] = result
+    return result
+
 find_emtf_layer = EMTFLayer()
 find_emtf_zones = EMTFZone()
 find_emtf_bend = EMTFBend()
@@ -623,23 +988,64 @@ def is_emtf_singlehit(mode):
 def is_emtf_singlehit_me2(mode):
   return bool(mode & (1 << 2))
 
+find_emtf_road_modes = EMTFRoadMode()
+
 # Decide EMTF legit hit
+def is_emtf_legit_hit_bx(hit):
+  if hit.type == kCSC:
+    return hit.bx in (-1,0)
+  elif hit.type == kDT:
+    return hit.bx in (-1,0)
+  else:
+    return hit.bx == 0
+
+def is_emtf_legit_hit_phi(hit):
+  if hit.type == kME0:
+    return hit.emtf_phi > 0
+  elif hit.type == kDT:
+    return hit.emtf_phi > 0
+  else:
+    return True
+
 def is_emtf_legit_hit(hit):
-  def check_bx(hit):
-    if hit.type == kCSC:
-      return hit.bx in (-1,0)
-    elif hit.type == kDT:
-      return hit.bx in (-1,0)
-    else:
-      return hit.bx == 0
-  def check_phi(hit):
-    if hit.type == kME0:
-      return hit.emtf_phi > 0
-    elif hit.type == kDT:
-      return hit.emtf_phi > 0
-    else:
-      return True
-  return check_bx(hit) and check_phi(hit)
+  return is_emtf_legit_hit_bx(hit) and is_emtf_legit_hit_phi(hit)
+
+def is_emtf_legit_hit_bx_array(_type, bx):
+  # Same as is_emtf_legit_hit_bx(), but works on arrays
+  return np.where((_type == kCSC) | (_type == kDT), (bx == -1) | (bx == 0), bx == 0)
+
+def is_emtf_legit_hit_array(hits):
+  # Same as is_emtf_legit_hit(), but works on the columnar hits
+  (_type, bx, emtf_phi) = (hits['type'], hits['bx'], hits['emtf_phi'])
+  check_bx = is_emtf_legit_hit_bx_array(_type, bx)
+  check_phi = np.where((_type == kME0) | (_type == kDT), emtf_phi > 0, True)
+  return check_bx & check_phi
+
+def check_emtf_hit_converters(hits):
+  # Compares the array versions of the hit converters against the scalar
+  # versions on the (legit) columnar hits. Returns the number of mismatched
+  # hits for each converter.
+  hits = hits[is_emtf_legit_hit_array(hits)]
+  records = make_columnar_records(hits)
+  converters = [
+    ('emtf_layer', find_emtf_layer),
+    ('emtf_bend', find_emtf_bend),
+    ('old_emtf_bend', find_emtf_old_bend),
+    ('emtf_phi', find_emtf_phi),
+    ('old_emtf_phi', find_emtf_old_phi),
+    ('emtf_theta', find_emtf_theta),
+    ('emtf_qual', find_emtf_qual),
+    ('emtf_time', find_emtf_time),
+  ]
+  nmismatched = []
+  for (name, converter) in converters:
+    values = converter.array(hits)
+    values_scalar = np.array([converter(hit) for hit in records], dtype=np.int64)
+    nmismatched.append((name, np.count_nonzero(values != values_scalar)))
+  zones = [np.flatnonzero(x) for x in find_emtf_zones.array(hits)]
+  zones_scalar = [find_emtf_zones(hit) for hit in records]
+  nmismatched.append(('zones', sum(not np.array_equal(x, y) for (x, y) in zip(zones, zones_scalar))))
+  return nmismatched
 
 def is_emtf_images_hit(hit):
   def check_quality(hit):
@@ -820,10 +1226,34 @@ def particles_to_parameters(particles):
   return parameters
 
 # Save road list as a numpy array
+# - same layout as Road.to_variables(), but filled in bulk: the first hit in
+#   each (road, emtf_layer) is found for all the roads at once, and each of the
+#   9 variables is written into its columns (i*nlayers + lay) in one go
 def roads_to_variables(roads):
-  variables = np.zeros((len(roads), (ROAD_LAYER_NVARS_P1 * nlayers) + ROAD_INFO_NVARS), dtype=np.float32)
-  for i, road in enumerate(roads):
-    variables[i] = road.to_variables()
+  variables = np.empty((len(roads), (ROAD_LAYER_NVARS_P1 * nlayers) + ROAD_INFO_NVARS), dtype=np.float32)
+  variables[:, 0*nlayers:ROAD_LAYER_NVARS*nlayers] = np.nan                # variables (n=nlayers * 9)
+  variables[:, ROAD_LAYER_NVARS*nlayers:ROAD_LAYER_NVARS_P1*nlayers] = 1.0 # mask      (n=nlayers * 1)
+  if len(roads) == 0:
+    return variables
+
+  # Road info (n=4)
+  variables[:, ROAD_LAYER_NVARS_P1*nlayers:] = [(road.id[2], road.id[3], road.phi_median, road.theta_median) for road in roads]
+
+  # Keep the first hit in each emtf_layer
+  road_hits = [hit for road in roads for hit in road.hits]
+  if len(road_hits) == 0:
+    return variables
+  road_idx = np.repeat(np.arange(len(roads)), [len(road.hits) for road in roads])
+  hit_lay = np.array([hit.emtf_layer for hit in road_hits], dtype=np.int64)
+  (_, first) = np.unique(road_idx * nlayers + hit_lay, return_index=True)
+  road_hits = [road_hits[j] for j in first]
+  (road_idx, hit_lay) = (road_idx[first], hit_lay[first])
+
+  hit_values = np.array([(hit.emtf_phi, hit.emtf_theta, hit.emtf_bend, hit.emtf_qual, hit.emtf_time,
+                          hit.ring, hit.fr, hit.old_emtf_phi, hit.old_emtf_bend) for hit in road_hits])
+  for i in xrange(ROAD_LAYER_NVARS):
+    variables[road_idx, i*nlayers + hit_lay] = hit_values[:, i]
+  variables[road_idx, ROAD_LAYER_NVARS*nlayers + hit_lay] = 0.0  # unmask
   return variables
 
 class RaggedTensorValue(object):
@@ -894,6 +1324,112 @@ def create_ragged_array(pylist):
     values = RaggedTensorValue(values, row_splits)
   return values
 
+# Columnar event data
+# The vh_*, vt_*, vp_*, ve_* branches for a block of events are stored as
+# jagged arrays: a numpy record array with the values of all the events
+# concatenated, plus the row_splits (see RaggedTensorValue). They are read by
+# load_columnar_blocks(), e.g. to check the array versions of the hit converters
+# against the scalar versions (see ConvertersAnalysis).
+class ColumnarRecord(object):
+  # A mutable row of a columnar collection, with the same attributes as the rootpy objects
+  def __init__(self, names, row):
+    self.__dict__.update(zip(names, row))
+
+def copy_records(collection, names):
+  # Copies the given attributes of the objects in a collection
+  return [ColumnarRecord(names, [getattr(obj, name) for name in names]) for obj in collection]
+
+def make_columnar_records(values):
+  names = values.dtype.names
+  return [ColumnarRecord(names, row) for row in values.tolist()]
+
+class ColumnarEvent(object):
+  def __init__(self, block, ievt):
+    for name, collection in block.collections.iteritems():
+      (begin, end) = collection.row_splits[ievt:ievt+2]
+      setattr(self, name, collection.values[begin:end])
+
+class ColumnarEventBlock(object):
+  def __init__(self, collections, entry_start=0):
+    self.collections = collections  # name -> RaggedTensorValue
+    self.entry_start = entry_start
+    self.nevents = 0
+    if collections:
+      self.nevents = len(next(collections.itervalues()).row_splits) - 1
+
+  def __len__(self):
+    return self.nevents
+
+  def __getitem__(self, ievt):
+    return ColumnarEvent(self, ievt)
+
+  def __iter__(self):
+    for ievt in xrange(self.nevents):
+      yield ColumnarEvent(self, ievt)
+
+def create_jagged_array(arr, prefix, size):
+  # Takes the output of root_numpy.root2array(), where the vector branches are
+  # object arrays of numpy arrays, returns the collection with the given prefix
+  lengths = np.asarray(arr[size], dtype=np.int64)
+  row_splits = np.zeros(len(lengths)+1, dtype=np.int64)
+  np.cumsum(lengths, out=row_splits[1:])
+
+  names = []
+  columns = []
+  for branch in arr.dtype.names:
+    if branch.startswith(prefix) and branch != size:
+      column = arr[branch]
+      if len(column):
+        column = np.concatenate(column)
+      else:
+        column = np.zeros(0, dtype=np.float32)
+      assert(len(column) == row_splits[-1])
+      names.append(branch[len(prefix):])
+      columns.append(column)
+  values = np.rec.fromarrays(columns, names=names)
+  return RaggedTensorValue(values, row_splits)
+
+def make_columnar_collection(objects, names, **columns):
+  # Copies the given attributes of the objects (e.g. the rootpy tracks, or the
+  # Track objects) into a numpy record array, with the same layout as the values
+  # of the jagged arrays. Extra columns can be given as arrays.
+  names = list(names)
+  arrays = [np.array([getattr(obj, name) for obj in objects]) for name in names]
+  for name in sorted(columns.keys()):
+    names.append(name)
+    arrays.append(np.asarray(columns[name]))
+  return np.rec.fromarrays(arrays, names=names)
+
+# Named selections
+# A selection is declared once as a function of (collection, masks), where
+# 'masks' gives access to the other selections on the same collection. The
+# selections are evaluated lazily on a columnar collection, either of an event
+# or of a whole block of events, and each one is only computed once.
+class Selections(object):
+  def __init__(self):
+    self.funcs = {}  # name -> func
+
+  def declare(self, name, func):
+    if name in self.funcs:
+      raise RuntimeError('Selection is already declared: {0}'.format(name))
+    self.funcs[name] = func
+
+  def evaluate(self, collection):
+    return SelectionMasks(self, collection)
+
+class SelectionMasks(object):
+  def __init__(self, selections, collection):
+    self.selections = selections
+    self.collection = collection
+    self.masks = {}  # name -> mask
+
+  def __getitem__(self, name):
+    mask = self.masks.get(name, None)
+    if mask is None:
+      mask = self.selections.funcs[name](self.collection, self)
+      self.masks[name] = mask
+    return mask
+
 
 # ______________________________________________________________________________
 # Modules
@@ -902,20 +1438,36 @@ PATTERN_X_CENTRAL = 31  # pattern bin number 31 is the central
 PATTERN_X_SEARCH_MIN = 33
 #PATTERN_X_SEARCH_MAX = 154-10
 PATTERN_X_SEARCH_MAX = 154-10+12  # account for DT
+PATTERN_X_SEARCH_NBINS = PATTERN_X_SEARCH_MAX + 1
+
+# Sector hits as a numpy structured array (used by the batch mode)
+sector_hit_dtype = np.dtype([('hit_x', np.int32), ('lay', np.int32), ('zones', np.int32), ('occupancy', np.uint32)])
 
 # Pattern recognition module
 class PatternRecognition(object):
-  def __init__(self, bank, omtf_input=False, run2_input=False):
+  def __init__(self, bank, omtf_input=False, run2_input=False, batch_mode=True):
     self.bank = bank
     self.cache = dict()  # cache for pattern results
     self.omtf_input = omtf_input
     self.run2_input = run2_input
-
-  def _create_road_hit(self, hit):
-    hit_id = (hit.type, hit.station, hit.ring, hit.endsec, hit.fr, hit.bx)
+    self.batch_mode = batch_mode  # use the numpy batch mode instead of the dict-based loop
+
+    # Pattern windows with (zone, lay, ipt) for the batch mode
+    self.patterns_x0 = np.transpose(self.bank.x_array[..., 0], (1, 2, 0)).copy()
+    self.patterns_x1 = np.transpose(self.bank.x_array[..., 2], (1, 2, 0)).copy()
+    self.patterns_max_width = np.max(self.patterns_x1 - self.patterns_x0) + 1
+
+    # Road occupancy with (ipt, ieta, iphi) for the batch mode (see EMTFRoadMode)
+    self.occupancy = np.zeros(self.bank.x_array.shape[:2] + (PATTERN_X_SEARCH_NBINS,), dtype=np.uint32)
+
+  def _create_road_hit(self, hit, bx=None, emtf_time=None):
+    # The BX and the time can be given, if they differ from the hit (see run_prepared())
+    if bx is None:
+      bx = hit.bx
+      emtf_time = find_emtf_time(hit)
+    hit_id = (hit.type, hit.station, hit.ring, hit.endsec, hit.fr, bx)
     emtf_bend = find_emtf_bend(hit)
     emtf_qual = find_emtf_qual(hit)
-    emtf_time = find_emtf_time(hit)
     sim_tp = hit.sim_tp1
     myhit = Hit(hit_id, hit.lay, hit.emtf_phi, hit.emtf_theta, emtf_bend,
                 emtf_qual, emtf_time, hit.old_emtf_phi, hit.old_emtf_bend,
@@ -924,90 +1476,15 @@ class PatternRecognition(object):
 
   def _create_road(self, road_id, road_hits):
     # Find road modes
-    road_mode = 0
-    road_mode_csc = 0
-    road_mode_me0 = 0  # zones 0,1
-    road_mode_me12 = 0 # zone 4
-    road_mode_csc_me12 = 0 # zone 4
-    road_mode_mb1 = 0  # zone 6
-    road_mode_mb2 = 0  # zone 6
-    road_mode_me13 = 0 # zone 6
-    #road_mode_me22 = 0 # zone 6
-
-    for hit in road_hits:
-      (_type, station, ring, endsec, fr, bx) = hit.id
-      road_mode |= (1 << (4 - station))
-
-      if _type == kCSC or _type == kME0:
-        road_mode_csc |= (1 << (4 - station))
-
-      if _type == kME0 and bx == 0:
-        road_mode_me0 |= (1 << 1)
-      elif _type == kCSC and station == 1 and (ring == 1 or ring == 4) and bx == 0:
-        road_mode_me0 |= (1 << 0)
-
-      if _type == kCSC and station == 1 and (ring == 2 or ring == 3):  # pretend as station 2
-        road_mode_me12 |= (1 << (4 - 2))
-      elif _type == kRPC and station == 1 and (ring == 2 or ring == 3):  # pretend as station 2
-        road_mode_me12 |= (1 << (4 - 2))
-      else:
-        road_mode_me12 |= (1 << (4 - station))
-
-      if _type == kCSC and station == 1 and (ring == 2 or ring == 3):  # pretend as station 2
-        road_mode_csc_me12 |= (1 << (4 - 2))
-      elif _type == kCSC:
-        road_mode_csc_me12 |= (1 << (4 - station))
-
-      if _type == kDT and station == 1:
-        road_mode_mb1 |= (1 << 1)
-      elif _type == kDT and station >= 2:
-        road_mode_mb1 |= (1 << 0)
-      elif _type == kCSC and station >= 1 and (ring == 2 or ring == 3):
-        road_mode_mb1 |= (1 << 0)
-      elif _type == kRPC and station >= 1 and (ring == 2 or ring == 3):
-        road_mode_mb1 |= (1 << 0)
-
-      if _type == kDT and station == 2:
-        road_mode_mb2 |= (1 << 1)
-      elif _type == kDT and station >= 3:
-        road_mode_mb2 |= (1 << 0)
-      elif _type == kCSC and station >= 1 and (ring == 2 or ring == 3):
-        road_mode_mb2 |= (1 << 0)
-      elif _type == kRPC and station >= 1 and (ring == 2 or ring == 3):
-        road_mode_mb2 |= (1 << 0)
-
-      if _type == kCSC and station == 1 and (ring == 2 or ring == 3):
-        road_mode_me13 |= (1 << 1)
-      elif _type == kCSC and station >= 2 and (ring == 2 or ring == 3):
-        road_mode_me13 |= (1 << 0)
-      elif _type == kRPC and station == 1 and (ring == 2 or ring == 3):
-        road_mode_me13 |= (1 << 1)
-      elif _type == kRPC and station >= 2 and (ring == 2 or ring == 3):
-        road_mode_me13 |= (1 << 0)
-
-      #if _type == kCSC and station == 2 and (ring == 2 or ring == 3):
-      #  road_mode_me22 |= (1 << 1)
-      #elif _type == kCSC and station >= 3 and (ring == 2 or ring == 3):
-      #  road_mode_me22 |= (1 << 0)
-      #elif _type == kRPC and station == 2 and (ring == 2 or ring == 3):
-      #  road_mode_me22 |= (1 << 1)
-      #elif _type == kRPC and station >= 3 and (ring == 2 or ring == 3):
-      #  road_mode_me22 |= (1 << 0)
+    road_word = find_emtf_road_modes([hit.id for hit in road_hits])
+    road_mode = (road_word & 0xf)
 
     # Create road
     myroad = None
     (endcap, sector, ipt, ieta, iphi) = road_id
 
-    # Apply SingleMu requirement
-    # + (zones 0,1) any road with ME0 and ME1
-    # + (zone 4) any road with ME1/1, ME1/2 + one more station
-    # + (zone 5) any road with 2 stations
-    # + (zone 6) any road with MB1+MB2, MB1+MB3, MB1+ME1/3, MB1+ME2/2, MB2+MB3, MB2+ME1/3, MB2+ME2/2, ME1/3+ME2/2
-    if ((is_emtf_singlemu(road_mode) and is_emtf_muopen(road_mode_csc)) or \
-        (ieta in (0,1) and road_mode_me0 == 3) or \
-        (ieta in (4,) and is_emtf_singlemu(road_mode_me12) and is_emtf_muopen(road_mode_csc_me12)) or \
-        (ieta in (5,) and is_emtf_doublemu(road_mode) and is_emtf_muopen(road_mode_csc)) or \
-        (ieta in (6,) and (road_mode_mb1 == 3 or road_mode_mb2 == 3 or road_mode_me13 == 3)) ):
+    # Apply SingleMu requirement (see EMTFRoadMode)
+    if find_emtf_road_modes.select_word(ieta, road_word):
       road_quality = find_emtf_road_quality(ipt)
       road_sort_code = find_emtf_road_sort_code(road_quality, [hit.emtf_layer for hit in road_hits])
       road_phi_median = 0    # to be determined later
@@ -1075,10 +1552,158 @@ class PatternRecognition(object):
         roads.append(myroad)
     return roads
 
-  def run(self, hits):
+  def _make_sector_hit_array(self, sector_hits):
+    # Pack the sector hits into a structured array. The zones are stored as a bitmask.
+    sector_hit_array = np.zeros(len(sector_hits), dtype=sector_hit_dtype)
+    sector_hit_array['hit_x'] = [find_pattern_x(hit.emtf_phi) for hit in sector_hits]
+    sector_hit_array['lay'] = [hit.lay for hit in sector_hits]
+    zones_mask = []
+    for hit in sector_hits:
+      hit_zones_mask = 0
+      for hit_zone in hit.zones:
+        if not self.omtf_input:
+          if hit_zone == 6:  # ignore zone 6
+            continue
+        hit_zones_mask |= (1 << hit_zone)
+      zones_mask.append(hit_zones_mask)
+    sector_hit_array['zones'] = zones_mask
+    sector_hit_array['occupancy'] = self._find_sector_hit_occupancy(sector_hits)
+    return sector_hit_array
+
+  def _find_sector_hit_occupancy(self, sector_hits, hits_bx=None):
+    # Road occupancy bits of the sector hits (see EMTFRoadMode). This depends on the hit BX,
+    # which can be given as an array.
+    hits_id = np.array([(hit.type, hit.station, hit.ring, hit.bx == 0) for hit in sector_hits], dtype=np.int32)
+    if hits_bx is not None:
+      hits_id[:,3] = (hits_bx == 0)
+    return find_emtf_road_modes.occupancy_lut[hits_id[:,0], hits_id[:,1], hits_id[:,2], hits_id[:,3]]
+
+  def _find_pattern_matches(self, sector_hit_array):
+    # Returns one entry per (road, hit) association as integer arrays
+    # (ipt, ieta, iphi, hit_index), sorted by hit_index
+    nzones = len(eta_bins)-1
+
+    # Expand the hits into (hit, zone) pairs
+    zone_bits = (sector_hit_array['zones'][:, np.newaxis] >> np.arange(nzones)) & 1
+    pair_hit, pair_zone = np.nonzero(zone_bits)
+    pair_x = sector_hit_array['hit_x'][pair_hit]
+    pair_lay = sector_hit_array['lay'][pair_hit]
+
+    # Broadcast hit_x against the pattern windows with shape (npairs, npatterns, width)
+    patterns_x0 = self.patterns_x0[pair_zone, pair_lay]
+    patterns_x1 = self.patterns_x1[pair_zone, pair_lay]
+    patterns_iphi = patterns_x0[..., np.newaxis] + np.arange(self.patterns_max_width, dtype=np.int32)
+    iphi = pair_x[:, np.newaxis, np.newaxis] - patterns_iphi
+
+    # Full range is 0 <= iphi <= 154. but a reduced range is sufficient (27% saving on patterns)
+    valid = (patterns_iphi <= patterns_x1[..., np.newaxis]) & \
+        (PATTERN_X_SEARCH_MIN <= iphi) & (iphi <= PATTERN_X_SEARCH_MAX)
+    ipair, ipt, _ = np.nonzero(valid)
+    iphi = iphi[valid]
+    ieta = pair_zone[ipair]
+    hit_index = pair_hit[ipair]
+    return (ipt, ieta, iphi, hit_index)
+
+  def _select_roads_from_occupancy(self):
+    # Apply the road mode requirements (see _create_road()) on all the occupied roads at once
+    road_keys = np.flatnonzero(self.occupancy)
+    road_occupancy = self.occupancy.reshape(-1)[road_keys]
+    ieta = np.unravel_index(road_keys, self.occupancy.shape)[1]
+
+    road_modes = find_emtf_road_modes.from_occupancy(road_occupancy)
+    accept = find_emtf_road_modes.select(ieta, road_modes)
+    road_mode = road_modes[0]
+    return (road_keys[accept], road_occupancy[accept], road_mode[accept])
+
+  def _apply_patterns_batch(self, endcap, sector, sector_hits):
+    # Same as _apply_patterns(), but uses numpy arrays instead of looping over the hits.
+    # The candidate roads are first accumulated in the occupancy tensor, and the
+    # Road objects are only built for the roads that satisfy the mode requirements.
+    if len(sector_hits) == 0:
+      return []
+
+    sector_hit_array = self._make_sector_hit_array(sector_hits)
+    matches = self._find_pattern_matches(sector_hit_array)
+    return self._make_roads_from_matches(endcap, sector, sector_hits, sector_hit_array['occupancy'], matches)
+
+  def _make_roads_from_matches(self, endcap, sector, sector_hits, sector_hit_occupancy, matches, hits_bx=None):
+    # Takes the pattern matches (see _find_pattern_matches()) and the road occupancy
+    # bits of the sector hits, returns the roads that satisfy the mode requirements.
+    # The hit BX can be given as an array, if it differs from the hits.
+    (ipt, ieta, iphi, hit_index) = matches
+
+    # Fill the road occupancy
+    road_key = np.ravel_multi_index((ipt, ieta, iphi), self.occupancy.shape)
+    self.occupancy.fill(0)
+    np.bitwise_or.at(self.occupancy.reshape(-1), road_key, sector_hit_occupancy[hit_index])
+
+    # Select the roads
+    (road_keys, road_occupancy, road_mode) = self._select_roads_from_occupancy()
+    if len(road_keys) == 0:
+      return []
+
+    # Find the road membership of the selected roads
+    road_index = np.searchsorted(road_keys, road_key)
+    selected = (road_keys[np.minimum(road_index, len(road_keys)-1)] == road_key)
+    road_index, hit_index = road_index[selected], hit_index[selected]
+    ind = np.argsort(road_index, kind='mergesort')  # stable, keeps the hit order
+    road_index, hit_index = road_index[ind], hit_index[ind]
+    road_splits = np.searchsorted(road_index, np.arange(len(road_keys)+1))
+
+    # Find road quality and sort code
+    road_ipt, road_ieta, road_iphi = np.unravel_index(road_keys, self.occupancy.shape)
+    road_quality = find_emtf_road_quality(road_ipt)
+    road_sort_code = find_emtf_road_sort_code.from_layer_mask(road_quality, road_occupancy & 0xffff)
+
+    # Create and associate 'myhit' to road ids
+    myhits = [None] * len(sector_hits)
+    if hits_bx is None:
+      for ihit in np.unique(hit_index):
+        myhits[ihit] = self._create_road_hit(sector_hits[ihit])
+    else:
+      hits_time = find_emtf_time.array({'bx': hits_bx})
+      for ihit in np.unique(hit_index):
+        myhits[ihit] = self._create_road_hit(sector_hits[ihit], bx=int(hits_bx[ihit]), emtf_time=hits_time[ihit])
+
+    # Create roads
+    roads = []
+    hit_index = hit_index.tolist()
+    for iroad in xrange(len(road_keys)):
+      road_id = (endcap, sector, int(road_ipt[iroad]), int(road_ieta[iroad]), int(road_iphi[iroad]))
+      road_hits = [myhits[ihit] for ihit in hit_index[road_splits[iroad]:road_splits[iroad+1]]]
+      road_phi_median = 0    # to be determined later
+      road_theta_median = 0  # to be determined later
+      myroad = Road(road_id, road_hits, int(road_mode[iroad]), road_quality[iroad], road_sort_code[iroad], road_phi_median, road_theta_median)
+      roads.append(myroad)
+    return roads
+
+  def _apply_derived_hits(self, hits, derived_hits):
+    # Same as the hit conversions in run(), but takes the derived columns from
+    # the cache (see DerivedHitCache). The phi, theta and zones are returned
+    # as a dict by id(hit), to be set only for the hits that are processed.
+    legit_hits = []
+    derived_values = {}
+    columns = [derived_hits[name] for name in ('endsec', 'lay', 'old_emtf_phi', 'old_emtf_bend', 'emtf_phi', 'emtf_theta', 'zones')]
+    assert(len(hits) == len(columns[0]))
+    for (hit, endsec, lay, old_emtf_phi, old_emtf_bend, emtf_phi, emtf_theta, zones) in zip(hits, *columns):
+      if is_emtf_legit_hit(hit):
+        assert(lay != -99)
+        hit.endsec = endsec
+        hit.lay = lay
+        hit.old_emtf_phi = old_emtf_phi
+        hit.old_emtf_bend = old_emtf_bend
+        derived_values[id(hit)] = (emtf_phi, emtf_theta, derived_zones_lut[zones])
+        legit_hits.append(hit)
+    return (legit_hits, derived_values)
+
+  def run(self, hits, derived_hits=None):
     roads = []
 
-    legit_hits = filter(is_emtf_legit_hit, hits)
+    derived_values = None
+    if derived_hits is not None:
+      (legit_hits, derived_values) = self._apply_derived_hits(list(hits), derived_hits)
+    else:
+      legit_hits = filter(is_emtf_legit_hit, hits)
 
     # Split by sector
     sector_mode_array = np.zeros((12,), dtype=np.int32)
@@ -1088,13 +1713,14 @@ class PatternRecognition(object):
 
     # Loop over hits
     for ihit, hit in enumerate(legit_hits):
-      hit.endsec = find_endsec(hit.endcap, hit.sector)
-      hit.lay = find_emtf_layer(hit)
-      assert(hit.lay != -99)
+      if derived_values is None:
+        hit.endsec = find_endsec(hit.endcap, hit.sector)
+        hit.lay = find_emtf_layer(hit)
+        assert(hit.lay != -99)
 
-      # Save the old phi & bend values
-      hit.old_emtf_phi = find_emtf_old_phi(hit)
-      hit.old_emtf_bend = find_emtf_old_bend(hit)
+        # Save the old phi & bend values
+        hit.old_emtf_phi = find_emtf_old_phi(hit)
+        hit.old_emtf_bend = find_emtf_old_bend(hit)
 
       if hit.type == kCSC:
         sector_mode_array[hit.endsec] |= (1 << (4 - hit.station))
@@ -1123,17 +1749,149 @@ class PatternRecognition(object):
           sector_hits = list(filter(is_valid_for_run2, sector_hits))
 
         # Loop over sector hits
-        for ihit, hit in enumerate(sector_hits):
-          hit.emtf_phi = find_emtf_phi(hit)
-          hit.emtf_theta = find_emtf_theta(hit)
-          hit.zones = find_emtf_zones(hit)
+        if derived_values is not None:
+          for ihit, hit in enumerate(sector_hits):
+            (hit.emtf_phi, hit.emtf_theta, hit.zones) = derived_values[id(hit)]
+        else:
+          for ihit, hit in enumerate(sector_hits):
+            hit.emtf_phi = find_emtf_phi(hit)
+            hit.emtf_theta = find_emtf_theta(hit)
+            hit.zones = find_emtf_zones(hit)
 
         # Apply patterns to the sector hits
-        sector_roads = self._apply_patterns(endcap, sector, sector_hits)
+        if self.batch_mode:
+          sector_roads = self._apply_patterns_batch(endcap, sector, sector_hits)
+        else:
+          sector_roads = self._apply_patterns(endcap, sector, sector_hits)
         sector_roads.sort(key=lambda x: x.id)
         roads += sector_roads
     return roads
 
+  def prepare(self, hits, derived_hits=None):
+    # Does the BX-independent part of run() once per event: the hit conversions
+    # and the pattern matches in each sector. The hit BX is also kept. The result
+    # is passed to run_prepared(), which can be called several times with different
+    # BX shifts (see MixingAnalysis), without changing the hits.
+    # Unlike run(), all the hits that can become legit hits are converted, and
+    # only the batch mode is used.
+    hits = list(hits)
+    if derived_hits is not None:
+      columns = [derived_hits[name] for name in derived_hit_columns]
+      assert(len(hits) == len(columns[0]))
+
+    sector_hits_array = np.empty((12,), dtype=np.object)
+    for ind in np.ndindex(sector_hits_array.shape):
+      sector_hits_array[ind] = []
+    invalid_hits = []  # hits that must never become legit hits, whatever their BX
+
+    # Loop over hits
+    for ihit, hit in enumerate(hits):
+      if not is_emtf_legit_hit_phi(hit):
+        continue
+
+      if derived_hits is not None:
+        (endsec, lay, old_emtf_phi, old_emtf_bend, emtf_phi, emtf_theta, zones) = [column[ihit] for column in columns]
+        if lay == -99:
+          invalid_hits.append(hit)
+          continue
+        hit.endsec = endsec
+        hit.lay = lay
+        hit.old_emtf_phi = old_emtf_phi
+        hit.old_emtf_bend = old_emtf_bend
+        hit.emtf_phi = emtf_phi
+        hit.emtf_theta = emtf_theta
+        hit.zones = derived_zones_lut[zones]
+      else:
+        hit.endsec = find_endsec(hit.endcap, hit.sector)
+        hit.lay = find_emtf_layer(hit)
+        if hit.lay == -99:
+          invalid_hits.append(hit)
+          continue
+
+        # Save the old phi & bend values
+        hit.old_emtf_phi = find_emtf_old_phi(hit)
+        hit.old_emtf_bend = find_emtf_old_bend(hit)
+
+        hit.emtf_phi = find_emtf_phi(hit)
+        hit.emtf_theta = find_emtf_theta(hit)
+        hit.zones = find_emtf_zones(hit)
+      sector_hits_array[hit.endsec].append(hit)
+
+    # Loop over sector processors
+    prepared_sectors = []
+    for endcap in (-1, +1):
+      for sector in (1, 2, 3, 4, 5, 6):
+        endsec = find_endsec(endcap, sector)
+        sector_hits = sector_hits_array[endsec]
+        if len(sector_hits) == 0:
+          continue
+
+        # Station bits for the sector mode (check CSC, ME0, DT)
+        hits_type = np.array([hit.type for hit in sector_hits], dtype=np.int32)
+        hits_station = np.array([hit.station for hit in sector_hits], dtype=np.int32)
+        hits_bx = np.array([hit.bx for hit in sector_hits], dtype=np.int32)
+        sector_mode_bits = np.where(hits_type == kCSC, 1 << (4 - hits_station),
+                                    np.where((hits_type == kME0) | (hits_type == kDT), 1 << (4 - 1), 0))
+
+        # Remove all non-Run 2 hits (after the sector mode, as in run())
+        if self.run2_input:
+          hits_valid = np.array([is_valid_for_run2(hit) for hit in sector_hits], dtype=np.bool)
+        else:
+          hits_valid = np.ones(len(sector_hits), dtype=np.bool)
+
+        sector_hit_array = self._make_sector_hit_array(sector_hits)
+        matches = self._find_pattern_matches(sector_hit_array)
+        prepared_sectors.append((endcap, sector, sector_hits, hits_type, hits_bx, sector_mode_bits, hits_valid, matches))
+    invalid_hits_type = np.array([hit.type for hit in invalid_hits], dtype=np.int32)
+    invalid_hits_bx = np.array([hit.bx for hit in invalid_hits], dtype=np.int32)
+    return (prepared_sectors, invalid_hits_type, invalid_hits_bx)
+
+  def run_prepared(self, prepared, bx_shift=0):
+    # Same as run(), but takes the output of prepare(), with the BX of all the
+    # hits shifted by bx_shift. Only the BX-dependent parts are redone: the legit
+    # hit check, the sector mode, the road occupancy and the road modes.
+    roads = []
+
+    (prepared_sectors, invalid_hits_type, invalid_hits_bx) = prepared
+    assert(not np.any(is_emtf_legit_hit_bx_array(invalid_hits_type, invalid_hits_bx + bx_shift)))
+
+    # Loop over sector processors
+    for (endcap, sector, sector_hits, hits_type, hits_bx, sector_mode_bits, hits_valid, matches) in prepared_sectors:
+      hits_bx = hits_bx + bx_shift
+      hits_legit = is_emtf_legit_hit_bx_array(hits_type, hits_bx)
+      sector_mode = int(np.bitwise_or.reduce(sector_mode_bits[hits_legit]))
+
+      # Provide early exit if no hit in stations 1&2 (check CSC, ME0, DT)
+      if not is_emtf_singlehit(sector_mode) and not is_emtf_singlehit_me2(sector_mode):
+        continue
+
+      # Keep only the matches with legit hits
+      (ipt, ieta, iphi, hit_index) = matches
+      selected = (hits_legit & hits_valid)[hit_index]
+      matches = (ipt[selected], ieta[selected], iphi[selected], hit_index[selected])
+
+      # Apply patterns to the sector hits
+      sector_hit_occupancy = self._find_sector_hit_occupancy(sector_hits, hits_bx)
+      sector_roads = self._make_roads_from_matches(endcap, sector, sector_hits, sector_hit_occupancy, matches, hits_bx=hits_bx)
+      sector_roads.sort(key=lambda x: x.id)
+      roads += sector_roads
+    return roads
+
+def get_road_signature(road):
+  # Returns the road id, hits, mode, quality and sort code, to compare the roads
+  hits = tuple((hit.id, hit.emtf_layer, hit.emtf_phi, hit.emtf_theta, hit.emtf_bend, hit.emtf_qual,
+                hit.emtf_time, hit.old_emtf_phi, hit.old_emtf_bend, hit.sim_tp) for hit in road.hits)
+  return (road.id, hits, road.mode, road.quality, road.sort_code)
+
+def check_pattern_recognition_batch_mode(recog, recog_batch, hits):
+  # Compares the roads of the batch mode of PatternRecognition against the
+  # dict-based loop on the columnar hits of an event. Each mode gets its own
+  # copy of the hits, as run() sets the converted values on them. Returns True
+  # if the roads are identical.
+  roads = recog.run(make_columnar_records(hits))
+  roads_batch = recog_batch.run(make_columnar_records(hits))
+  return [get_road_signature(road) for road in roads] == [get_road_signature(road) for road in roads_batch]
+
 
 # Road cleaning module
 # - reject ghost roads and out-of-time roads
@@ -1238,40 +1996,39 @@ class RoadCleaning(object):
     tmp_clean_roads_groupinfo = [tmp_clean_roads_groupinfo[i] for i in ind]
 
     # Loop over the sorted roads, kill the siblings
+    # - a road is killed if it intersects with any of the previous roads (kept
+    #   or not), so keep track of everything that has been claimed so far:
+    #   the occupied iphi's of each endsec (sorted), and the ME1/1, ME1/2, ME0,
+    #   MB1, MB2 hits as (endsec*100 + emtf_layer, emtf_phi)
     clean_roads = []
+    claimed_iphis = {}
+    claimed_hits = set()
 
     for i in xrange(len(tmp_clean_roads)):
       keep = True
 
       # Check for intersection in the iphi range
-      for j in xrange(i):
-        road_i = tmp_clean_roads[i]
-        road_j = tmp_clean_roads[j]
-        group_i = tmp_clean_roads_groupinfo[i]
-        group_j = tmp_clean_roads_groupinfo[j]
-        # No intersect between two ranges (x1, x2), (y1, y2): (x2 < y1) || (x1 > y2)
-        # Intersect: !((x2 < y1) || (x1 > y2)) = (x2 >= y1) and (x1 <= y2)
-        # Allow +/-2 due to extrapolation-to-EMTF error
-        _get_endsec = lambda x: x[:2]
-        if (_get_endsec(road_i.id) == _get_endsec(road_j.id)) and (group_i[1]+2 >= group_j[0]) and (group_i[0]-2 <= group_j[1]):
-          keep = False
-          break
+      # Allow +/-2 due to extrapolation-to-EMTF error
+      road_i = tmp_clean_roads[i]
+      group_i = tmp_clean_roads_groupinfo[i]
+      endsec_i = road_i.id[:2]
+      iphis = claimed_iphis.setdefault(endsec_i, [])
+      j = bisect.bisect_left(iphis, group_i[0]-2)
+      if j < len(iphis) and iphis[j] <= group_i[1]+2:
+        keep = False
 
       # Do not share ME1/1, ME1/2, ME0, MB1, MB2
+      hits_i = [(hit.endsec*100 + hit.emtf_layer, hit.emtf_phi) for hit in road_i.hits if hit.emtf_layer in (0,1,11,12,13)]
       if keep:
-        road_i = tmp_clean_roads[i]
-        hits_i = [(hit.endsec*100 + hit.emtf_layer, hit.emtf_phi) for hit in road_i.hits if hit.emtf_layer in (0,1,11,12,13)]
-
-        for j in xrange(i):
-          road_j = tmp_clean_roads[j]
-          hits_j = [(hit.endsec*100 + hit.emtf_layer, hit.emtf_phi) for hit in road_j.hits if hit.emtf_layer in (0,1,11,12,13)]
-          if set(hits_i).intersection(hits_j):  # has sharing
-            keep = False
-            break
+        if not claimed_hits.isdisjoint(hits_i):  # has sharing
+          keep = False
+
+      for iphi in xrange(group_i[0], group_i[1]+1):
+        bisect.insort(iphis, iphi)
+      claimed_hits.update(hits_i)
 
       # Finally, check consistency with BX=0
       if keep:
-        road_i = tmp_clean_roads[i]
         if self.select_bx_zero(road_i):
           clean_roads.append(road_i)
     return clean_roads
@@ -1282,58 +2039,63 @@ class RoadSlimming(object):
   def __init__(self, bank):
     self.bank = bank
 
-  def run(self, roads):
-    def pick_the_median(lst):
-      middle = 0 if len(lst) == 0 else (len(lst)-1)//2
-      return lst[middle]
+    # Phi offset terms with (ipt, ieta, lay)
+    self.patterns_xc = find_pattern_x_inverse(self.bank.x_array[..., 1])
 
+  def run(self, roads):
     slim_roads = []
-
-    # Loop over roads
-    for road in roads:
-      ipt, ieta, iphi = road.id[2:]
-
-      # Retrieve the phi offset terms for each emtf_layer
-      patterns_xc = self.bank.x_array[ipt, ieta, :, 1]
-      patterns_xc = find_pattern_x_inverse(patterns_xc)
-
-      # Find median phi and theta
-      road_phi_median = np.sort(np.array([hit.emtf_phi - patterns_xc[hit.emtf_layer] for hit in road.hits]))
-      road_phi_median = pick_the_median(road_phi_median)
-
-      road_theta_median = np.sort(np.array([hit.emtf_theta for hit in road.hits]))
-      road_theta_median = pick_the_median(road_theta_median)
-
-      # Loop over all the emtf_layer's, select unique hit for each emtf_layer
-      slim_road_hits = []
-
-      for hit_lay in xrange(nlayers):
-        sort_criteria = []  # for sorting hits
-
-        for ihit, hit in enumerate(road.hits):
-          if hit_lay == hit.emtf_layer:
-            dphi = np.abs(hit.emtf_phi - (road_phi_median + patterns_xc[hit.emtf_layer]))
-            dtheta = np.abs(hit.emtf_theta - road_theta_median)
-            neg_qual = -np.abs(hit.emtf_qual)
-            sort_criteria.append((ihit, dphi, dtheta, neg_qual))
-
-        # Find the best hit, which is (max qual, min dtheta, min dphi, min ihit)
-        if sort_criteria:
-          best_ihit = min(sort_criteria, key=lambda x: (x[3], x[2], x[1], x[0]))[0]
-          best_hit = road.hits[best_ihit]
-          slim_road_hits.append(best_hit)
-
-      slim_road = Road(road.id, slim_road_hits, road.mode, road.quality, road.sort_code, road_phi_median, road_theta_median)
+    if len(roads) == 0:
+      return slim_roads
+
+    # Pack the hits of all the roads into flat arrays
+    road_hits = [hit for road in roads for hit in road.hits]
+    road_sizes = np.array([len(road.hits) for road in roads], dtype=np.int64)
+    row_splits = np.append(0, np.cumsum(road_sizes))
+    road_idx = np.repeat(np.arange(len(roads)), road_sizes)
+    ihit = np.arange(len(road_hits))
+
+    hit_lay = np.array([hit.emtf_layer for hit in road_hits], dtype=np.int32)
+    hit_phi = np.array([hit.emtf_phi for hit in road_hits])
+    hit_theta = np.array([hit.emtf_theta for hit in road_hits])
+    hit_qual = np.array([hit.emtf_qual for hit in road_hits])
+
+    # Retrieve the phi offset terms for each emtf_layer
+    road_ipt = np.array([road.id[2] for road in roads], dtype=np.int32)
+    road_ieta = np.array([road.id[3] for road in roads], dtype=np.int32)
+    hit_xc = self.patterns_xc[road_ipt[road_idx], road_ieta[road_idx], hit_lay]
+
+    # Find median phi and theta, i.e. the element at (n-1)//2 after sorting the hits of each road
+    def segmented_median(values):
+      ind = np.lexsort((values, road_idx))
+      return values[ind[row_splits[:-1] + (road_sizes-1)//2]]
+
+    road_phi_median = segmented_median(hit_phi - hit_xc)
+    road_theta_median = segmented_median(hit_theta)
+
+    # Select unique hit for each emtf_layer
+    # Find the best hit, which is (max qual, min dtheta, min dphi, min ihit)
+    dphi = np.abs(hit_phi - (road_phi_median[road_idx] + hit_xc))
+    dtheta = np.abs(hit_theta - road_theta_median[road_idx])
+    neg_qual = -np.abs(hit_qual)
+    ind = np.lexsort((ihit, dphi, dtheta, neg_qual, hit_lay, road_idx))
+    road_lay = road_idx[ind] * nlayers + hit_lay[ind]
+    best = ind[np.append(True, road_lay[1:] != road_lay[:-1])]
+    best_splits = np.searchsorted(road_idx[best], np.arange(len(roads)+1))
+
+    for i, road in enumerate(roads):
+      slim_road_hits = [road_hits[j] for j in best[best_splits[i]:best_splits[i+1]]]
+      slim_road = Road(road.id, slim_road_hits, road.mode, road.quality, road.sort_code, road_phi_median[i], road_theta_median[i])
       slim_roads.append(slim_road)
     return slim_roads
 
 
 # pT assignment module
 class PtAssignment(object):
-  def __init__(self, kerasfile, omtf_input=False, run2_input=False):
+  def __init__(self, kerasfile, omtf_input=False, run2_input=False, backend='keras', foldedfile=None):
     (model_file, model_weights_file, model_run3_file, model_run3_weights_file, model_omtf_file, model_omtf_weights_file) = kerasfile
     self.omtf_input = omtf_input
     self.run2_input = run2_input
+    self.backend = backend
 
     self.reg_pt_scale = 100.
     self.reg_dxy_scale = 0.4
@@ -1347,6 +2109,24 @@ class PtAssignment(object):
     self.create_encoder_run3 = partial(create_encoder_run3, reg_pt_scale=self.reg_pt_scale, reg_dxy_scale=self.reg_dxy_scale)
     self.create_encoder_omtf = partial(create_encoder_omtf, reg_pt_scale=self.reg_pt_scale, reg_dxy_scale=self.reg_dxy_scale)
 
+    if self.backend == 'numpy':
+      # Load the folded models, no need to import TensorFlow
+      (model_folded_file, model_run3_folded_file, model_omtf_folded_file) = foldedfile
+      from nn_inference import load_my_numpy_model
+      self.loaded_model = load_my_numpy_model(name=model_folded_file)
+      self.loaded_model_run3 = load_my_numpy_model(name=model_run3_folded_file)
+      self.loaded_model_omtf = load_my_numpy_model(name=model_omtf_folded_file)
+      return
+
+    if self.backend == 'quantized':
+      # Load the folded models, and emulate the fixed-point arithmetic
+      (model_folded_file, model_run3_folded_file, model_omtf_folded_file) = foldedfile
+      from nn_inference import load_my_quantized_model
+      self.loaded_model = load_my_quantized_model(name=model_folded_file, **quantized_config)
+      self.loaded_model_run3 = load_my_quantized_model(name=model_run3_folded_file, **quantized_config)
+      self.loaded_model_omtf = load_my_quantized_model(name=model_omtf_folded_file, **quantized_config)
+      return
+
     # Load Keras models
     from nn_models import load_my_model, update_keras_custom_objects
     update_keras_custom_objects()
@@ -1381,6 +2161,16 @@ class PtAssignment(object):
     y = np.moveaxis(np.asarray(y),0,-1)  # shape (2, n, 1) -> shape (n, 1, 2)
     return (x_new, y, z, t)
 
+  def print_saturation_counts(self):
+    if self.backend == 'quantized':
+      if self.omtf_input:
+        loaded_model = self.loaded_model_omtf
+      elif self.run2_input:
+        loaded_model = self.loaded_model_run3
+      else:
+        loaded_model = self.loaded_model
+      loaded_model.print_saturation_counts()
+
   def run(self, x):
     x_new = np.array([], dtype=np.float32)
     y = np.array([], dtype=np.float32)
@@ -1392,6 +2182,51 @@ class PtAssignment(object):
     (x_new, y, z, t) = self.predict(x)
     return (x_new, y, z, t)
 
+  def run_many(self, xs):
+    # Same as run(), but takes the road variables of several events, runs the
+    # prediction once on all of them, and returns the results of each event
+    row_splits = np.cumsum([0] + [len(x) for x in xs])
+    if row_splits[-1] == 0:
+      return [self.run(x) for x in xs]
+
+    (x_new, y, z, t) = self.predict(np.concatenate(xs))
+    results = []
+    for i, x in enumerate(xs):
+      if len(x) == 0:
+        results.append(self.run(x))
+      else:
+        (begin, end) = row_splits[i:i+2]
+        results.append((x_new[begin:end], y[begin:end], z[begin:end], t[begin:end]))
+    return results
+
+# Buffered pT assignment
+# - accumulates the road variables across events, so that the prediction runs
+#   on large batches instead of a handful of roads per event
+class PtAssignmentBuffer(object):
+  def __init__(self, ptassig, max_events=200, max_roads=4000):
+    self.ptassig = ptassig
+    self.max_events = max_events
+    self.max_roads = max_roads
+    self.buffered_x = []
+    self.nroads = 0
+
+  def __len__(self):
+    return len(self.buffered_x)
+
+  def append(self, x):
+    self.buffered_x.append(x)
+    self.nroads += len(x)
+
+  def is_full(self):
+    return len(self.buffered_x) >= self.max_events or self.nroads >= self.max_roads
+
+  def flush(self):
+    # Returns the results of each buffered event, in the order they were appended
+    results = self.ptassig.run_many(self.buffered_x)
+    self.buffered_x = []
+    self.nroads = 0
+    return results
+
 
 # Track producer module
 class TrackProducer(object):
@@ -1427,16 +2262,14 @@ class TrackProducer(object):
     self.s_lut = np.asarray(self.s_lut)
 
   def get_trigger_pt(self, y_pred):
+    # Works on arrays
     xml_pt = np.abs(1.0/y_pred)
-    if xml_pt <= 2.:  # do not use the LUT if below 2 GeV
-      return xml_pt
 
     def digitize(x, bins=(self.s_nbins, self.s_min, self.s_max)):
       x = np.clip(x, bins[1], bins[2]-1e-5)
       x = (x - bins[1]) / (bins[2] - bins[1]) * bins[0]
       binx = x.astype(np.int32)
-      if binx == bins[0]-1:  # avoid boundary
-        binx -= 1
+      binx = np.where(binx == bins[0]-1, binx-1, binx)  # avoid boundary
       return binx
 
     def interpolate(x, x0, x1, y0, y1):
@@ -1447,47 +2280,36 @@ class TrackProducer(object):
     x0, x1 = binx * self.s_step, (binx+1) * self.s_step
     y0, y1 = self.s_lut[binx], self.s_lut[binx+1]
     trg_pt = interpolate(xml_pt, x0, x1, y0, y1)
-    assert(trg_pt > 2.)
+    use_lut = (xml_pt > 2.)  # do not use the LUT if below 2 GeV
+    assert(np.all(trg_pt[use_lut] > 2.))
+    trg_pt = np.where(use_lut, trg_pt, xml_pt)
     return trg_pt
 
   def pass_trigger(self, ndof, mode, strg, zone, theta_median, y_pred, y_discr):
+    # Works on arrays
     ipt1 = strg.astype(np.int32)
-    ipt2 = find_pt_bin(y_pred)
+    ipt2 = np.clip(np.digitize(y_pred, pt_bins[1:]), 0, len(pt_bins)-2)  # same as find_pt_bin()
     quality1 = find_emtf_road_quality(ipt1)
     quality2 = find_emtf_road_quality(ipt2)
     strg_ok = (quality2 <= (quality1+1))
 
     xml_pt = np.abs(1.0/y_pred)
 
-    # Apply cuts
-    trigger = (y_discr < 0.)  # default: False
+    # Discriminator cuts for >14 GeV, 8-14 GeV, 4-8 GeV
     if self.omtf_input:
-      if xml_pt > self.discr_pt_cut_high:  # >14 GeV (98.0% coverage)
-        trigger = (y_discr > 0.6043)
-      elif xml_pt > self.discr_pt_cut_med: # 8-14 GeV (98.0% coverage)
-        trigger = (y_discr > 0.2905)
-      elif xml_pt > self.discr_pt_cut_low: # 4-8 GeV (98.0% coverage)
-        trigger = (y_discr > 0.2000)
-      else:
-        trigger = (y_discr >= 0.) and strg_ok
+      discr_cuts = (0.6043, 0.2905, 0.2000)  # 98.0%, 98.0%, 98.0% coverage
     elif self.run2_input:
-      if xml_pt > self.discr_pt_cut_high:  # >14 GeV (97.0% coverage)
-        trigger = (y_discr > 0.8557)
-      elif xml_pt > self.discr_pt_cut_med: # 8-14 GeV (97.0% coverage)
-        trigger = (y_discr > 0.6640)
-      elif xml_pt > self.discr_pt_cut_low: # 4-8 GeV (97.0% coverage)
-        trigger = (y_discr > 0.2000)
-      else:
-        trigger = (y_discr >= 0.) and strg_ok
+      discr_cuts = (0.8557, 0.6640, 0.2000)  # 97.0%, 97.0%, 97.0% coverage
     else:
-      if xml_pt > self.discr_pt_cut_high:  # >14 GeV (98.5% coverage)
-        trigger = (y_discr > 0.9600)
-      elif xml_pt > self.discr_pt_cut_med: # 8-14 GeV (98.5% coverage)
-        trigger = (y_discr > 0.8932)
-      elif xml_pt > self.discr_pt_cut_low: # 4-8 GeV (99.0% coverage)
-        trigger = (y_discr > 0.2000)
-      else:
-        trigger = (y_discr >= 0.) and strg_ok
+      discr_cuts = (0.9600, 0.8932, 0.2000)  # 98.5%, 98.5%, 99.0% coverage
+
+    # Apply cuts
+    # Below 4 GeV, only require the discriminator to be valid and the pT to be
+    # consistent with the road pattern straightness
+    trigger = np.select(
+        [xml_pt > self.discr_pt_cut_high, xml_pt > self.discr_pt_cut_med, xml_pt > self.discr_pt_cut_low],
+        [y_discr > discr_cuts[0], y_discr > discr_cuts[1], y_discr > discr_cuts[2]],
+        default=((y_discr >= 0.) & strg_ok))
     return trigger
 
   def run(self, slim_roads, variables, predictions, x_mask_vars, x_road_vars):
@@ -1496,24 +2318,20 @@ class TrackProducer(object):
     # Extra pieces
 
     def get_ndof_from_x_mask(x_mask):
-      assert(x_mask.shape[0] == nlayers)
+      assert(x_mask.shape[1:] == (nlayers,))
       assert(x_mask.dtype == np.bool)
       valid = ~x_mask
-      return valid.sum()
+      return valid.sum(axis=-1)
 
     def get_mode_from_x_mask(x_mask):
-      assert(x_mask.shape[0] == nlayers)
+      assert(x_mask.shape[1:] == (nlayers,))
       assert(x_mask.dtype == np.bool)
       valid = ~x_mask
-      mode = np.int32(0)
-      if np.any((valid[0], valid[1], valid[5], valid[9], valid[11])):   # ME1/1, ME1/2, RE1/2, GE1/1, ME0
-        mode |= (1<<3)
-      if np.any((valid[2], valid[6], valid[10])):  # ME2, RE2, GE2/1
-        mode |= (1<<2)
-      if np.any((valid[3], valid[7])):  # ME3, RE3
-        mode |= (1<<1)
-      if np.any((valid[4], valid[8])):  # ME4, RE4
-        mode |= (1<<0)
+      mode = np.zeros(x_mask.shape[0], dtype=np.int32)
+      mode |= np.where(valid[:, (0,1,5,9,11)].any(axis=-1), (1<<3), 0).astype(np.int32)  # ME1/1, ME1/2, RE1/2, GE1/1, ME0
+      mode |= np.where(valid[:, (2,6,10)].any(axis=-1), (1<<2), 0).astype(np.int32)  # ME2, RE2, GE2/1
+      mode |= np.where(valid[:, (3,7)].any(axis=-1), (1<<1), 0).astype(np.int32)  # ME3, RE3
+      mode |= np.where(valid[:, (4,8)].any(axis=-1), (1<<0), 0).astype(np.int32)  # ME4, RE4
       return mode
 
     # __________________________________________________________________________
@@ -1523,28 +2341,31 @@ class TrackProducer(object):
     assert(len(slim_roads) == len(x_road_vars))
 
     tracks = []
+    if len(slim_roads) == 0:
+      return tracks
 
-    for myroad, x, y, x_mask, x_road in zip(slim_roads, variables, predictions, x_mask_vars, x_road_vars):
-      assert(len(x.shape) == 1)
-      assert(y.shape == (1,2))
-      assert(x_mask.shape == (nlayers,))
-      assert(x_road.shape == (4,))
+    # All the roads are processed at once, only the passing ones become tracks
+    assert(len(variables.shape) == 2)
+    assert(predictions.shape[1:] == (1,2))
+    assert(x_road_vars.shape[1:] == (4,))
 
-      y_pred = np.asscalar(y[...,0])
-      y_discr = np.asscalar(y[...,1])
-      ndof = get_ndof_from_x_mask(x_mask)
-      mode = get_mode_from_x_mask(x_mask)
-      strg, zone, phi_median, theta_median = x_road
+    y_pred = predictions[:, 0, 0].astype(np.float64)
+    y_discr = predictions[:, 0, 1].astype(np.float64)
+    ndof = get_ndof_from_x_mask(x_mask_vars)
+    mode = get_mode_from_x_mask(x_mask_vars)
+    strg, zone, phi_median, theta_median = x_road_vars.T
 
-      passed = self.pass_trigger(ndof, mode, strg, zone, theta_median, y_pred, y_discr)
+    passed = self.pass_trigger(ndof, mode, strg, zone, theta_median, y_pred, y_discr)
 
-      if passed:
-        xml_pt = np.abs(1.0/y_pred)
-        pt = self.get_trigger_pt(y_pred)
+    passed = np.flatnonzero(passed)
+    xml_pt = np.abs(1.0/y_pred[passed])
+    pt = self.get_trigger_pt(y_pred[passed])
+    trk_q = np.sign(y_pred[passed]).astype(np.int32)
 
-        trk_q = np.sign(y_pred).astype(np.int32)
-        trk = Track(myroad.id, myroad.hits, mode, myroad.quality, zone, xml_pt, pt, trk_q, y_pred, y_discr, phi_median, theta_median)
-        tracks.append(trk)
+    for j, i in enumerate(passed):
+      myroad = slim_roads[i]
+      trk = Track(myroad.id, myroad.hits, mode[i], myroad.quality, zone[i], xml_pt[j], pt[j], trk_q[j], float(y_pred[i]), float(y_discr[i]), phi_median[i], theta_median[i])
+      tracks.append(trk)
     return tracks
 
 
@@ -1579,28 +2400,29 @@ class GhostBusting(object):
       return find_endsec(trk.id[0], trk.id[1])
 
     # Loop over the sorted tracks and remove duplicates (ghosts)
+    # - a track is removed if it shares a hit with any of the previous tracks
+    #   (kept or not), so keep all the hits that have been claimed so far
+    claimed_hits = set()
+
     for i in xrange(len(tracks)):
       keep = True
 
       # Do not share ME1/1, ME1/2, ME0, MB1, MB2
       # Need to check for neighbor sector hits
-      if keep:
-        track_i = tracks[i]
-        hits_i = [(get_gb_endsec(hit)*100 + hit.emtf_layer, get_gb_emtf_phi(hit)) for hit in track_i.hits if hit.emtf_layer in (0,1,11,12,13)]
-
-        for j in xrange(i):
-          track_j = tracks[j]
-          hits_j = [(get_gb_endsec(hit)*100 + hit.emtf_layer, get_gb_emtf_phi(hit)) for hit in track_j.hits if hit.emtf_layer in (0,1,11,12,13)]
-          if set(hits_i).intersection(hits_j):  # has sharing
-            keep = False
-            break
+      track_i = tracks[i]
+      hits_i = [(get_gb_endsec(hit)*100 + hit.emtf_layer, get_gb_emtf_phi(hit)) for hit in track_i.hits if hit.emtf_layer in (0,1,11,12,13)]
+      if not claimed_hits.isdisjoint(hits_i):  # has sharing
+        keep = False
+      claimed_hits.update(hits_i)
 
       if keep:
-        track_i = tracks[i]
+        tracks_after_gb.append(track_i)
 
-        # Output tracks following the order of sector processors
-        ind = np.searchsorted([get_gb_track_endsec(x) for x in tracks_after_gb], get_gb_track_endsec(track_i))
-        tracks_after_gb.insert(ind, track_i)
+    # Output tracks following the order of sector processors
+    # Within the same sector, the later tracks come first (as if each track is
+    # inserted at the leftmost position of its sector), hence the reverse
+    tracks_after_gb.reverse()
+    tracks_after_gb.sort(key=get_gb_track_endsec)  # stable sort
     return tracks_after_gb
 
 
@@ -1663,118 +2485,373 @@ class TrackMuonCorrelation(object):
   def run(self, particles, tracks):
     matched = np.zeros((len(particles), len(tracks)), dtype=np.bool)
 
+    # All the particles and tracks are processed at once. The window bounds are
+    # computed for each particle, and the matching for each (particle, track) pair.
     def sf_progressive(x, xstart, xstop, ystart, ystop):
-      if (x < xstart):
-        return ystart
-      elif (x >= xstop):
-        return ystop
-      else:
-        return ystart + (x-xstart)*(ystop-ystart)/(xstop-xstart)
+      y = ystart + (x-xstart)*(ystop-ystart)/(xstop-xstart)
+      y = np.where(x < xstart, ystart, np.where(x >= xstop, ystop, y))
+      return y
 
     def get_ibin(eta):
-      ieta = np.digitize((abs(eta),), self.bounds[1:])[0]  # skip lowest edge
-      if ieta > self.nbins-1:
-        ieta = self.nbins-1
+      ieta = np.digitize(np.abs(eta), self.bounds[1:])  # skip lowest edge
+      ieta = np.minimum(ieta, self.nbins-1)
       return ieta
 
-    def get_theta_bound_low(part_eta, part_pt):
-      # [Const]+[A]*TMath::Power(x,[B])
-      f = lambda x, a, b, c: a + b * np.power(np.clip(x, 2., 100.), c)
-      a, b, c = self.wdws_theta_low[get_ibin(part_eta)]
-      return f(part_pt, a, b, c)
-
-    def get_theta_bound_high(part_eta, part_pt):
+    def get_bound(wdws, part_eta, part_pt):
       # [Const]+[A]*TMath::Power(x,[B])
       f = lambda x, a, b, c: a + b * np.power(np.clip(x, 2., 100.), c)
-      a, b, c = self.wdws_theta_high[get_ibin(part_eta)]
+      a, b, c = wdws[get_ibin(part_eta)].T
       return f(part_pt, a, b, c)
 
-    def get_phi_bound_low(part_eta, part_pt):
-      # [Const]+[A]*TMath::Power(x,[B])
-      f = lambda x, a, b, c: a + b * np.power(np.clip(x, 2., 100.), c)
-      a, b, c = self.wdws_phi_low[get_ibin(part_eta)]
-      return f(part_pt, a, b, c)
-
-    def get_phi_bound_high(part_eta, part_pt):
-      # [Const]+[A]*TMath::Power(x,[B])
-      f = lambda x, a, b, c: a + b * np.power(np.clip(x, 2., 100.), c)
-      a, b, c = self.wdws_phi_high[get_ibin(part_eta)]
-      return f(part_pt, a, b, c)
-
-    # Loop over tracking particles
+    def get_delta_phi(lhs, rhs):  # same as delta_phi(), in radians
+      rad = lhs - rhs
+      while np.any(rad < -np.pi):
+        rad = np.where(rad < -np.pi, rad + np.pi*2, rad)
+      while np.any(rad >= +np.pi):
+        rad = np.where(rad >= +np.pi, rad - np.pi*2, rad)
+      return rad
+
+    if len(particles) == 0:
+      return matched
+
+    # Tracking particles
+    part_pt = np.array([part.pt for part in particles])
+    part_eta = np.array([part.eta for part in particles])
+    part_phi = np.array([part.phi for part in particles])
+    part_theta = np.array([part.theta for part in particles])
+    part_q = np.array([part.q for part in particles])
+    part_vx = np.array([part.vx for part in particles])
+    part_vy = np.array([part.vy for part in particles])
+    part_vz = np.array([part.vz for part in particles])
+    part_bx = np.array([part.bx for part in particles])
+    part_invpt = np.true_divide(part_q, part_pt)
+    part_d0 = calculate_d0(part_invpt, part_phi, part_vx, part_vy)
     for ipart, part in enumerate(particles):
-      part.invpt = np.true_divide(part.q, part.pt)
-      part.d0 = calculate_d0(part.invpt, part.phi, part.vx, part.vy)
+      part.invpt = part_invpt[ipart]
+      part.d0 = part_d0[ipart]
+
+    if len(tracks) == 0:
+      return matched
+
+    # Skip particles that are not (BX=0, |eta|>1, |d0|<10 cm, |z0|<100 cm)
+    sel = (part_bx == 0) & (np.abs(part_eta) > 1.) & (np.abs(part_d0) < 10.) & (np.abs(part_vz) < 100.)
+    sel = np.flatnonzero(sel)
+    if len(sel) == 0:
+      return matched
+    (part_pt, part_eta, part_phi, part_theta, part_q) = (part_pt[sel], part_eta[sel], part_phi[sel], part_theta[sel], part_q[sel])
+
+    # Get boundaries
+    if self.do_relax_factor:
+      sf_l = sf_progressive(part_pt, self.pt_start, self.pt_end, self.initial_sf_l, self.safety_factor_l)
+      sf_h = sf_progressive(part_pt, self.pt_start, self.pt_end, self.initial_sf_h, self.safety_factor_h)
+    else:
+      sf_l = self.safety_factor_l
+      sf_h = self.safety_factor_h
+
+    theta_bound_low = (1 - sf_l) * get_bound(self.wdws_theta_low, part_eta, part_pt)
+    theta_bound_high = (1 + sf_h) * get_bound(self.wdws_theta_high, part_eta, part_pt)
+    phi_bound_low = (1 - sf_l) * get_bound(self.wdws_phi_low, part_eta, part_pt)
+    phi_bound_high = (1 + sf_h) * get_bound(self.wdws_phi_high, part_eta, part_pt)
+
+    # Luca uses 0.004 rad in phi & theta
+    theta_bound_low = np.where(theta_bound_low < 0.004, -1., theta_bound_low)  # disable check
+    phi_bound_low = np.where(phi_bound_low < 0.004, -1., phi_bound_low)  # disable check
+    assert(np.all(theta_bound_high > 0.004) and np.all(phi_bound_high > 0.004))
+    assert(np.all(theta_bound_low < theta_bound_high) and np.all(phi_bound_low < phi_bound_high))
+
+    # Standalone muons
+    trk_eta = np.array([trk.eta for trk in tracks])
+    trk_phi = np.array([trk.phi for trk in tracks])
+    emtf_theta_glob = calc_theta_rad_from_eta(trk_eta)  # in radians
+    emtf_phi_glob = np.deg2rad(trk_phi)  # in radians
+
+    # Calculate deltas, with shape (n_particles, n_tracks)
+    dtheta = np.abs(delta_theta(emtf_theta_glob[np.newaxis, :], part_theta[:, np.newaxis]))
+    tmp_dphi = get_delta_phi(emtf_phi_glob[np.newaxis, :], part_phi[:, np.newaxis])
+    dphi = np.abs(tmp_dphi)
+    dphi_sign = np.where(tmp_dphi < 0, -1, +1)
+    dphi_sign = np.where((part_pt > 100.)[:, np.newaxis], -part_q[:, np.newaxis], dphi_sign)  # disable check
+
+    matched[sel] = (
+        (theta_bound_low[:, np.newaxis] < dtheta) & (dtheta <= theta_bound_high[:, np.newaxis]) & \
+        (phi_bound_low[:, np.newaxis] < dphi) & (dphi <= phi_bound_high[:, np.newaxis]) & \
+        ((dphi_sign * part_q[:, np.newaxis]) < 0) & \
+        ((trk_eta[np.newaxis, :] * part_eta[:, np.newaxis]) > 0)
+    )
 
-      # Skip particles that are not (BX=0, |eta|>1, |d0|<10 cm, |z0|<100 cm)
-      if not ((part.bx == 0) and (np.abs(part.eta) > 1.) and (np.abs(part.d0) < 10.) and (np.abs(part.vz) < 100.)):
-        continue
+    # Make sure the matching is unique
+    # First, keep only the first track match of each particle
+    has_match = matched.any(axis=1)
+    first_itrk = np.argmax(matched, axis=1)
+    matched[:] = False
+    matched[has_match, first_itrk[has_match]] = True
+
+    # Then, keep only the highest-pT particle match of each track (the first one if tied)
+    all_part_pt = np.array([part.pt for part in particles])
+    has_match = matched.any(axis=0)
+    highest_pt_ipart = np.argmax(np.where(matched, all_part_pt[:, np.newaxis], -np.inf), axis=0)
+    matched[:, has_match] = False
+    matched[highest_pt_ipart[has_match], has_match] = True
+    return matched
 
-      # Get boundaries
-      if self.do_relax_factor:
-        sf_l = sf_progressive(part.pt, self.pt_start, self.pt_end, self.initial_sf_l, self.safety_factor_l)
-        sf_h = sf_progressive(part.pt, self.pt_start, self.pt_end, self.initial_sf_h, self.safety_factor_h)
-      else:
-        sf_l = self.safety_factor_l
-        sf_h = self.safety_factor_h
-
-      theta_bound_low = (1 - sf_l) * get_theta_bound_low(part.eta, part.pt)
-      theta_bound_high = (1 + sf_h) * get_theta_bound_high(part.eta, part.pt)
-      phi_bound_low = (1 - sf_l) * get_phi_bound_low(part.eta, part.pt)
-      phi_bound_high = (1 + sf_h) * get_phi_bound_high(part.eta, part.pt)
-
-      # Luca uses 0.004 rad in phi & theta
-      if theta_bound_low < 0.004:
-        theta_bound_low = -1.  # disable check
-      if phi_bound_low < 0.004:
-        phi_bound_low = -1.  # disable check
-      assert(theta_bound_high > 0.004 and phi_bound_high > 0.004)
-      assert(theta_bound_low < theta_bound_high and phi_bound_low < phi_bound_high)
-
-      # Loop over standalone muons
-      for itrk, trk in enumerate(tracks):
-        emtf_theta_glob = calc_theta_rad_from_eta(trk.eta)  # in radians
-        emtf_phi_glob = np.deg2rad(trk.phi)  # in radians
-
-        # Calculate deltas
-        dtheta = np.abs(delta_theta(emtf_theta_glob, part.theta))
-        tmp_dphi = delta_phi(emtf_phi_glob, part.phi)
-        dphi = np.abs(tmp_dphi)
-        dphi_sign = -1 if tmp_dphi < 0 else +1
-        if part.pt > 100.:
-          dphi_sign = -part.q  # disable check
-
-        matched[ipart, itrk] = (
-            (theta_bound_low < dtheta <= theta_bound_high) and \
-            (phi_bound_low < dphi <= phi_bound_high) and \
-            ((dphi_sign * part.q) < 0) and \
-            ((trk.eta * part.eta) > 0)
-        )
 
-    # Make sure the matching is unique
-    for ipart in xrange(matched.shape[0]):
-      if matched[ipart, :].any():
-        # find the first track match set to True, then set all the following track matches to False
-        for itrk in xrange(matched.shape[1]):
-          if matched[ipart, itrk]:
-            matched[ipart, itrk+1:] = False
-            break
+# ______________________________________________________________________________
+# Histogram bank
+# - keeps the bin contents of many histograms in numpy arrays, which are
+#   addressed by integer handles. The fills are buffered and binned in bulk
+#   with np.bincount when the buffer is full, or when the contents are needed.
+# - the binning follows TAxis::FindFixBin(), including the underflow and
+#   overflow bins. The sum of squares of weights is always kept, the errors
+#   are only set on the ROOT histograms that are booked with sumw2=True or
+#   filled with weights (as in TH1::Fill).
+# - the histograms are only converted to rootpy objects when written out
+
+class HistogramBank(object):
+  def __init__(self, buffer_size=1<<16):
+    self.buffer_size = buffer_size
+    self.nbuffered = 0
+    self.hnames = []
+    self.handles = {}    # hname -> handle
+    self.specs = []      # (args, title, type, sumw2) as used to book the rootpy histogram
+    self.axes = []       # (nbins, low, high, edges) of each axis
+    self.sumw = []       # sum of weights, with shape (nbinsx+2, [nbinsy+2])
+    self.sumw2 = []      # sum of squares of weights
+    self.entries = []
+    self.stats = []      # (sumw, sumw2, sumwx, sumwx2, [sumwy, sumwy2, sumwxy]) of the in-range fills
+    self.weighted = []   # filled with weights
+    self.buffers = []
+    self.checkpoint_slot = 0
+
+  def __getitem__(self, hname):
+    return self.handles[hname]
+
+  def __len__(self):
+    return len(self.hnames)
+
+  @staticmethod
+  def _parse_axes(args):
+    # Takes the binning args of Hist or Hist2D, either (nbins, low, high) or (edges,) for each axis
+    axes = []
+    args = list(args)
+    while args:
+      if np.ndim(args[0]) == 1:
+        edges = np.asarray(args.pop(0), dtype=np.float64)
+        axes.append((len(edges)-1, edges[0], edges[-1], edges))
+      else:
+        (nbins, low, high) = args[:3]
+        del args[:3]
+        axes.append((int(nbins), float(low), float(high), None))
+    return axes
+
+  def book(self, hname, *args, **kwargs):
+    # Books a 1D histogram with Hist(nbins, low, high) or Hist(edges), or a 2D
+    # histogram with Hist2D(nbinsx, lowx, highx, nbinsy, lowy, highy). Returns the handle.
+    if hname in self.handles:
+      raise RuntimeError('Histogram is already booked: {0}'.format(hname))
+    title = kwargs.pop('title', '')
+    _type = kwargs.pop('type', 'F')
+    sumw2 = kwargs.pop('sumw2', False)
+    if kwargs:
+      raise RuntimeError('Unexpected arguments: {0}'.format(kwargs.keys()))
+    axes = self._parse_axes(args)
+    if len(axes) not in (1, 2):
+      raise RuntimeError('Cannot book histogram with {0} axes: {1}'.format(len(axes), hname))
+    shape = tuple(nbins+2 for (nbins, low, high, edges) in axes)
+
+    handle = len(self.hnames)
+    self.hnames.append(hname)
+    self.handles[hname] = handle
+    self.specs.append((args, title, _type, sumw2))
+    self.axes.append(axes)
+    self.sumw.append(np.zeros(shape, dtype=np.float64))
+    self.sumw2.append(np.zeros(shape, dtype=np.float64))
+    self.entries.append(0)
+    self.stats.append(np.zeros(4 if len(axes) == 1 else 7, dtype=np.float64))
+    self.weighted.append(False)
+    self.buffers.append([])
+    return handle
+
+  def find_bin(self, handle, x, axis=0):
+    # Same as TAxis::FindFixBin(), but works on arrays
+    (nbins, low, high, edges) = self.axes[handle][axis]
+    x = np.asarray(x, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+      if edges is None:
+        inner = 1 + np.floor(nbins * (x - low) / (high - low))
+      else:
+        inner = np.searchsorted(edges, x, side='right')
+      b = np.where(x < low, 0, np.where(x < high, inner, nbins+1))
+    return b.astype(np.int64)
+
+  def bin_center(self, handle, b, axis=0):
+    (nbins, low, high, edges) = self.axes[handle][axis]
+    b = np.asarray(b)
+    if edges is None:
+      return low + (b - 0.5) * ((high - low) / nbins)
+    else:
+      edges = np.concatenate(([2*edges[0] - edges[1]], edges, [2*edges[-1] - edges[-2]]))
+      return 0.5 * (edges[b] + edges[b+1])
+
+  def fill(self, handle, x, y=None, weights=None):
+    # Takes scalars or arrays. The values are only binned when the buffer is flushed.
+    x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+    if y is not None:
+      y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+    if weights is not None:
+      weights = np.broadcast_to(np.asarray(weights, dtype=np.float64), x.shape)
+    if (y is None) != (len(self.axes[handle]) == 1):
+      raise RuntimeError('Wrong number of values to fill: {0}'.format(self.hnames[handle]))
+    self.buffers[handle].append((x, y, weights))
+    self.nbuffered += len(x)
+    if self.nbuffered >= self.buffer_size:
+      self.flush()
+
+  def fill_bins(self, handle, b, weights=None):
+    # Same as fill(), but takes the bin numbers of a 1D histogram
+    self.fill(handle, self.bin_center(handle, b), weights=weights)
+
+  def _flush_one(self, handle):
+    buf = self.buffers[handle]
+    if not buf:
+      return
+    axes = self.axes[handle]
+    x = np.concatenate([bx for (bx, by, bw) in buf])
+    if len(axes) == 2:
+      y = np.concatenate([by for (bx, by, bw) in buf])
+    if any((bw is not None) for (bx, by, bw) in buf):
+      w = np.concatenate([(bw if bw is not None else np.ones_like(bx)) for (bx, by, bw) in buf])
+      self.weighted[handle] = True
+    else:
+      w = np.ones_like(x)
+    self.buffers[handle] = []
+
+    # Bin the values
+    shape = self.sumw[handle].shape
+    b = self.find_bin(handle, x)
+    in_range = (1 <= b) & (b <= axes[0][0])
+    if len(axes) == 2:
+      by = self.find_bin(handle, y, axis=1)
+      in_range &= (1 <= by) & (by <= axes[1][0])
+      b = np.ravel_multi_index((b, by), shape)
+    self.sumw[handle] += np.bincount(b, weights=w, minlength=np.prod(shape)).reshape(shape)
+    self.sumw2[handle] += np.bincount(b, weights=w*w, minlength=np.prod(shape)).reshape(shape)
+    self.entries[handle] += len(x)
+
+    # Update the stats
+    (x, w) = (x[in_range], w[in_range])
+    stats = [w.sum(), (w*w).sum(), (w*x).sum(), (w*x*x).sum()]
+    if len(axes) == 2:
+      y = y[in_range]
+      stats += [(w*y).sum(), (w*y*y).sum(), (w*x*y).sum()]
+    self.stats[handle] += stats
+
+  def flush(self):
+    for handle in xrange(len(self.hnames)):
+      self._flush_one(handle)
+    self.nbuffered = 0
+
+  def get_contents(self, handle):
+    # Returns the sum of weights, including the underflow and overflow bins
+    self._flush_one(handle)
+    return self.sumw[handle]
+
+  def get_bin_content(self, handle, x):
+    # Same as TH1::GetBinContent(TH1::FindBin(x)) on a 1D histogram
+    return self.get_contents(handle)[self.find_bin(handle, x)]
+
+  def add(self, other):
+    # Adds the contents of another bank with the same histograms
+    if self.hnames != other.hnames:
+      raise RuntimeError('Cannot add histogram banks with different histograms')
+    self.flush()
+    other.flush()
+    for handle in xrange(len(self.hnames)):
+      self.sumw[handle] += other.sumw[handle]
+      self.sumw2[handle] += other.sumw2[handle]
+      self.entries[handle] += other.entries[handle]
+      self.stats[handle] += other.stats[handle]
+      self.weighted[handle] |= other.weighted[handle]
+
+  def to_root(self, handle):
+    self._flush_one(handle)
+    hname = self.hnames[handle]
+    (args, title, _type, sumw2) = self.specs[handle]
+    if len(self.axes[handle]) == 1:
+      h = Hist(*args, name=hname, title=title, type=_type)
+    else:
+      h = Hist2D(*args, name=hname, title=title, type=_type)
+    # The global bin number is binx + (nbinsx+2) * biny
+    contents = self.sumw[handle].T.ravel()
+    for b, v in enumerate(contents.tolist()):
+      h.SetBinContent(b, v)
+    if sumw2 or self.weighted[handle]:
+      h.Sumw2()
+      errors = np.sqrt(self.sumw2[handle].T.ravel())
+      for b, v in enumerate(errors.tolist()):
+        h.SetBinError(b, v)
+    h.PutStats(self.stats[handle].copy())
+    h.SetEntries(self.entries[handle])
+    return h
+
+  def write(self, outfile, hnames=None):
+    # Writes the histograms (all of them, or the given ones in order) into a ROOT file
+    if hnames is None:
+      hnames = self.hnames
+    with root_open(outfile, 'recreate') as f:
+      for hname in hnames:
+        h = self.to_root(self.handles[hname])
+        h.Write()
 
-    for itrk in xrange(matched.shape[1]):
-      if matched[:, itrk].any():
-        # now find the highest-pT track match, then set the other track matches to False
-        highest_pt = -999999.
-        highest_pt_ipart = -999
-        for ipart in xrange(matched.shape[0]):
-          if matched[ipart, itrk]:
-            part = particles[ipart]
-            if highest_pt < part.pt:
-              highest_pt = part.pt
-              highest_pt_ipart = ipart
-        assert(highest_pt_ipart >= 0)
-        matched[:, itrk] = False
-        matched[highest_pt_ipart, itrk] = True
-    return matched
+  def savez(self, outfile):
+    # Saves the bank as a npz file, which can be loaded with HistogramBank.loadz()
+    import json
+    self.flush()
+    meta = [(hname, [(a.tolist() if isinstance(a, np.ndarray) else a) for a in args], title, _type, sumw2, weighted, entries)
+            for (hname, (args, title, _type, sumw2), weighted, entries) in zip(self.hnames, self.specs, self.weighted, self.entries)]
+    arrays = {}
+    for handle in xrange(len(self.hnames)):
+      arrays['sumw_%i' % handle] = self.sumw[handle]
+      arrays['sumw2_%i' % handle] = self.sumw2[handle]
+      arrays['stats_%i' % handle] = self.stats[handle]
+    np.savez_compressed(outfile, meta=np.array(json.dumps(meta)), **arrays)
+
+  def save_checkpoint(self, prefix):
+    # The bank is saved in full, using two files in turn so that the previous
+    # checkpoint stays valid until the new one is complete
+    self.checkpoint_slot = 1 - self.checkpoint_slot
+    outfile = '%s.%i.npz' % (prefix, self.checkpoint_slot)
+    self.savez(outfile)
+    return {'file': os.path.basename(outfile)}
+
+  def load_checkpoint(self, prefix, meta):
+    infile = os.path.join(os.path.dirname(prefix), meta['file'])
+    other = HistogramBank.loadz(infile)
+    if other.hnames != self.hnames:
+      raise RuntimeError('Cannot restore histograms from: {0}'.format(infile))
+    for handle in xrange(len(self.hnames)):
+      self.sumw[handle] = other.sumw[handle]
+      self.sumw2[handle] = other.sumw2[handle]
+      self.stats[handle] = other.stats[handle]
+      self.weighted[handle] = other.weighted[handle]
+      self.entries[handle] = other.entries[handle]
+      del self.buffers[handle][:]
+    self.nbuffered = 0
+    self.checkpoint_slot = int(meta['file'].split('.')[-2])
+
+  @classmethod
+  def loadz(cls, infile):
+    import json
+    bank = cls()
+    with np.load(infile) as data:
+      meta = json.loads(str(data['meta']))
+      for (hname, args, title, _type, sumw2, weighted, entries) in meta:
+        handle = bank.book(str(hname), *args, title=str(title), type=str(_type), sumw2=sumw2)
+        bank.sumw[handle] = data['sumw_%i' % handle]
+        bank.sumw2[handle] = data['sumw2_%i' % handle]
+        bank.stats[handle] = data['stats_%i' % handle]
+        bank.weighted[handle] = weighted
+        bank.entries[handle] = entries
+    return bank
 
 
 # ______________________________________________________________________________
@@ -1809,10 +2886,54 @@ class DummyAnalysis(object):
     unload_tree()
 
 
+# ______________________________________________________________________________
+# Analysis: converters
+
+class ConvertersAnalysis(object):
+  def run(self, omtf_input=False, run2_input=False):
+    # Check the array versions of the hit converters against the scalar versions,
+    # and the roads of the batch mode of PatternRecognition against the dict-based loop
+    if omtf_input:
+      infile = 'ntuple_SingleMuon_Overlap_3GeV_add.5.root'
+    else:
+      infile = 'ntuple_SingleMuon_Endcap_2GeV_add.5.root'
+    stop = None if maxEvents == -1 else maxEvents
+
+    # Workers
+    bank = PatternBank(bankfile)
+    recog = PatternRecognition(bank, omtf_input=omtf_input, run2_input=run2_input, batch_mode=False)
+    recog_batch = PatternRecognition(bank, omtf_input=omtf_input, run2_input=run2_input, batch_mode=True)
+
+    nhits = 0
+    nmismatched = {}
+    nevents = 0
+    nmismatched_events = 0
+    for block in load_columnar_blocks(infile, stop=stop, names=['hits']):
+      hits = block.collections['hits'].values
+      nhits += len(hits)
+      for (name, n) in check_emtf_hit_converters(hits):
+        nmismatched[name] = nmismatched.get(name, 0) + n
+      for evt in block:
+        nevents += 1
+        if not check_pattern_recognition_batch_mode(recog, recog_batch, evt.hits):
+          nmismatched_events += 1
+
+    for name in sorted(nmismatched.keys()):
+      print('[INFO] {0}: {1}/{2} mismatched hits'.format(name, nmismatched[name], nhits))
+    print('[INFO] roads: {0}/{1} mismatched events'.format(nmismatched_events, nevents))
+    assert(not any(nmismatched.values()))
+    assert(nmismatched_events == 0)
+
+
 # ______________________________________________________________________________
 # Analysis: roads
 
 class RoadsAnalysis(object):
+  @staticmethod
+  def report(counters):
+    (npassed, ntotal) = (counters['npassed'], counters['ntotal'])
+    print('[INFO] npassed/ntotal: %i/%i = %f' % (npassed, ntotal, (float(npassed)/ntotal) if ntotal else 0.))
+
   def run(self, omtf_input=False, run2_input=False):
     # Book histograms
     histograms = {}
@@ -1842,34 +2963,46 @@ class RoadsAnalysis(object):
     recog = PatternRecognition(bank, omtf_input=omtf_input, run2_input=run2_input)
     clean = RoadCleaning()
     slim = RoadSlimming(bank)
-    out_particles = []
-    out_roads = []
-    npassed, ntotal = 0, 0
+    instrument_stages(recog, clean, slim)
+
+    # Output
+    outfile = 'histos_tba.npz'
+    if use_condor:
+      outfile = 'histos_tba_%i.npz' % jobid
+    outfile = make_shard_outfile(outfile)
+    writer = ChunkedOutputWriter(outfile, [('parameters', particles_to_parameters), ('variables', roads_to_variables)])
+
+    # Checkpoint
+    checkpoint = Checkpoint('histos_tba', [('writer', writer)])
+    counters = checkpoint.restore()
+    npassed, ntotal = counters.get('npassed', 0), counters.get('ntotal', 0)
 
     # Event range
     n = -1
 
     # __________________________________________________________________________
     # Loop over events
-    for ievt, evt in enumerate(tree):
+    for ievt, evt in enumerate_events(tree, start=checkpoint.next_entry):
       if n != -1 and ievt == n:
         break
 
+      if checkpoint.is_due(ievt):
+        checkpoint.save(ievt, npassed=npassed, ntotal=ntotal)
+
       if len(evt.particles) == 0:
         continue
 
       part = evt.particles[0]  # particle gun
       part.invpt = np.true_divide(part.q, part.pt)
 
-      roads = recog.run(evt.hits)
+      roads = recog.run(evt.hits, get_derived_hits(ievt))
       clean_roads = clean.run(roads)
       slim_roads = slim.run(clean_roads)
       assert(len(clean_roads) == len(slim_roads))
 
       if len(slim_roads) > 0:
         mypart = Particle(part.pt, part.eta, part.phi, part.q, part.vx, part.vy, part.vz)
-        out_particles.append(mypart)
-        out_roads.append(slim_roads[0])
+        writer.append(parameters=mypart, variables=slim_roads[0])
 
       if omtf_input:
         is_important = lambda part: (0.8 <= abs(part.eta) <= 1.24) and (part.bx == 0) and (part.pt > 5.)
@@ -1939,19 +3072,16 @@ class RoadsAnalysis(object):
     # End loop over events
     unload_tree()
 
-    print('[INFO] npassed/ntotal: %i/%i = %f' % (npassed, ntotal, float(npassed)/ntotal))
+    # The counters are also returned, so that the event-parallel driver can report the totals
+    counters = {'npassed': npassed, 'ntotal': ntotal}
+    self.report(counters)
 
     # __________________________________________________________________________
     # Save objects
-    outfile = 'histos_tba.npz'
-    if use_condor:
-      outfile = 'histos_tba_%i.npz' % jobid
     print('[INFO] Creating file: %s' % outfile)
-    if True:
-      assert(len(out_particles) == len(out_roads))
-      parameters = particles_to_parameters(out_particles)
-      variables = roads_to_variables(out_roads)
-      np.savez_compressed(outfile, parameters=parameters, variables=variables)
+    writer.close()
+    checkpoint.close()
+    return counters
 
 
 # ______________________________________________________________________________
@@ -1960,29 +3090,66 @@ class RoadsAnalysis(object):
 class RatesAnalysis(object):
   def run(self, omtf_input=False, run2_input=False, pileup=200):
     # Book histograms
-    histograms = {}
+    histograms = HistogramBank()
     hname = "nevents"
-    histograms[hname] = Hist(5, 0, 5, name=hname, title="; count", type='F')
+    histograms.book(hname, 5, 0, 5, title="; count", type='F')
     for m in ("emtf", "emtf2026"):
       hname = "highest_%s_absEtaMin0.8_absEtaMax2.4_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
+      histograms.book(hname, 100, 0., 100., title="; p_{T} [GeV]; entries", type='F')
       hname = "highest_%s_absEtaMin1.24_absEtaMax2.4_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
+      histograms.book(hname, 100, 0., 100., title="; p_{T} [GeV]; entries", type='F')
       hname = "highest_%s_absEtaMin0.8_absEtaMax1.24_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
+      histograms.book(hname, 100, 0., 100., title="; p_{T} [GeV]; entries", type='F')
       hname = "highest_%s_absEtaMin1.24_absEtaMax1.65_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
+      histograms.book(hname, 100, 0., 100., title="; p_{T} [GeV]; entries", type='F')
       hname = "highest_%s_absEtaMin1.65_absEtaMax2.15_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
+      histograms.book(hname, 100, 0., 100., title="; p_{T} [GeV]; entries", type='F')
       hname = "highest_%s_absEtaMin2.15_absEtaMax2.4_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
+      histograms.book(hname, 100, 0., 100., title="; p_{T} [GeV]; entries", type='F')
 
       hname = "highest_%s_absEtaMin0.8_absEtaMax2.4_matched_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
+      histograms.book(hname, 100, 0., 100., title="; p_{T} [GeV]; entries", type='F')
 
       for l in xrange(14,22+1):
         hname = "%s_ptmin%i_qmin12_eta" % (m,l)
-        histograms[hname] = Hist(18, 0.75, 2.55, name=hname, title="; |#eta|; entries", type='F')
+        histograms.book(hname, 18, 0.75, 2.55, title="; |#eta|; entries", type='F')
+
+    eta_regions = ("absEtaMin0.8_absEtaMax2.4", "absEtaMin1.24_absEtaMax2.4", "absEtaMin0.8_absEtaMax1.24",
+                   "absEtaMin1.24_absEtaMax1.65", "absEtaMin1.65_absEtaMax2.15", "absEtaMin2.15_absEtaMax2.4")
+    h_highest = {(m,r): histograms["highest_%s_%s_qmin12_pt" % (m,r)] for r in eta_regions + ("absEtaMin0.8_absEtaMax2.4_matched",) for m in ("emtf", "emtf2026")}
+    h_ptmin_eta = {m: [histograms["%s_ptmin%i_qmin12_eta" % (m,l)] for l in xrange(14,22+1)] for m in ("emtf", "emtf2026")}
+
+    # Track selections (see Selections)
+    # - the "ptmin" selections have shape (len(ptmin_cuts), ntracks)
+    ptmin_cuts = np.arange(14,22+1, dtype=np.float64)
+
+    emtf_selections = Selections()
+    emtf_selections.declare("abs_eta", lambda trks, m: np.abs(trks['eta']))
+    emtf_selections.declare("qmin12", lambda trks, m: (trks['bx'] == 0) & np.in1d(trks['mode'], (11,13,14,15)))
+    emtf_selections.declare("absEtaMin0.8_absEtaMax2.4", lambda trks, m: m["qmin12"] & (0.8 <= m["abs_eta"]) & (m["abs_eta"] <= 2.4))
+    emtf_selections.declare("absEtaMin1.24_absEtaMax2.4", lambda trks, m: m["qmin12"] & (1.24 <= m["abs_eta"]) & (m["abs_eta"] <= 2.4))
+    emtf_selections.declare("absEtaMin0.8_absEtaMax1.24", lambda trks, m: m["qmin12"] & (0.8 <= m["abs_eta"]) & (m["abs_eta"] < 1.24))
+    emtf_selections.declare("absEtaMin1.24_absEtaMax1.65", lambda trks, m: m["qmin12"] & (1.24 <= m["abs_eta"]) & (m["abs_eta"] < 1.65))
+    emtf_selections.declare("absEtaMin1.65_absEtaMax2.15", lambda trks, m: m["qmin12"] & (1.65 <= m["abs_eta"]) & (m["abs_eta"] < 2.15))
+    emtf_selections.declare("absEtaMin2.15_absEtaMax2.4", lambda trks, m: m["qmin12"] & (2.15 <= m["abs_eta"]) & (m["abs_eta"] <= 2.4))
+    emtf_selections.declare("ptmin", lambda trks, m: m["qmin12"] & (m["abs_eta"] <= 9.9) & (trks['pt'] > ptmin_cuts[:, np.newaxis]))
+
+    emtf2026_selections = Selections()
+    emtf2026_selections.declare("abs_eta", lambda trks, m: np.abs(trks['eta']))
+    emtf2026_selections.declare("emtf_zones", lambda trks, m: np.in1d(trks['zone'], (0,1,2,3,4,5)))
+    emtf2026_selections.declare("absEtaMin0.8_absEtaMax2.4", lambda trks, m: np.in1d(trks['zone'], (0,1,2,3,4,5,6)) & (0.8 <= m["abs_eta"]) & (m["abs_eta"] <= 2.4))
+    emtf2026_selections.declare("absEtaMin1.24_absEtaMax2.4", lambda trks, m: m["emtf_zones"] & (1.24 <= m["abs_eta"]) & (m["abs_eta"] <= 2.4))
+    emtf2026_selections.declare("absEtaMin0.8_absEtaMax1.24", lambda trks, m: (trks['zone'] == 6) & (0.8 <= m["abs_eta"]) & (m["abs_eta"] <= 1.24))
+    emtf2026_selections.declare("absEtaMin1.24_absEtaMax1.65", lambda trks, m: m["emtf_zones"] & (1.24 <= m["abs_eta"]) & (m["abs_eta"] <= 1.65))
+    emtf2026_selections.declare("absEtaMin1.65_absEtaMax2.15", lambda trks, m: m["emtf_zones"] & (1.65 <= m["abs_eta"]) & (m["abs_eta"] <= 2.15))
+    emtf2026_selections.declare("absEtaMin2.15_absEtaMax2.4", lambda trks, m: m["emtf_zones"] & (2.15 <= m["abs_eta"]) & (m["abs_eta"] <= 2.4))
+    emtf2026_selections.declare("absEtaMin0.8_absEtaMax2.4_matched", lambda trks, m: m["absEtaMin0.8_absEtaMax2.4"] & trks['matched'])
+    emtf2026_selections.declare("ptmin", lambda trks, m: (m["abs_eta"] <= 9.9) & (trks['pt'] > ptmin_cuts[:, np.newaxis]))
+
+    # Per-event tracks for the rate curves (see rate_curves.py)
+    from rate_curves import TrackArraysCollector, save_track_arrays
+    emtf_collector = TrackArraysCollector(('pt', 'eta', 'mode', 'bx'))
+    emtf2026_collector = TrackArraysCollector(('pt', 'eta', 'zone', 'mode', 'matched'))
 
     # Load tree
     tree = load_minbias_batch(jobid, pileup=pileup)
@@ -1992,45 +3159,43 @@ class RatesAnalysis(object):
     recog = PatternRecognition(bank, omtf_input=omtf_input, run2_input=run2_input)
     clean = RoadCleaning()
     slim = RoadSlimming(bank)
-    ptassig1, ptassig2 = PtAssignment(kerasfile, omtf_input=False, run2_input=run2_input), PtAssignment(kerasfile, omtf_input=True, run2_input=run2_input)
+    ptassig1, ptassig2 = PtAssignment(kerasfile, omtf_input=False, run2_input=run2_input, backend=nn_backend, foldedfile=foldedfile), PtAssignment(kerasfile, omtf_input=True, run2_input=run2_input, backend=nn_backend, foldedfile=foldedfile)
     trkprod1, trkprod2 = TrackProducer(omtf_input=False, run2_input=run2_input), TrackProducer(omtf_input=True, run2_input=run2_input)
     ghost = GhostBusting()
     mucorr = TrackMuonCorrelation()
+    instrument_stages(recog, clean, slim, ptassig1, ptassig2, trkprod1, trkprod2, ghost, mucorr)
+
+    # Buffered pT assignment (see PtAssignmentBuffer)
+    ptbuf1, ptbuf2 = PtAssignmentBuffer(ptassig1), PtAssignmentBuffer(ptassig2)
+    buffered_events = []
+
+    # Checkpoint
+    checkpoint = Checkpoint('histos_tbb', [('histograms', histograms), ('emtf', emtf_collector), ('emtf2026', emtf2026_collector)])
+    checkpoint.restore()
 
     # Event range
     n = -1
 
     # __________________________________________________________________________
-    # Loop over events
-    for ievt, evt in enumerate(tree):
-      if n != -1 and ievt == n:
-        break
-
-      roads = recog.run(evt.hits)
-      clean_roads = clean.run(roads)
-      slim_roads = slim.run(clean_roads)
-
+    # Finish processing an event, once its pT assignment is done
+    def process_event(ievt, evt_tracks, evt_particles, nroads, clean_roads, slim_roads1, slim_roads2, ptassig_result1, ptassig_result2):
       # EMTF mode
-      slim_roads1 = [road for road in slim_roads if road.zone != 6]  # ignore zone 6
-      variables1 = roads_to_variables(slim_roads1)
-      variables1, predictions1, x_mask_vars1, x_road_vars1 = ptassig1.run(variables1)
+      variables1, predictions1, x_mask_vars1, x_road_vars1 = ptassig_result1
       tracks1 = trkprod1.run(slim_roads1, variables1, predictions1, x_mask_vars1, x_road_vars1)
 
       # OMTF mode
-      slim_roads2 = [road for road in slim_roads if road.zone == 6]  # only zone 6
-      variables2 = roads_to_variables(slim_roads2)
-      variables2, predictions2, x_mask_vars2, x_road_vars2 = ptassig2.run(variables2)
+      variables2, predictions2, x_mask_vars2, x_road_vars2 = ptassig_result2
       tracks2 = trkprod2.run(slim_roads2, variables2, predictions2, x_mask_vars2, x_road_vars2)
 
       # Ghost busting & muon correlator
       emtf2026_tracks = ghost.run(tracks1 + tracks2)
-      emtf2026_matched = mucorr.run(evt.particles, emtf2026_tracks)
+      emtf2026_matched = mucorr.run(evt_particles, emtf2026_tracks)
 
       found_high_pt_tracks = any(map(lambda trk: trk.pt > 20., emtf2026_tracks))
 
       if found_high_pt_tracks:
-        print("evt {0} has {1} roads, {2} clean roads, {3} old tracks, {4} new tracks".format(ievt, len(roads), len(clean_roads), len(evt.tracks), len(emtf2026_tracks)))
-        for ipart, part in enumerate(evt.particles):
+        print("evt {0} has {1} roads, {2} clean roads, {3} old tracks, {4} new tracks".format(ievt, nroads, len(clean_roads), len(evt_tracks), len(emtf2026_tracks)))
+        for ipart, part in enumerate(evt_particles):
           if part.pt > 5.:
             part.invpt = np.true_divide(part.q, part.pt)
             print(".. part invpt: {0} pt: {1} phi: {2} eta: {3} theta: {4}".format(part.invpt, part.pt, part.phi, part.eta, part.theta))
@@ -2042,136 +3207,125 @@ class RatesAnalysis(object):
           print(".. trk {0} id: {1} nhits: {2} mode: {3} pt: {4} y_pred: {5} y_discr: {6}".format(itrk, mytrk.id, len(mytrk.hits), mytrk.mode, mytrk.pt, mytrk.y_pred, mytrk.y_discr))
           for ihit, myhit in enumerate(mytrk.hits):
             print(".. .. hit {0} id: {1} lay: {2} ph: {3} th: {4} tp: {5}".format(ihit, myhit.id, myhit.emtf_layer, myhit.emtf_phi, myhit.emtf_theta, myhit.sim_tp))
-        for itrk, mytrk in enumerate(evt.tracks):
+        for itrk, mytrk in enumerate(evt_tracks):
           nhits = sum([bool(mytrk.mode & (1<<3)), bool(mytrk.mode & (1<<2)), bool(mytrk.mode & (1<<1)), bool(mytrk.mode & (1<<0))])
           print(".. otrk {0} id: {1} nhits: {2} mode: {3} pt: {4}".format(itrk, (mytrk.endcap, mytrk.sector), nhits, mytrk.mode, mytrk.pt))
 
       # ________________________________________________________________________
       # Fill histograms
-      histograms["nevents"].fill(1.0)
-
-      def fill_highest_pt():
-        highest_pt = -999999.
-        for itrk, trk in enumerate(tracks):
-          if select(trk):
-            if highest_pt < trk.pt:  # using scaled pT
-              highest_pt = trk.pt
-        if highest_pt > 0.:
-          highest_pt = min(100.-1e-4, highest_pt)
-          histograms[hname].fill(highest_pt)
-
-      def fill_eta():
-        h = histograms[hname]
-        eta_bins = [False] * (h.GetNbinsX()+2)
-        for itrk, trk in enumerate(tracks):
-          if select(trk):  # using scaled pT
-            b = h.FindFixBin(abs(trk.eta))
-            eta_bins[b] = True
-        for b in xrange(len(eta_bins)):
-          if eta_bins[b]:
-            h.fill(h.GetBinCenter(b))
-
-      tracks = evt.tracks
-      select = lambda trk: trk and (0.8 <= abs(trk.eta) <= 2.4) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-      hname = "highest_emtf_absEtaMin0.8_absEtaMax2.4_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-      hname = "highest_emtf_absEtaMin1.24_absEtaMax2.4_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (0.8 <= abs(trk.eta) < 1.24) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-      hname = "highest_emtf_absEtaMin0.8_absEtaMax1.24_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (1.24 <= abs(trk.eta) < 1.65) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-      hname = "highest_emtf_absEtaMin1.24_absEtaMax1.65_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (1.65 <= abs(trk.eta) < 2.15) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-      hname = "highest_emtf_absEtaMin1.65_absEtaMax2.15_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (2.15 <= abs(trk.eta) <= 2.4) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-      hname = "highest_emtf_absEtaMin2.15_absEtaMax2.4_qmin12_pt"
-      fill_highest_pt()
-      for l in xrange(14,22+1):
-        select = lambda trk: trk and (0 <= abs(trk.eta) <= 9.9) and (trk.bx == 0) and (trk.mode in (11,13,14,15)) and (trk.pt > float(l))
-        hname = "emtf_ptmin%i_qmin12_eta" % (l)
-        fill_eta()
-
-      tracks = emtf2026_tracks
-      select = lambda trk: trk and (0.8 <= abs(trk.eta) <= 2.4) and trk.zone in (0,1,2,3,4,5,6)
-      hname = "highest_emtf2026_absEtaMin0.8_absEtaMax2.4_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4) and trk.zone in (0,1,2,3,4,5)
-      hname = "highest_emtf2026_absEtaMin1.24_absEtaMax2.4_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (0.8 <= abs(trk.eta) <= 1.24) and trk.zone in (6,)
-      hname = "highest_emtf2026_absEtaMin0.8_absEtaMax1.24_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (1.24 <= abs(trk.eta) <= 1.65) and trk.zone in (0,1,2,3,4,5)
-      hname = "highest_emtf2026_absEtaMin1.24_absEtaMax1.65_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (1.65 <= abs(trk.eta) <= 2.15) and trk.zone in (0,1,2,3,4,5)
-      hname = "highest_emtf2026_absEtaMin1.65_absEtaMax2.15_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (2.15 <= abs(trk.eta) <= 2.4) and trk.zone in (0,1,2,3,4,5)
-      hname = "highest_emtf2026_absEtaMin2.15_absEtaMax2.4_qmin12_pt"
-      fill_highest_pt()
-      for l in xrange(14,22+1):
-        select = lambda trk: trk and (0 <= abs(trk.eta) <= 9.9) and (trk.pt > float(l))
-        hname = "emtf2026_ptmin%i_qmin12_eta" % (l)
-        fill_eta()
+      histograms.fill(histograms["nevents"], 1.0)
+
+      def fill_highest_pt(handle, tracks_pt, select):
+        if select.any():
+          highest_pt = tracks_pt[select].max()  # using scaled pT
+          if highest_pt > 0.:
+            highest_pt = min(100.-1e-4, highest_pt)
+            histograms.fill(handle, highest_pt)
+
+      def fill_eta(handle, tracks_abs_eta, select):
+        # Fill each eta bin at most once
+        b = np.unique(histograms.find_bin(handle, tracks_abs_eta[select]))
+        if len(b):
+          histograms.fill_bins(handle, b)
+
+      masks = emtf_selections.evaluate(evt_tracks)
+      for r in eta_regions:
+        fill_highest_pt(h_highest[("emtf",r)], evt_tracks['pt'], masks[r])
+      for (handle, select) in zip(h_ptmin_eta["emtf"], masks["ptmin"]):
+        fill_eta(handle, masks["abs_eta"], select)
+
+      emtf2026_trks = make_columnar_collection(emtf2026_tracks, ('pt', 'eta', 'zone', 'mode'), matched=emtf2026_matched.any(axis=0))
+      masks = emtf2026_selections.evaluate(emtf2026_trks)
+      for r in eta_regions:
+        fill_highest_pt(h_highest[("emtf2026",r)], emtf2026_trks['pt'], masks[r])
+      for (handle, select) in zip(h_ptmin_eta["emtf2026"], masks["ptmin"]):
+        fill_eta(handle, masks["abs_eta"], select)
 
       # For fake rate plot
-      for itrk, mytrk in enumerate(emtf2026_tracks):
-        m = emtf2026_matched[:, itrk]
-        mytrk.matched = m.any()
+      r = "absEtaMin0.8_absEtaMax2.4_matched"
+      fill_highest_pt(h_highest[("emtf2026",r)], emtf2026_trks['pt'], masks[r])
 
-      tracks = emtf2026_tracks
-      select = lambda trk: trk and (0.8 <= abs(trk.eta) <= 2.4) and trk.zone in (0,1,2,3,4,5,6) and trk.matched
-      hname = "highest_emtf2026_absEtaMin0.8_absEtaMax2.4_matched_qmin12_pt"
-      fill_highest_pt()
+      emtf_collector.append(evt_tracks)
+      emtf2026_collector.append(emtf2026_trks)
+
+    def flush_events():
+      results1 = ptbuf1.flush()
+      results2 = ptbuf2.flush()
+      for (evt_args, ptassig_result1, ptassig_result2) in zip(buffered_events, results1, results2):
+        process_event(*(evt_args + (ptassig_result1, ptassig_result2)))
+      del buffered_events[:]
+
+    # __________________________________________________________________________
+    # Loop over events
+    for ievt, evt in enumerate_events(tree, start=checkpoint.next_entry):
+      if n != -1 and ievt == n:
+        break
+
+      if checkpoint.is_due(ievt):
+        flush_events()
+        checkpoint.save(ievt)
+
+      roads = recog.run(evt.hits, get_derived_hits(ievt))
+      clean_roads = clean.run(roads)
+      slim_roads = slim.run(clean_roads)
+
+      # EMTF mode
+      slim_roads1 = [road for road in slim_roads if road.zone != 6]  # ignore zone 6
+      ptbuf1.append(roads_to_variables(slim_roads1))
+
+      # OMTF mode
+      slim_roads2 = [road for road in slim_roads if road.zone == 6]  # only zone 6
+      ptbuf2.append(roads_to_variables(slim_roads2))
+
+      # Keep what is needed after the pT assignment, as the rootpy objects are
+      # only valid until the next event is read
+      evt_tracks = make_columnar_collection(evt.tracks, ('endcap', 'sector', 'mode', 'pt', 'eta', 'bx'))
+      evt_particles = copy_records(evt.particles, ('pt', 'eta', 'phi', 'theta', 'q', 'vx', 'vy', 'vz', 'bx'))
+      buffered_events.append((ievt, evt_tracks, evt_particles, len(roads), clean_roads, slim_roads1, slim_roads2))
+
+      if ptbuf1.is_full() or ptbuf2.is_full():
+        flush_events()
+
+    flush_events()
 
     # End loop over events
     unload_tree()
 
+    # Report the fixed-point saturation
+    ptassig1.print_saturation_counts()
+    ptassig2.print_saturation_counts()
+
     # __________________________________________________________________________
     # Save histograms
     outfile = 'histos_tbb.root'
     if use_condor:
       outfile = 'histos_tbb_%i.root' % jobid
+    save_histogram_bank(histograms, outfile)
+
+    # __________________________________________________________________________
+    # Save the per-event tracks
+    outfile = 'rates_tbb.npz'
+    if use_condor:
+      outfile = 'rates_tbb_%i.npz' % jobid
+    outfile = make_shard_outfile(outfile)
     print('[INFO] Creating file: %s' % outfile)
-    with root_open(outfile, 'recreate') as f:
-      hnames = []
-      hname = "nevents"
-      hnames.append("nevents")
-      for m in ("emtf", "emtf2026"):
-        hname = "highest_%s_absEtaMin0.8_absEtaMax2.4_qmin12_pt" % m
-        hnames.append(hname)
-        hname = "highest_%s_absEtaMin1.24_absEtaMax2.4_qmin12_pt" % m
-        hnames.append(hname)
-        hname = "highest_%s_absEtaMin0.8_absEtaMax1.24_qmin12_pt" % m
-        hnames.append(hname)
-        hname = "highest_%s_absEtaMin1.24_absEtaMax1.65_qmin12_pt" % m
-        hnames.append(hname)
-        hname = "highest_%s_absEtaMin1.65_absEtaMax2.15_qmin12_pt" % m
-        hnames.append(hname)
-        hname = "highest_%s_absEtaMin2.15_absEtaMax2.4_qmin12_pt" % m
-        hnames.append(hname)
-        hname = "highest_%s_absEtaMin0.8_absEtaMax2.4_matched_qmin12_pt" % m
-        hnames.append(hname)
-        for l in xrange(14,22+1):
-          hname = "%s_ptmin%i_qmin12_eta" % (m,l)
-          hnames.append(hname)
-      for hname in hnames:
-        h = histograms[hname]
-        h.Write()
+    save_track_arrays(outfile, {'emtf': emtf_collector.to_track_arrays(), 'emtf2026': emtf2026_collector.to_track_arrays()})
+    checkpoint.close()
 
 
 # ______________________________________________________________________________
 # Analysis: effie
 
 class EffieAnalysis(object):
+  @staticmethod
+  def report(counters):
+    for l in (20, 30, 40, 50):
+      (npassed, ntotal) = (counters['npassed_l1pt%i' % l], counters['ntotal_l1pt%i' % l])
+      print('[INFO] @%i GeV npassed/ntotal: %i/%i = %f' % (l, npassed, ntotal, (float(npassed)/ntotal) if ntotal else 0.))
+
   def run(self, omtf_input=False, run2_input=False):
     # Book histograms
-    histograms = {}
+    histograms = HistogramBank()
     eff_pt_bins = (0., 0.5, 1., 1.5, 2., 3., 4., 5., 6., 7., 8., 10., 12., 14., 16., 18., 20., 22., 24., 26., 28., 30., 34., 40., 48., 60., 80., 120.)
     eff_highpt_bins = (2., 2.5, 3., 3.5, 4., 4.5, 5., 6., 7., 8., 10., 12., 14., 16., 18., 20., 22., 24., 26., 28., 30., 34., 40., 48., 60., 80., 100., 120., 250., 500., 1000.)
 
@@ -2179,30 +3333,69 @@ class EffieAnalysis(object):
       for l in (0, 10, 15, 20, 30, 40, 50):
         for k in ("denom", "numer"):
           hname = "%s_eff_vs_genpt_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(eff_pt_bins, name=hname, title="; gen p_{T} [GeV]", type='F')
+          histograms.book(hname, eff_pt_bins, title="; gen p_{T} [GeV]", type='F')
           hname = "%s_eff_vs_genpt_allzones_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(eff_pt_bins, name=hname, title="; gen p_{T} [GeV]", type='F')
+          histograms.book(hname, eff_pt_bins, title="; gen p_{T} [GeV]", type='F')
           hname = "%s_eff_vs_genpt_highpt_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(eff_highpt_bins, name=hname, title="; gen p_{T} [GeV]", type='F')
+          histograms.book(hname, eff_highpt_bins, title="; gen p_{T} [GeV]", type='F')
           hname = "%s_eff_vs_genpt_allzones_highpt_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(eff_highpt_bins, name=hname, title="; gen p_{T} [GeV]", type='F')
+          histograms.book(hname, eff_highpt_bins, title="; gen p_{T} [GeV]", type='F')
           hname = "%s_eff_vs_genphi_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(76, -190, 190, name=hname, title="; gen #phi {gen p_{T} > 20 GeV}", type='F')
+          histograms.book(hname, 76, -190, 190, title="; gen #phi {gen p_{T} > 20 GeV}", type='F')
           hname = "%s_eff_vs_genphi_allzones_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(76, -190, 190, name=hname, title="; gen #phi {gen p_{T} > 20 GeV}", type='F')
+          histograms.book(hname, 76, -190, 190, title="; gen #phi {gen p_{T} > 20 GeV}", type='F')
           hname = "%s_eff_vs_geneta_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(85, 0.8, 2.5, name=hname, title="; gen |#eta| {gen p_{T} > 20 GeV}", type='F')
+          histograms.book(hname, 85, 0.8, 2.5, title="; gen |#eta| {gen p_{T} > 20 GeV}", type='F')
           hname = "%s_eff_vs_geneta_allzones_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(85, 0.8, 2.5, name=hname, title="; gen |#eta| {gen p_{T} > 20 GeV}", type='F')
+          histograms.book(hname, 85, 0.8, 2.5, title="; gen |#eta| {gen p_{T} > 20 GeV}", type='F')
           hname = "%s_eff_vs_gend0_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(80, 0, 120, name=hname, title="; gen |d_{0}| {gen p_{T} > 20 GeV}", type='F')
+          histograms.book(hname, 80, 0, 120, title="; gen |d_{0}| {gen p_{T} > 20 GeV}", type='F')
           hname = "%s_eff_vs_gend0_allzones_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(80, 0, 120, name=hname, title="; gen |d_{0}| {gen p_{T} > 20 GeV}", type='F')
+          histograms.book(hname, 80, 0, 120, title="; gen |d_{0}| {gen p_{T} > 20 GeV}", type='F')
 
       hname = "%s_l1pt_vs_genpt" % m
-      histograms[hname] = Hist2D(100, -0.5, 0.5, 300, -0.5, 0.5, name=hname, title="; gen q/p_{T} [1/GeV]; q/p_{T} [1/GeV]", type='F')
+      histograms.book(hname, 100, -0.5, 0.5, 300, -0.5, 0.5, title="; gen q/p_{T} [1/GeV]; q/p_{T} [1/GeV]", type='F')
       hname = "%s_l1ptres_vs_genpt" % m
-      histograms[hname] = Hist2D(100, -0.5, 0.5, 300, -1, 2, name=hname, title="; gen q/p_{T} [1/GeV]; #Delta(p_{T})/p_{T}", type='F')
+      histograms.book(hname, 100, -0.5, 0.5, 300, -1, 2, title="; gen q/p_{T} [1/GeV]; #Delta(p_{T})/p_{T}", type='F')
+
+    eff_l1pt_cuts = (0, 10, 15, 20, 30, 40, 50)
+    eff_variables = (('genpt', 'genpt_allzones'), ('genpt_highpt', 'genpt_allzones_highpt'), ('genphi', 'genphi_allzones'),
+                     ('geneta', 'geneta_allzones'), ('gend0', 'gend0_allzones'))
+    h_eff = {}  # (m, l, variable) -> (denom, numer, allzones denom, allzones numer)
+    for m in ("emtf", "emtf2026"):
+      for l in eff_l1pt_cuts:
+        for (v, v_allzones) in eff_variables:
+          h_eff[(m,l,v)] = tuple(histograms["%s_eff_vs_%s_l1pt%i_%s" % (m,vv,l,k)] for vv in (v, v_allzones) for k in ("denom", "numer"))
+
+    # Particle and track selections (see Selections)
+    # - the "l1pt" selections have shape (len(eff_l1pt_cuts), ntracks)
+    l1pt_cuts = np.array(eff_l1pt_cuts, dtype=np.float64)
+
+    part_selections = Selections()
+    part_selections.declare("abs_eta", lambda parts, m: np.abs(parts['eta']))
+    part_selections.declare("emtf", lambda parts, m: (1.24 <= m["abs_eta"]) & (m["abs_eta"] <= 2.4) & (parts['bx'] == 0))
+    if omtf_input:
+      part_selections.declare("emtf2026", lambda parts, m: (0.8 <= m["abs_eta"]) & (m["abs_eta"] <= 1.24) & (parts['bx'] == 0))
+    else:
+      part_selections.declare("emtf2026", lambda parts, m: m["emtf"])
+
+    emtf_selections = Selections()
+    emtf_selections.declare("abs_eta", lambda trks, m: np.abs(trks['eta']))
+    emtf_selections.declare("l1pt", lambda trks, m: (trks['pt'] > l1pt_cuts[:, np.newaxis]))  # using scaled pT
+    emtf_selections.declare("select_track", lambda trks, m: (1.24 <= m["abs_eta"]) & (m["abs_eta"] <= 2.4) & (trks['bx'] == 0) & np.in1d(trks['mode'], (11,13,14,15)))
+    emtf_selections.declare("select_track_allzones", lambda trks, m: m["select_track"])
+
+    emtf2026_selections = Selections()
+    emtf2026_selections.declare("abs_eta", lambda trks, m: np.abs(trks['eta']))
+    emtf2026_selections.declare("l1pt", lambda trks, m: (trks['pt'] > l1pt_cuts[:, np.newaxis]))  # using scaled pT
+    if omtf_input:
+      #emtf2026_selections.declare("select_track", lambda trks, m: (0.8 <= m["abs_eta"]) & (m["abs_eta"] <= 1.24) & (trks['zone'] == 6))
+      emtf2026_selections.declare("select_track_allzones", lambda trks, m: (0.75 <= m["abs_eta"]) & (m["abs_eta"] <= 1.4))
+      emtf2026_selections.declare("select_track", lambda trks, m: m["select_track_allzones"] & (trks['zone'] == 6))
+    else:
+      #emtf2026_selections.declare("select_track", lambda trks, m: (1.24 <= m["abs_eta"]) & (m["abs_eta"] <= 2.4) & np.in1d(trks['zone'], (0,1,2,3,4,5)))
+      emtf2026_selections.declare("select_track_allzones", lambda trks, m: (1.1 <= m["abs_eta"]) & (m["abs_eta"] <= 2.4))
+      emtf2026_selections.declare("select_track", lambda trks, m: m["select_track_allzones"] & np.in1d(trks['zone'], (0,1,2,3,4,5)))
 
     # Load tree
     if omtf_input:
@@ -2215,20 +3408,28 @@ class EffieAnalysis(object):
     recog = PatternRecognition(bank, omtf_input=omtf_input, run2_input=run2_input)
     clean = RoadCleaning()
     slim = RoadSlimming(bank)
-    ptassig1, ptassig2 = PtAssignment(kerasfile, omtf_input=False, run2_input=run2_input), PtAssignment(kerasfile, omtf_input=True, run2_input=run2_input)
+    ptassig1, ptassig2 = PtAssignment(kerasfile, omtf_input=False, run2_input=run2_input, backend=nn_backend, foldedfile=foldedfile), PtAssignment(kerasfile, omtf_input=True, run2_input=run2_input, backend=nn_backend, foldedfile=foldedfile)
     trkprod1, trkprod2 = TrackProducer(omtf_input=False, run2_input=run2_input), TrackProducer(omtf_input=True, run2_input=run2_input)
     ghost = GhostBusting()
     mucorr = TrackMuonCorrelation()
+    instrument_stages(recog, clean, slim, ptassig1, ptassig2, trkprod1, trkprod2, ghost, mucorr)
+
+    # Checkpoint
+    checkpoint = Checkpoint('histos_tbc', [('histograms', histograms)])
+    checkpoint.restore()
 
     # Event range
     n = -1
 
     # __________________________________________________________________________
     # Loop over events
-    for ievt, evt in enumerate(tree):
+    for ievt, evt in enumerate_events(tree, start=checkpoint.next_entry):
       if n != -1 and ievt == n:
         break
 
+      if checkpoint.is_due(ievt):
+        checkpoint.save(ievt)
+
       if len(evt.particles) == 0:
         continue
 
@@ -2236,7 +3437,7 @@ class EffieAnalysis(object):
       part.invpt = np.true_divide(part.q, part.pt)
       part.d0 = calculate_d0(part.invpt, part.phi, part.vx, part.vy)
 
-      roads = recog.run(evt.hits)
+      roads = recog.run(evt.hits, get_derived_hits(ievt))
       clean_roads = clean.run(roads)
       slim_roads = slim.run(clean_roads)
 
@@ -2267,192 +3468,75 @@ class EffieAnalysis(object):
 
       # ________________________________________________________________________
       # Fill histograms
-      def fill_efficiency_pt():
-        if select_part(part):
-          trigger = any([select_track(trk) for trk in tracks])  # using scaled pT
-          denom = histograms[hname + "_denom"]
-          numer = histograms[hname + "_numer"]
-          denom.fill(part.pt)
-          if trigger:
-            numer.fill(part.pt)
-          #
-          trigger_allzones = any([select_track_allzones(trk) for trk in tracks])  # using scaled pT
-          denom = histograms[hname_allzones + "_denom"]
-          numer = histograms[hname_allzones + "_numer"]
-          denom.fill(part.pt)
-          if trigger_allzones:
-            numer.fill(part.pt)
-
-      def fill_efficiency_phi():
-        if select_part(part):
-          trigger = any([select_track(trk) for trk in tracks])  # using scaled pT
-          denom = histograms[hname + "_denom"]
-          numer = histograms[hname + "_numer"]
-          denom.fill(np.rad2deg(part.phi))
-          if trigger:
-            numer.fill(np.rad2deg(part.phi))
-          #
-          trigger_allzones = any([select_track_allzones(trk) for trk in tracks])  # using scaled pT
-          denom = histograms[hname_allzones + "_denom"]
-          numer = histograms[hname_allzones + "_numer"]
-          denom.fill(np.rad2deg(part.phi))
-          if trigger_allzones:
-            numer.fill(np.rad2deg(part.phi))
-
-      def fill_efficiency_eta():
-        if (part.bx == 0):
-          trigger = any([select_track(trk) for trk in tracks])  # using scaled pT
-          denom = histograms[hname + "_denom"]
-          numer = histograms[hname + "_numer"]
-          denom.fill(abs(part.eta))
-          if trigger:
-            numer.fill(abs(part.eta))
-          #
-          trigger_allzones = any([select_track_allzones(trk) for trk in tracks])  # using scaled pT
-          denom = histograms[hname_allzones + "_denom"]
-          numer = histograms[hname_allzones + "_numer"]
-          denom.fill(abs(part.eta))
-          if trigger_allzones:
-            numer.fill(abs(part.eta))
-
-      def fill_efficiency_d0():
-        if select_part(part):
-          trigger = any([select_track(trk) for trk in tracks])  # using scaled pT
-          denom = histograms[hname + "_denom"]
-          numer = histograms[hname + "_numer"]
-          denom.fill(abs(part.d0))
-          if trigger:
-            numer.fill(abs(part.d0))
-          #
-          trigger_allzones = any([select_track_allzones(trk) for trk in tracks])  # using scaled pT
-          denom = histograms[hname_allzones + "_denom"]
-          numer = histograms[hname_allzones + "_numer"]
-          denom.fill(abs(part.d0))
-          if trigger_allzones:
-            numer.fill(abs(part.d0))
-
-      def fill_resolution():
-        if (part.bx == 0):
-          trigger = any([select_track(trk) for trk in tracks])  # using scaled pT
-          if trigger:
-            trk = tracks[0]
-            trk.invpt = np.true_divide(trk.q, trk.xml_pt)  # using unscaled pT
-            histograms[hname1].fill(part.invpt, trk.invpt)
-            histograms[hname2].fill(abs(part.invpt), abs(part.invpt/trk.invpt) - 1)
-
-      for l in (0, 10, 15, 20, 30, 40, 50):
-        tracks = evt.tracks
-        select_part = lambda part: (1.24 <= abs(part.eta) <= 2.4) and (part.bx == 0)
-        select_track = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4) and (trk.bx == 0) and (trk.mode in (11,13,14,15)) and (trk.pt > float(l))
-        select_track_allzones = select_track
-        #
-        hname = "emtf_eff_vs_genpt_l1pt%i" % (l)
-        hname_allzones = "emtf_eff_vs_genpt_allzones_l1pt%i" % (l)
-        fill_efficiency_pt()
-        hname = "emtf_eff_vs_genpt_highpt_l1pt%i" % (l)
-        hname_allzones = "emtf_eff_vs_genpt_allzones_highpt_l1pt%i" % (l)
-        fill_efficiency_pt()
-        if part.pt > 20.:
-          hname = "emtf_eff_vs_genphi_l1pt%i" % (l)
-          hname_allzones = "emtf_eff_vs_genphi_allzones_l1pt%i" % (l)
-          fill_efficiency_phi()
-          hname = "emtf_eff_vs_geneta_l1pt%i" % (l)
-          hname_allzones = "emtf_eff_vs_geneta_allzones_l1pt%i" % (l)
-          fill_efficiency_eta()
-          hname = "emtf_eff_vs_gend0_l1pt%i" % (l)
-          hname_allzones = "emtf_eff_vs_gend0_allzones_l1pt%i" % (l)
-          fill_efficiency_d0()
-        if l == 0:
-          hname1 = "emtf_l1pt_vs_genpt"
-          hname2 = "emtf_l1ptres_vs_genpt"
-          fill_resolution()
-
-        tracks = emtf2026_tracks
-        if omtf_input:
-          select_part = lambda part: (0.8 <= abs(part.eta) <= 1.24) and (part.bx == 0)
-          #select_track = lambda trk: trk and (0.8 <= abs(trk.eta) <= 1.24) and trk.zone in (6,) and (trk.pt > float(l))
-          select_track = lambda trk: trk and (0.75 <= abs(trk.eta) <= 1.4) and trk.zone in (6,) and (trk.pt > float(l))
-          select_track_allzones = lambda trk: trk and (0.75 <= abs(trk.eta) <= 1.4) and (trk.pt > float(l))
-        else:
-          select_part = lambda part: (1.24 <= abs(part.eta) <= 2.4) and (part.bx == 0)
-          #select_track = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4) and trk.zone in (0,1,2,3,4,5) and (trk.pt > float(l))
-          select_track = lambda trk: trk and (1.1 <= abs(trk.eta) <= 2.4) and trk.zone in (0,1,2,3,4,5) and (trk.pt > float(l))
-          select_track_allzones = lambda trk: trk and (1.1 <= abs(trk.eta) <= 2.4) and (trk.pt > float(l))
-        #
-        hname = "emtf2026_eff_vs_genpt_l1pt%i" % (l)
-        hname_allzones = "emtf2026_eff_vs_genpt_allzones_l1pt%i" % (l)
-        fill_efficiency_pt()
-        hname = "emtf2026_eff_vs_genpt_highpt_l1pt%i" % (l)
-        hname_allzones = "emtf2026_eff_vs_genpt_allzones_highpt_l1pt%i" % (l)
-        fill_efficiency_pt()
-        if part.pt > 20.:
-          hname = "emtf2026_eff_vs_genphi_l1pt%i" % (l)
-          hname_allzones = "emtf2026_eff_vs_genphi_allzones_l1pt%i" % (l)
-          fill_efficiency_phi()
-          hname = "emtf2026_eff_vs_geneta_l1pt%i" % (l)
-          hname_allzones = "emtf2026_eff_vs_geneta_allzones_l1pt%i" % (l)
-          fill_efficiency_eta()
-          hname = "emtf2026_eff_vs_gend0_l1pt%i" % (l)
-          hname_allzones = "emtf2026_eff_vs_gend0_allzones_l1pt%i" % (l)
-          fill_efficiency_d0()
-        if l == 0:
-          hname1 = "emtf2026_l1pt_vs_genpt"
-          hname2 = "emtf2026_l1ptres_vs_genpt"
-          fill_resolution()
+      def fill_efficiency(handles, x, trigger, trigger_allzones):
+        (denom, numer, denom_allzones, numer_allzones) = handles
+        histograms.fill(denom, x)
+        if trigger:
+          histograms.fill(numer, x)
+        histograms.fill(denom_allzones, x)
+        if trigger_allzones:
+          histograms.fill(numer_allzones, x)
+
+      def fill_resolution(m, trks, trigger):
+        if (part.bx == 0) and trigger:
+          trk_invpt = np.true_divide(trks['q'][0], trks['xml_pt'][0])  # using unscaled pT
+          histograms.fill(histograms["%s_l1pt_vs_genpt" % m], part.invpt, trk_invpt)
+          histograms.fill(histograms["%s_l1ptres_vs_genpt" % m], abs(part.invpt), abs(part.invpt/trk_invpt) - 1)
+
+      def fill_efficiencies(m, trks, select_part, masks):
+        triggers = (masks["select_track"] & masks["l1pt"]).any(axis=1)
+        triggers_allzones = (masks["select_track_allzones"] & masks["l1pt"]).any(axis=1)
+        for (l, trigger, trigger_allzones) in zip(eff_l1pt_cuts, triggers, triggers_allzones):
+          if select_part:
+            fill_efficiency(h_eff[(m,l,'genpt')], part.pt, trigger, trigger_allzones)
+            fill_efficiency(h_eff[(m,l,'genpt_highpt')], part.pt, trigger, trigger_allzones)
+          if part.pt > 20.:
+            if select_part:
+              fill_efficiency(h_eff[(m,l,'genphi')], np.rad2deg(part.phi), trigger, trigger_allzones)
+            if (part.bx == 0):
+              fill_efficiency(h_eff[(m,l,'geneta')], abs(part.eta), trigger, trigger_allzones)
+            if select_part:
+              fill_efficiency(h_eff[(m,l,'gend0')], abs(part.d0), trigger, trigger_allzones)
+          if l == 0:
+            fill_resolution(m, trks, trigger)
+
+      parts = make_columnar_collection([part], ('eta', 'bx'))  # particle gun
+      part_masks = part_selections.evaluate(parts)
+
+      trks = make_columnar_collection(evt.tracks, ('pt', 'eta', 'bx', 'mode', 'q', 'xml_pt'))
+      fill_efficiencies("emtf", trks, part_masks["emtf"][0], emtf_selections.evaluate(trks))
+
+      trks = make_columnar_collection(emtf2026_tracks, ('pt', 'eta', 'zone', 'q', 'xml_pt'))
+      fill_efficiencies("emtf2026", trks, part_masks["emtf2026"][0], emtf2026_selections.evaluate(trks))
 
     # End loop over events
     unload_tree()
 
-    # Quick efficiency
+    # Quick efficiency (the counters are also returned, so that the event-parallel
+    # driver can report the totals)
+    counters = {}
     for l in (20, 30, 40, 50):
       for k in ("denom", "numer"):
         m = 'emtf2026'
         hname = "%s_eff_vs_genpt_l1pt%i_%s" % (m,l,k)
-        h = histograms[hname]
         if k == 'numer' :
-          npassed = h.GetBinContent(h.FindBin(l))
+          counters['npassed_l1pt%i' % l] = histograms.get_bin_content(histograms[hname], l)
         else:
-          ntotal = h.GetBinContent(h.FindBin(l))
-      print('[INFO] @%i GeV npassed/ntotal: %i/%i = %f' % (l, npassed, ntotal, float(npassed)/ntotal))
+          counters['ntotal_l1pt%i' % l] = histograms.get_bin_content(histograms[hname], l)
+    self.report(counters)
+
+    # Report the fixed-point saturation
+    ptassig1.print_saturation_counts()
+    ptassig2.print_saturation_counts()
 
     # __________________________________________________________________________
     # Save histograms
     outfile = 'histos_tbc.root'
     if use_condor:
       outfile = 'histos_tbc_%i.root' % jobid
-    print('[INFO] Creating file: %s' % outfile)
-    with root_open(outfile, 'recreate') as f:
-      hnames = []
-      for m in ("emtf", "emtf2026"):
-        for l in (0, 10, 15, 20, 30, 40, 50):
-          for k in ("denom", "numer"):
-            hname = "%s_eff_vs_genpt_l1pt%i_%s" % (m,l,k)
-            hnames.append(hname)
-            hname = "%s_eff_vs_genpt_allzones_l1pt%i_%s" % (m,l,k)
-            hnames.append(hname)
-            hname = "%s_eff_vs_genpt_highpt_l1pt%i_%s" % (m,l,k)
-            hnames.append(hname)
-            hname = "%s_eff_vs_genpt_allzones_highpt_l1pt%i_%s" % (m,l,k)
-            hnames.append(hname)
-            hname = "%s_eff_vs_genphi_l1pt%i_%s" % (m,l,k)
-            hnames.append(hname)
-            hname = "%s_eff_vs_genphi_allzones_l1pt%i_%s" % (m,l,k)
-            hnames.append(hname)
-            hname = "%s_eff_vs_geneta_l1pt%i_%s" % (m,l,k)
-            hnames.append(hname)
-            hname = "%s_eff_vs_geneta_allzones_l1pt%i_%s" % (m,l,k)
-            hnames.append(hname)
-            hname = "%s_eff_vs_gend0_l1pt%i_%s" % (m,l,k)
-            hnames.append(hname)
-            hname = "%s_eff_vs_gend0_allzones_l1pt%i_%s" % (m,l,k)
-            hnames.append(hname)
-        hname = "%s_l1pt_vs_genpt" % m
-        hnames.append(hname)
-        hname = "%s_l1ptres_vs_genpt" % m
-        hnames.append(hname)
-      for hname in hnames:
-        h = histograms[hname]
-        h.Write()
+    save_histogram_bank(histograms, outfile)
+    checkpoint.close()
+    return counters
 
 
 # ______________________________________________________________________________
@@ -2469,9 +3553,19 @@ class MixingAnalysis(object):
     slim = RoadSlimming(bank)
     ghost = GhostBusting()
     mucorr = TrackMuonCorrelation()
-    out_particles = []
-    out_roads = []
-    out_aux = []
+    instrument_stages(recog, clean, slim, ghost, mucorr)
+
+    # Output
+    outfile = 'histos_tbd.npz'
+    if use_condor:
+      outfile = 'histos_tbd_%i.npz' % jobid
+    outfile = make_shard_outfile(outfile)
+    writer = ChunkedOutputWriter(outfile, [('parameters', particles_to_parameters), ('variables', roads_to_variables),
+                                           ('aux', lambda x: np.array(x, dtype=np.float32))])
+
+    # Checkpoint
+    checkpoint = Checkpoint('histos_tbd', [('writer', writer)])
+    checkpoint.restore()
 
     training_phase = (jobid < test_job)
     if training_phase:
@@ -2480,18 +3574,6 @@ class MixingAnalysis(object):
     else:
       bx_shifts = [0]
 
-    def keep_old_bx(hits, particles):
-      for hit in hits:
-        hit.old_bx = hit.bx
-      for part in particles:
-        part.old_bx = part.bx
-
-    def manipulate_bx(hits, particles, bx_shift):
-      for hit in hits:
-        hit.bx = hit.old_bx + bx_shift
-      for part in particles:
-        part.bx = part.old_bx + bx_shift
-
     def make_tracks_without_pt(roads):
       tracks = []
       for myroad in roads:
@@ -2510,31 +3592,39 @@ class MixingAnalysis(object):
 
     # __________________________________________________________________________
     # Loop over events
-    for ievt, evt in enumerate(tree):
+    for ievt, evt in enumerate_events(tree, start=checkpoint.next_entry):
       if n != -1 and ievt == n:
         break
 
-      # Remember the BX
-      keep_old_bx(evt.hits, evt.particles)
+      if checkpoint.is_due(ievt):
+        checkpoint.save(ievt)
+
+      # Convert the hits and find the pattern matches only once
+      prepared = recog.prepare(evt.hits, get_derived_hits(ievt))
+
+      # Copy the particles, so that their BX can be shifted without changing the tree
+      evt_particles = copy_records(evt.particles, ('pt', 'eta', 'phi', 'theta', 'q', 'vx', 'vy', 'vz', 'bx'))
+      evt_particles_bx = [part.bx for part in evt_particles]
 
       # Manipulate hit BX multiple times
       for bx_shift in bx_shifts:
 
-        # Manipulate hit BX
-        manipulate_bx(evt.hits, evt.particles, bx_shift=bx_shift)
+        # Manipulate particle BX (the hit BX is shifted by run_prepared())
+        for (part, part_bx) in zip(evt_particles, evt_particles_bx):
+          part.bx = part_bx + bx_shift
 
-        roads = recog.run(evt.hits)
+        roads = recog.run_prepared(prepared, bx_shift=bx_shift)
         clean_roads = clean.run(roads)
         slim_roads = slim.run(clean_roads)
         assert(len(clean_roads) == len(slim_roads))
 
         tracks_without_pt = make_tracks_without_pt(slim_roads)
         emtf2026_tracks = ghost.run(tracks_without_pt)
-        emtf2026_matched = mucorr.run(evt.particles, emtf2026_tracks)
+        emtf2026_matched = mucorr.run(evt_particles, emtf2026_tracks)
 
         def find_highest_part_pt():
           highest_pt = -999999.
-          for ipart, part in enumerate(evt.particles):
+          for ipart, part in enumerate(evt_particles):
             if select_part(part):
               if highest_pt < part.pt:
                 highest_pt = part.pt
@@ -2567,16 +3657,14 @@ class MixingAnalysis(object):
           if m.any():
             assert(np.squeeze(m.nonzero()).ndim == 0)
             m_ipart = np.asscalar(np.squeeze(m.nonzero()))
-            m_part = evt.particles[m_ipart]
+            m_part = evt_particles[m_ipart]
             mypart = Particle(m_part.pt, m_part.eta, m_part.phi, m_part.q, m_part.vx, m_part.vy, m_part.vz)
             highest_part_pt = m_part.pt
           else:
             mypart = Particle(0., 0., 0., -1, 0., 0., 0.)
             highest_part_pt = -999999.
           aux = (jobid, ievt, highest_part_pt, highest_track_pt)
-          out_particles.append(mypart)
-          out_roads.append(mytrk.myroad)
-          out_aux.append(aux)
+          writer.append(parameters=mypart, variables=mytrk.myroad, aux=aux)
 
         debug_event_list = set([2826, 2937, 3675, 4581, 4838, 5379, 7640])
 
@@ -2592,17 +3680,9 @@ class MixingAnalysis(object):
 
     # __________________________________________________________________________
     # Save objects
-    outfile = 'histos_tbd.npz'
-    if use_condor:
-      outfile = 'histos_tbd_%i.npz' % jobid
     print('[INFO] Creating file: %s' % outfile)
-    if True:
-      assert(len(out_particles) == len(out_roads))
-      assert(len(out_particles) == len(out_aux))
-      parameters = particles_to_parameters(out_particles)
-      variables = roads_to_variables(out_roads)
-      out_aux = np.array(out_aux, dtype=np.float32)
-      np.savez_compressed(outfile, parameters=parameters, variables=variables, aux=out_aux)
+    writer.close()
+    checkpoint.close()
 
 
 # ______________________________________________________________________________
@@ -2618,18 +3698,30 @@ class CollusionAnalysis(object):
     recog = PatternRecognition(bank, omtf_input=omtf_input, run2_input=run2_input)
     clean = RoadCleaning()
     slim = RoadSlimming(bank)
-    out_particles = []
-    out_roads = []
+    instrument_stages(recog, clean, slim)
+
+    # Output
+    outfile = 'histos_tbe.npz'
+    if use_condor:
+      outfile = 'histos_tbe_%i.npz' % jobid
+    writer = ChunkedOutputWriter(outfile, [('parameters', particles_to_parameters), ('variables', roads_to_variables)])
+
+    # Checkpoint
+    checkpoint = Checkpoint('histos_tbe', [('writer', writer)])
+    checkpoint.restore()
 
     # Event range
     n = -1
 
     # __________________________________________________________________________
     # Loop over events
-    for ievt, evt in enumerate(tree):
+    for ievt, evt in enumerate_events(tree, start=checkpoint.next_entry):
       if n != -1 and ievt == n:
         break
 
+      if checkpoint.is_due(ievt):
+        checkpoint.save(ievt)
+
       if len(evt.particles) == 0:
         continue
 
@@ -2683,10 +3775,8 @@ class CollusionAnalysis(object):
               myroad_1 = myroad
 
       if not ((myroad_0 is None) or (myroad_1 is None)):
-        out_particles.append(myparticles[0])
-        out_particles.append(myparticles[1])
-        out_roads.append(myroad_0)
-        out_roads.append(myroad_1)
+        writer.append(parameters=myparticles[0], variables=myroad_0)
+        writer.append(parameters=myparticles[1], variables=myroad_1)
 
       if ievt < 20:
         print("evt {0} has {1} roads and {2} clean roads".format(ievt, len(roads), len(clean_roads)))
@@ -2707,15 +3797,9 @@ class CollusionAnalysis(object):
 
     # __________________________________________________________________________
     # Save objects
-    outfile = 'histos_tbe.npz'
-    if use_condor:
-      outfile = 'histos_tbe_%i.npz' % jobid
     print('[INFO] Creating file: %s' % outfile)
-    if True:
-      assert(len(out_particles) == len(out_roads))
-      parameters = particles_to_parameters(out_particles)
-      variables = roads_to_variables(out_roads)
-      np.savez_compressed(outfile, parameters=parameters, variables=variables)
+    writer.close()
+    checkpoint.close()
 
 
 # ______________________________________________________________________________
@@ -2729,15 +3813,26 @@ class ImagesAnalysis(object):
     else:
       tree = load_pgun()
 
-    out_part = []
-    out_hits = []
+    # Output
+    outfile = 'histos_tbf.npz'
+    if use_condor:
+      outfile = 'histos_tbf_%i.npz' % jobid
+    writer = ChunkedOutputWriter(outfile, [('out_part', lambda x: np.asarray(x, dtype=np.float32)), ('out_hits', create_ragged_array)],
+                                 ragged=('out_hits',))
+
+    # Checkpoint
+    checkpoint = Checkpoint('histos_tbf', [('writer', writer)])
+    checkpoint.restore()
 
     # __________________________________________________________________________
     # Loop over events
-    for ievt, evt in enumerate(tree):
+    for ievt, evt in enumerate_events(tree, start=checkpoint.next_entry):
       if maxEvents != -1 and ievt == maxEvents:
         break
 
+      if checkpoint.is_due(ievt):
+        checkpoint.save(ievt)
+
       # Skip events with very few hits
       if omtf_input:
         if not len(evt.hits) >= 2:
@@ -2865,8 +3960,7 @@ class ImagesAnalysis(object):
         print ievt, part.pt, ievt_part, ievt_nhits
 
       # Output
-      out_part += ievt_part
-      out_hits += ievt_hits
+      writer.extend(out_part=ievt_part, out_hits=ievt_hits)
       continue  # end loop over events
 
     # End loop over events
@@ -2874,16 +3968,10 @@ class ImagesAnalysis(object):
 
     # __________________________________________________________________________
     # Save objects
-    outfile = 'histos_tbf.npz'
-    if use_condor:
-      outfile = 'histos_tbf_%i.npz' % jobid
     print('[INFO] Creating file: %s' % outfile)
-    if True:
-      assert(len(out_part) == len(out_hits))
-      out_part = np.asarray(out_part, dtype=np.float32)
-      out_hits = create_ragged_array(out_hits)
-      print out_part.shape, out_hits.shape
-      np.savez_compressed(outfile, out_part=out_part, out_hits_values=out_hits.values, out_hits_row_splits=out_hits.row_splits)
+    writer.close()
+    print('[INFO] nrows: %i nchunks: %i' % (writer.nrows, writer.nchunks))
+    checkpoint.close()
 
 
 # ______________________________________________________________________________
@@ -2900,6 +3988,31 @@ use_condor = ('CONDOR_EXEC' in os.environ)
 if use_condor:
   os.environ['ROOTPY_GRIDMODE'] = 'true'
 
+# Checkpoints (see Checkpoint), saved every checkpoint_events events and/or
+# every checkpoint_seconds seconds (disabled if both are 0). With --resume (or
+# RESUME=1), the analysis continues from its last checkpoint.
+checkpoint_dir = 'checkpoints'
+if 'CHECKPOINT_DIR' in os.environ:
+  checkpoint_dir = os.environ['CHECKPOINT_DIR']
+checkpoint_events = 0
+if 'CHECKPOINT_EVENTS' in os.environ:
+  checkpoint_events = int(os.environ['CHECKPOINT_EVENTS'])
+checkpoint_seconds = 0
+if 'CHECKPOINT_SECONDS' in os.environ:
+  checkpoint_seconds = float(os.environ['CHECKPOINT_SECONDS'])
+resume = ('RESUME' in os.environ)
+if '--resume' in sys.argv:
+  sys.argv.remove('--resume')
+  resume = True
+
+# Per-stage timing of the emulator chain (see StageTimer), enabled with --timing
+# (or TIMING=1). A json summary is written at the end of the job.
+timing = ('TIMING' in os.environ)
+if '--timing' in sys.argv:
+  sys.argv.remove('--timing')
+  timing = True
+stage_timer = None  # see start_stage_timer()
+
 # Algorithm (pick one)
 algo = 'default'  # phase 2
 #algo = 'run3'
@@ -2909,20 +4022,44 @@ if use_condor:
 
 # Analysis mode (pick one)
 #analysis = 'dummy'
+#analysis = 'converters'
 #analysis = 'roads'
 #analysis = 'rates'
 analysis = 'effie'
 #analysis = 'mixing'
 #analysis = 'collusion'
 #analysis = 'images'
+#analysis = 'parallel'  # checks the event-parallel driver (see ParallelCheckAnalysis)
 if use_condor:
   analysis = sys.argv[2]
 
+# NN inference backend (pick one)
+nn_backend = 'keras'
+#nn_backend = 'numpy'  # needs the folded models (see nn_models.save_my_folded_model())
+#nn_backend = 'quantized'  # fixed-point emulation, also needs the folded models
+
+# Fixed-point types for nn_backend = 'quantized', given as (bits, int_bits)
+quantized_config = dict(input_type=(16,11), weight_bits=8, preact_type=(16,6), act_type=(16,1), output_type=(16,8), lut_bits=10)
+
 # Job id
 jobid = 0
 if use_condor:
   jobid = int(sys.argv[3])
 
+# Number of processes (if > 1, use the event-parallel driver, see run_parallel())
+nprocesses = 1
+if 'NPROCESSES' in os.environ:
+  nprocesses = int(os.environ['NPROCESSES'])
+
+# Event range and shard number (set by the event-parallel driver)
+entry_start, entry_stop = 0, -1
+shard_id = -1
+
+# Analysis that is run sequentially and in parallel by the 'parallel' analysis
+parallel_check_analysis = 'roads'
+if 'PARALLEL_CHECK_ANALYSIS' in os.environ:
+  parallel_check_analysis = os.environ['PARALLEL_CHECK_ANALYSIS']
+
 
 # Input files
 bankfile = 'pattern_bank_18patt.27.npz'
@@ -2931,16 +4068,161 @@ kerasfile = ['model.27.json', 'model_weights.27.h5',
              'model_run3.27.json', 'model_run3_weights.27.h5',
              'model_omtf.27.json', 'model_omtf_weights.27.h5',]
 
+foldedfile = ['model_folded.27.npz', 'model_run3_folded.27.npz', 'model_omtf_folded.27.npz']
+
 infile_r = None  # input file handle
 
-def purge_bad_files(infiles):
+derived_hits_r = None  # derived hit columns of the input files, and their entry offsets (see load_derived_hits())
+
+# Derived-hit cache directory (disabled if empty) and max size in bytes
+hit_cache_dir = ''
+if 'HIT_CACHE_DIR' in os.environ:
+  hit_cache_dir = os.environ['HIT_CACHE_DIR']
+hit_cache_max_size = 20 << 30
+
+# Input file cache directory (disabled if empty), max size in bytes, and remote
+# (xrootd if empty, or a local directory that stands for the redirector)
+file_cache_dir = ''
+if 'FILE_CACHE_DIR' in os.environ:
+  file_cache_dir = os.environ['FILE_CACHE_DIR']
+file_cache_max_size = 50 << 30
+if 'FILE_CACHE_MAX_SIZE' in os.environ:
+  file_cache_max_size = int(os.environ['FILE_CACHE_MAX_SIZE'])
+file_cache_remote = ''
+if 'FILE_CACHE_REMOTE' in os.environ:
+  file_cache_remote = os.environ['FILE_CACHE_REMOTE']
+file_cache = None  # see get_file_cache()
+
+# Number of rows in each chunk of the npz outputs (see ChunkedOutputWriter)
+output_chunk_size = 20000
+if 'OUTPUT_CHUNK_SIZE' in os.environ:
+  output_chunk_size = int(os.environ['OUTPUT_CHUNK_SIZE'])
+
+# Index of the validated input files (disabled if empty). If enabled, the bad
+# files are removed from the chains (see purge_bad_files())
+file_index_path = ''
+if 'FILE_INDEX' in os.environ:
+  file_index_path = os.environ['FILE_INDEX']
+file_index_nprocesses = 8
+if 'FILE_INDEX_NPROCESSES' in os.environ:
+  file_index_nprocesses = int(os.environ['FILE_INDEX_NPROCESSES'])
+
+# Input file validation
+# - the files are checked in parallel (by file_index_nprocesses processes) for
+#   the tree and its number of entries, and the local files (or their copies in
+#   the file cache) also get an adler32 checksum.
+# - the results are kept in a persistent index (a json file), so the files are
+#   only validated again if they change. The remote files are assumed not to
+#   change, and the bad files are only checked again with recheck_bad=True.
+
+def get_file_stamp(infile):
+  # Returns (size, mtime) for a local file, or None for a remote file
+  if os.path.isfile(infile):
+    st = os.stat(infile)
+    return [st.st_size, int(st.st_mtime)]
+  return None
+
+def get_file_checksum(infile):
+  # Same as the adler32 checksum of the CMS data management, as a hex string
+  import zlib
+  checksum = 1
+  with open(infile, 'rb') as f:
+    while True:
+      block = f.read(1 << 24)
+      if not block:
+        break
+      checksum = zlib.adler32(block, checksum)
+  return '%08x' % (checksum & 0xffffffff)
+
+def validate_file(infile, treename='ntupler/tree'):
+  # Returns the index entry of the file
+  import ROOT
+  entry = {'stamp': get_file_stamp(infile), 'good': False, 'has_tree': False, 'entries': -1, 'checksum': None, 'error': ''}
+  tfile = ROOT.TFile.Open(infile)
+  if not tfile or tfile.IsZombie():
+    entry['error'] = 'cannot open file'
+  elif tfile.TestBit(ROOT.TFile.kRecovered):
+    entry['error'] = 'file was not closed properly'
+  else:
+    tree = tfile.Get(treename)
+    if not tree:
+      entry['error'] = 'cannot find tree: %s' % treename
+    else:
+      entry['has_tree'] = True
+      entry['entries'] = int(tree.GetEntries())
+      entry['good'] = True
+  if tfile:
+    tfile.Close()
+  local_infile = infile
+  if entry['stamp'] is None:
+    cache = get_file_cache()
+    local_infile = cache.lookup(infile) if cache is not None else None
+  if entry['good'] and local_infile is not None:
+    entry['checksum'] = get_file_checksum(local_infile)
+  return entry
+
+class FileIndex(object):
+  def __init__(self, path):
+    self.path = path
+    self.entries = {}  # file name -> entry (see validate_file())
+    if os.path.isfile(self.path):
+      self.entries = self._read()
+
+  def _read(self):
+    import json
+    with open(self.path) as f:
+      return {str(k): v for (k, v) in json.load(f).iteritems()}
+
+  def save(self):
+    # The entries of the other jobs that saved the same index are kept
+    import json
+    entries = self._read() if os.path.isfile(self.path) else {}
+    entries.update(self.entries)
+    self.entries = entries
+    tmpfile = '%s.tmp%i' % (self.path, os.getpid())
+    with open(tmpfile, 'w') as f:
+      json.dump(entries, f, indent=0, sort_keys=True)
+    os.rename(tmpfile, self.path)
+
+  def is_validated(self, infile, recheck_bad=False):
+    entry = self.entries.get(infile)
+    if entry is None or entry['stamp'] != get_file_stamp(infile):
+      return False
+    return entry['good'] or not recheck_bad
+
+  def validate(self, infiles, nprocesses=None, recheck_bad=False):
+    # Validates the files that are not in the index yet (or have changed)
+    import multiprocessing
+    if nprocesses is None:
+      nprocesses = file_index_nprocesses
+    todo = [infile for infile in infiles if not self.is_validated(infile, recheck_bad=recheck_bad)]
+    if not todo:
+      return
+    print('[INFO] Validating {0} files with {1} processes'.format(len(todo), nprocesses))
+    if nprocesses > 1 and len(todo) > 1:
+      pool = multiprocessing.Pool(processes=min(nprocesses, len(todo)))
+      try:
+        results = pool.map(validate_file, todo, chunksize=1)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      results = [validate_file(infile) for infile in todo]
+    for (infile, entry) in zip(todo, results):
+      self.entries[infile] = entry
+    self.save()
+
+def purge_bad_files(infiles, recheck_bad=False):
+  # Returns the good files, after validating the files that are not in the index
+  index = FileIndex(file_index_path)
+  index.validate(infiles, recheck_bad=recheck_bad)
   good_files = []
   for infile in infiles:
-    try:
-      _ = TreeChain('ntupler/tree', infile)
+    entry = index.entries[infile]
+    if entry['good']:
       good_files.append(infile)
-    except:
-      pass
+    else:
+      print('[WARNING] Skipping bad file: {0} ({1})'.format(infile, entry['error']))
   return good_files
 
 def define_collections(tree):
@@ -2950,22 +4232,71 @@ def define_collections(tree):
   tree.define_collection(name='evt_info', prefix='ve_', size='ve_size')
   return
 
+columnar_collections = [
+  ('hits', 'vh_', 'vh_size'),
+  ('tracks', 'vt_', 'vt_size'),
+  ('particles', 'vp_', 'vp_size'),
+  ('evt_info', 've_', 've_size'),
+]
+
+def load_columnar_blocks(infiles, block_size=1000, start=0, stop=None, names=None):
+  # Read the collections (see define_collections()) for blocks of events into
+  # jagged arrays, instead of accessing them one attribute at a time through
+  # the rootpy tree. Yields ColumnarEventBlock's. Only the branches of the
+  # collections in 'names' (default: all) are read.
+  from root_numpy import root2array, list_branches
+  if isinstance(infiles, str):
+    infiles = [infiles]
+  print('[INFO] Opening file: %s' % ' '.join(infiles))
+  collections_to_read = [(name, prefix, size) for (name, prefix, size) in columnar_collections if names is None or name in names]
+  prefixes = tuple(prefix for (name, prefix, size) in collections_to_read)
+  branches = [branch for branch in list_branches(infiles[0], treename='ntupler/tree') if branch.startswith(prefixes)]
+  entry_start = start
+  while stop is None or entry_start < stop:
+    entry_stop = entry_start + block_size
+    if stop is not None:
+      entry_stop = min(entry_stop, stop)
+    arr = root2array(infiles, treename='ntupler/tree', branches=branches, start=entry_start, stop=entry_stop)
+    if len(arr) == 0:
+      break
+    collections = {}
+    for (name, prefix, size) in collections_to_read:
+      collections[name] = create_jagged_array(arr, prefix, size)
+    yield ColumnarEventBlock(collections, entry_start=entry_start)
+    entry_start += len(arr)
+
 def load_tree_single(infile):
   print('[INFO] Opening file: %s' % infile)
   global infile_r
+  cache = get_file_cache()
+  if cache is not None:
+    infile = cache.get(infile)
   infile_r = root_open(infile)
   tree = infile_r.ntupler.tree
   define_collections(tree)
+  load_derived_hits([infile])
   return tree
 
 def load_tree_multiple(infiles):
+  entries = None
+  if file_index_path:
+    infiles = purge_bad_files(infiles)
+    # The number of entries of each file is already in the index
+    index = FileIndex(file_index_path)
+    entries = [index.entries[infile]['entries'] for infile in infiles]
   print('[INFO] Opening file: %s' % ' '.join(infiles))
-  tree = TreeChain('ntupler/tree', infiles)
+  cache = get_file_cache()
+  tree = CachedTreeChain('ntupler/tree', infiles, cache, entries=entries)
   define_collections(tree)
+  if cache is not None:
+    # The derived hits are only used if all the files are already in the cache
+    infiles = [cache.lookup(infile) or infile for infile in infiles]
+  load_derived_hits(infiles)
   return tree
 
 def unload_tree():
-  global infile_r
+  global infile_r, derived_hits_r
+  derived_hits_r = None
   try:
     infile_r.close()
   except:
@@ -2994,7 +4325,6 @@ def load_pgun_batch_omtf(k):
   for j in jj:
     infiles.append('root://cmsxrootd-site.fnal.gov//store/group/l1upgrades/L1MuonTrigger/P2_10_4_0/ntuple_SingleMuon_Overlap_3GeV/ParticleGuns/CRAB3/190416_194944/%04i/ntuple_SingleMuon_Overlap_%i.root' % ((j+1)/1000, (j+1)))
     infiles.append('root://cmsxrootd-site.fnal.gov//store/group/l1upgrades/L1MuonTrigger/P2_10_4_0/ntuple_SingleMuon_Overlap2_3GeV/ParticleGuns/CRAB3/190416_195101/%04i/ntuple_SingleMuon_Overlap2_%i.root' % ((j+1)/1000, (j+1)))
-  #infiles = purge_bad_files(infiles)
   return load_tree_multiple(infiles)
 
 def load_pgun_batch_displ(k):
@@ -3053,6 +4383,1047 @@ def load_minbias_batch_for_collusion(k):
   return load_tree_single(infile)
 
 
+# ______________________________________________________________________________
+# Derived-hit cache
+# - the hit conversions done by PatternRecognition (endsec, emtf_layer, zones,
+#   emtf_phi, emtf_theta, old_emtf_phi, old_emtf_bend) only depend on the input
+#   ntuple, so they are computed once per input file with the array versions
+#   of the converters, and stored in a sidecar directory with one .npy file per
+#   column (loaded with mmap).
+# - an entry is keyed by the file path, size and mtime, and the converter
+#   version. When a file changes, its old entry is removed when the new one is
+#   stored. The least recently used entries are removed when the cache
+#   directory grows beyond max_size.
+# - only local files are cached.
+
+derived_hit_version = 1  # bump when the hit converters change
+
+derived_hit_columns = ('endsec', 'lay', 'old_emtf_phi', 'old_emtf_bend', 'emtf_phi', 'emtf_theta', 'zones')
+
+derived_zones_lut = [np.flatnonzero((zones >> np.arange(7)) & 1) for zones in xrange(1<<7)]  # zones bitmask -> zones
+
+def derive_hit_columns(hits):
+  # Takes the columnar hits, returns the derived columns as a dict
+  zones = find_emtf_zones.array(hits, emtf_theta=find_emtf_theta.array(hits))
+  columns = {
+    'endsec': np.where(hits['endcap'] == 1, hits['sector'] - 1, hits['sector'] - 1 + 6).astype(np.int8),
+    'lay': find_emtf_layer.array(hits).astype(np.int8),
+    'old_emtf_phi': find_emtf_old_phi.array(hits),
+    'old_emtf_bend': find_emtf_old_bend.array(hits),
+    'emtf_phi': find_emtf_phi.array(hits),
+    'emtf_theta': find_emtf_theta.array(hits),
+    'zones': np.sum(zones << np.arange(7), axis=-1).astype(np.uint8),
+  }
+  return columns
+
+class DerivedHitCache(object):
+  def __init__(self, cachedir, max_size=hit_cache_max_size, version=derived_hit_version):
+    self.cachedir = cachedir
+    self.max_size = max_size
+    self.version = version
+    if not os.path.isdir(self.cachedir):
+      try:
+        os.makedirs(self.cachedir)
+      except OSError:  # made by another process
+        pass
+
+  def make_key(self, infile):
+    import hashlib
+    st = os.stat(infile)
+    key = '%s:%i:%i:%i' % (os.path.abspath(infile), st.st_size, int(st.st_mtime), self.version)
+    return hashlib.sha1(key).hexdigest()
+
+  def load(self, infile):
+    entry = os.path.join(self.cachedir, self.make_key(infile))
+    if not os.path.isdir(entry):
+      return None
+    os.utime(entry, None)  # mark as recently used
+    columns = {}
+    for name in derived_hit_columns:
+      columns[name] = np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+    row_splits = np.load(os.path.join(entry, 'row_splits.npy'))
+    return (columns, row_splits)
+
+  def store(self, infile, columns, row_splits):
+    import json, shutil
+    key = self.make_key(infile)
+    entry = os.path.join(self.cachedir, key)
+    tmp_entry = '%s.tmp%i' % (entry, os.getpid())
+    os.makedirs(tmp_entry)
+    for (name, column) in columns.iteritems():
+      np.save(os.path.join(tmp_entry, name + '.npy'), column)
+    np.save(os.path.join(tmp_entry, 'row_splits.npy'), row_splits)
+    with open(os.path.join(tmp_entry, 'meta.json'), 'w') as f:
+      json.dump({'path': os.path.abspath(infile), 'version': self.version}, f)
+    try:
+      os.rename(tmp_entry, entry)
+    except OSError:  # stored by another process
+      shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    # Remove stale entries of the same file, then the least recently used entries
+    entries = []
+    for other_key in os.listdir(self.cachedir):
+      other_entry = os.path.join(self.cachedir, other_key)
+      if other_key == key or not os.path.isdir(other_entry) or '.tmp' in other_key:
+        continue
+      try:
+        with open(os.path.join(other_entry, 'meta.json')) as f:
+          meta = json.load(f)
+        if meta['path'] == os.path.abspath(infile):
+          shutil.rmtree(other_entry, ignore_errors=True)
+          continue
+        size = sum(os.path.getsize(os.path.join(other_entry, x)) for x in os.listdir(other_entry))
+        entries.append((os.path.getmtime(other_entry), size, other_entry))
+      except (IOError, OSError, ValueError):  # removed by another process
+        continue
+    total_size = sum(os.path.getsize(os.path.join(entry, x)) for x in os.listdir(entry))
+    total_size += sum(size for (mtime, size, other_entry) in entries)
+    for (mtime, size, other_entry) in sorted(entries):
+      if total_size <= self.max_size:
+        break
+      shutil.rmtree(other_entry, ignore_errors=True)
+      total_size -= size
+
+  def get(self, infile):
+    # Returns the derived columns of all the hits in the file as (columns, row_splits),
+    # or None if they cannot be read or derived (then the hits are derived per event)
+    try:
+      derived = self.load(infile)
+      if derived is not None:
+        return derived
+      from root_numpy import root2array
+      arr = root2array(infile, treename='ntupler/tree', branches=['vh_size'] + ['vh_' + x for x in hit_cache_branches])
+      hits = create_jagged_array(arr, 'vh_', 'vh_size')
+      columns = derive_hit_columns(hits.values)
+      self.store(infile, columns, hits.row_splits)
+      return self.load(infile)
+    except (AssertionError, IOError, OSError, KeyError, ValueError) as e:
+      print('[WARNING] Cannot derive the hit columns for file: %s (%s)' % (infile, e))
+      return None
+
+hit_cache_branches = ['type', 'station', 'ring', 'endcap', 'sector', 'subsector', 'neighbor', 'cscid', 'strip', 'pattern', 'bend', 'fr', 'quality', 'wire', 'emtf_phi', 'emtf_theta']
+
+def load_derived_hits(infiles):
+  # Loads the derived hit columns of the input files (in the same entry order as
+  # the tree) if the cache is enabled and all the files are local
+  global derived_hits_r
+  derived_hits_r = None
+  if not hit_cache_dir or not all(os.path.isfile(infile) for infile in infiles):
+    return
+  cache = DerivedHitCache(hit_cache_dir)
+  derived_list = [cache.get(infile) for infile in infiles]
+  if any(derived is None for derived in derived_list):
+    return
+  # The columns of each file stay memory-mapped. The first entry of each file
+  # in the chain is found from the number of entries of the files.
+  entry_offsets = np.zeros(len(derived_list)+1, dtype=np.int64)
+  np.cumsum([len(row_splits) - 1 for (columns, row_splits) in derived_list], out=entry_offsets[1:])
+  derived_hits_r = (derived_list, entry_offsets)
+
+def get_derived_hits(ievt):
+  # Returns the derived hit columns of an event as a dict of lists, or None
+  if derived_hits_r is None:
+    return None
+  (derived_list, entry_offsets) = derived_hits_r
+  ifile = np.searchsorted(entry_offsets, ievt, side='right') - 1
+  (columns, row_splits) = derived_list[ifile]
+  ievt -= entry_offsets[ifile]
+  (begin, end) = row_splits[ievt:ievt+2]
+  return {name: column[begin:end].tolist() for (name, column) in columns.iteritems()}
+
+
+# ______________________________________________________________________________
+# Input file cache
+# - when file_cache_dir is set, the xrootd input files are read from their local
+#   copies in a read-through cache (see Configuration/python/filecache.py),
+#   which keeps the most recently used files up to file_cache_max_size bytes.
+# - CachedTreeChain is used instead of TreeChain for multiple files. It opens
+#   the files one at a time, and prefetches the next file in the background
+#   while the current one is being processed. It can also start at any entry
+#   (see iter_range()), so it is used even when the cache is disabled.
+
+def get_file_cache():
+  # Returns the FileCache, or None if it is disabled
+  global file_cache
+  if file_cache is None and file_cache_dir:
+    try:
+      from L1TMuonSimulations.Configuration.filecache import FileCache, XRootDRemote, LocalRemote
+    except ImportError:
+      from filecache import FileCache, XRootDRemote, LocalRemote
+    if file_cache_remote:
+      remote = LocalRemote(file_cache_remote)
+    else:
+      remote = XRootDRemote()
+    file_cache = FileCache(file_cache_dir, max_size=file_cache_max_size, remote=remote)
+  return file_cache
+
+class CachedTreeChain(object):
+  # Same as TreeChain as used by the analyses (collections, iteration,
+  # GetEntries, and the other tree methods for the current file). The cache
+  # can be None, then the files are opened directly.
+  def __init__(self, name, files, cache=None, entries=None):
+    if entries is None:
+      entries = [None] * len(files)
+    self.name = name
+    self.files = list(files)
+    self.cache = cache
+    self.collections = []    # arguments of define_collection()
+    self.branch_status = []  # arguments of SetBranchStatus()
+    self.entries = list(entries)  # number of entries of each file, if known
+    self._file = None
+    self._tree = None
+
+  def define_collection(self, **kwargs):
+    self.collections.append(kwargs)
+    if self._tree is not None:
+      self._tree.define_collection(**kwargs)
+
+  def SetBranchStatus(self, *args):
+    self.branch_status.append(args)
+    if self._tree is not None:
+      self._tree.SetBranchStatus(*args)
+
+  def _get_path(self, ifile):
+    if self.cache is None:
+      return self.files[ifile]
+    return self.cache.get(self.files[ifile])
+
+  def _open(self, ifile, prefetch=True):
+    self._close()
+    path = self._get_path(ifile)
+    if prefetch and self.cache is not None and ifile + 1 < len(self.files):
+      self.cache.prefetch([self.files[ifile + 1]])
+    self._file = root_open(path)
+    self._tree = self._file.Get(self.name)
+    for kwargs in self.collections:
+      self._tree.define_collection(**kwargs)
+    for args in self.branch_status:
+      self._tree.SetBranchStatus(*args)
+    return self._tree
+
+  def _close(self):
+    if self._file is not None:
+      self._file.Close()
+    self._file = None
+    self._tree = None
+
+  def get_file_entries(self, ifile):
+    # Returns the number of entries of a file. The file is not fetched: if it is
+    # not in the cache, only its metadata are read remotely (e.g. when resuming
+    # from a checkpoint in a later file).
+    if self.entries[ifile] is None:
+      path = self.files[ifile] if self.cache is None else self.cache.url(self.files[ifile])
+      with root_open(path) as f:
+        self.entries[ifile] = int(f.Get(self.name).GetEntries())
+    return self.entries[ifile]
+
+  def iter_range(self, start=0, stop=-1):
+    # Yields (entry, event) for the entries in [start, stop). The entry offsets
+    # are found from the number of entries of each file, so only the files that
+    # overlap the range are opened, and the first one is read from its local entry.
+    offset = 0
+    for ifile in xrange(len(self.files)):
+      if stop != -1 and offset >= stop:
+        break
+      nentries = self.get_file_entries(ifile)
+      if offset + nentries > start:
+        local_stop = nentries if stop == -1 else min(nentries, stop - offset)
+        tree = self._open(ifile, prefetch=(stop == -1 or offset + nentries < stop))
+        for (ientry, evt) in iter_tree_range(tree, max(start - offset, 0), local_stop):
+          yield (offset + ientry, evt)
+      offset += nentries
+    self._close()
+
+  def __iter__(self):
+    for (ievt, evt) in self.iter_range():
+      yield evt
+
+  def GetEntries(self):
+    # Does not fetch the files (see get_file_entries())
+    return sum(self.get_file_entries(ifile) for ifile in xrange(len(self.files)))
+
+  def __getattr__(self, attr):
+    # GetEntry(), GetReadEntry(), etc. of the current tree
+    tree = self.__dict__.get('_tree')
+    if tree is None:
+      raise AttributeError(attr)
+    return getattr(tree, attr)
+
+
+# ______________________________________________________________________________
+# Streaming outputs
+# - the output objects (particles, roads, aux tuples, ...) are converted into
+#   numpy arrays in chunks of output_chunk_size rows while the event loop runs,
+#   and each chunk is saved as .npy files in the directory <outfile>.chunks
+# - when the writer is closed, the chunks are copied into the usual npz file one
+#   array at a time through a memmap, so the memory stays bounded regardless of
+#   the number of events. If the job crashes, the chunks that were already
+#   written can still be read with ChunkedOutputReader.
+
+def load_chunk(path):
+  try:
+    return np.load(path, mmap_mode='r')
+  except ValueError:  # cannot mmap an empty array
+    return np.load(path)
+
+class ChunkedArray(object):
+  # The chunks of an output array, presented as one array
+  def __init__(self, chunks):
+    if not chunks:  # nothing has been flushed yet
+      chunks = [np.zeros(0, dtype=np.float64)]
+    if any(len(chunk) for chunk in chunks):
+      chunks = [chunk for chunk in chunks if len(chunk)]
+    self.chunks = chunks
+    assert(len(set(chunk.shape[1:] for chunk in chunks)) == 1)
+    self.dtype = np.result_type(*chunks)
+    self.shape = (sum(len(chunk) for chunk in chunks),) + chunks[0].shape[1:]
+    self.offsets = np.zeros(len(chunks)+1, dtype=np.int64)
+    np.cumsum([len(chunk) for chunk in chunks], out=self.offsets[1:])
+
+  def __len__(self):
+    return self.shape[0]
+
+  def __getitem__(self, key):
+    if isinstance(key, (int, long, np.integer)):
+      if key < 0:
+        key += len(self)
+      if not (0 <= key < len(self)):
+        raise IndexError('Index out of range: {0}'.format(key))
+      ichunk = np.searchsorted(self.offsets, key, side='right') - 1
+      return self.chunks[ichunk][key - self.offsets[ichunk]]
+    elif isinstance(key, slice) and key.step in (None, 1):
+      (start, stop, _) = key.indices(len(self))
+      parts = []
+      for ichunk, chunk in enumerate(self.chunks):
+        (begin, end) = self.offsets[ichunk:ichunk+2]
+        if begin < stop and start < end:
+          parts.append(chunk[max(start, begin) - begin:min(stop, end) - begin])
+      if not parts:
+        return np.zeros((0,) + self.shape[1:], dtype=self.dtype)
+      return np.concatenate(parts).astype(self.dtype, copy=False)
+    else:
+      return np.asarray(self)[key]
+
+  def __array__(self, dtype=None):
+    arr = np.concatenate(self.chunks).astype(self.dtype, copy=False)
+    if dtype is not None:
+      arr = arr.astype(dtype, copy=False)
+    return arr
+
+  def to_memmap(self, filename):
+    # Writes the array as a .npy file, and returns it as a memmap
+    if np.prod(self.shape) == 0:
+      np.save(filename, np.zeros(self.shape, dtype=self.dtype))
+      return np.load(filename)
+    out = np.lib.format.open_memmap(filename, mode='w+', dtype=self.dtype, shape=self.shape)
+    for ichunk, chunk in enumerate(self.chunks):
+      (begin, end) = self.offsets[ichunk:ichunk+2]
+      out[begin:end] = chunk
+    out.flush()
+    return out
+
+class ChunkedOutputReader(object):
+  def __init__(self, chunkdir):
+    import json
+    self.chunkdir = chunkdir
+    with open(os.path.join(chunkdir, 'meta.json')) as f:
+      meta = json.load(f)
+    self.names = [str(name) for name in meta['names']]
+    self.ragged = [str(name) for name in meta['ragged']]
+    self.nchunks = meta['nchunks']
+
+  def get_array_names(self):
+    # The ragged arrays are saved as <name>_values and <name>_row_splits
+    array_names = []
+    for name in self.names:
+      if name in self.ragged:
+        array_names += [name + '_values', name + '_row_splits']
+      else:
+        array_names.append(name)
+    return array_names
+
+  def __getitem__(self, array_name):
+    if array_name not in self.get_array_names():
+      raise KeyError(array_name)
+    chunks = [load_chunk(os.path.join(self.chunkdir, '%s.%i.npy' % (array_name, ichunk))) for ichunk in xrange(self.nchunks)]
+    if array_name.endswith('_row_splits') and array_name[:-len('_row_splits')] in self.ragged:
+      # Shift the row splits of each chunk by the number of values in the previous chunks
+      offset = 0
+      row_splits = [np.zeros(1, dtype=np.int64)]
+      for chunk in chunks:
+        row_splits.append(np.asarray(chunk[1:], dtype=np.int64) + offset)
+        offset += chunk[-1]
+      chunks = row_splits
+    return ChunkedArray(chunks)
+
+  def write_npz(self, outfile):
+    # Same as np.savez_compressed(), but only one array is in memory at a time (as a memmap)
+    import tempfile, zipfile
+    tmpfile = outfile + '.tmp'
+    zf = zipfile.ZipFile(tmpfile, mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+    try:
+      for array_name in self.get_array_names():
+        (fd, npyfile) = tempfile.mkstemp(suffix='.npy', dir=self.chunkdir)
+        os.close(fd)
+        arr = self[array_name].to_memmap(npyfile)
+        del arr
+        zf.write(npyfile, arcname=array_name + '.npy')
+        os.remove(npyfile)
+    finally:
+      zf.close()
+    os.rename(tmpfile, outfile)
+
+class ChunkedOutputWriter(object):
+  def __init__(self, outfile, converters, ragged=(), chunk_size=None):
+    # 'converters' is a list of (name, func), where func converts a list of
+    # output objects into a numpy array (or a RaggedTensorValue for the names
+    # in 'ragged')
+    import shutil
+    if chunk_size is None:
+      chunk_size = output_chunk_size
+    self.outfile = outfile
+    self.chunkdir = outfile + '.chunks'
+    self.converters = converters
+    self.ragged = ragged
+    self.chunk_size = chunk_size
+    self.nchunks = 0
+    self.nrows = 0
+    self.buffers = {name: [] for (name, func) in converters}
+    if os.path.isdir(self.chunkdir) and not resume:
+      shutil.rmtree(self.chunkdir)
+    if not os.path.isdir(self.chunkdir):
+      os.makedirs(self.chunkdir)
+    self._write_meta()
+
+  def _write_meta(self):
+    import json
+    tmpfile = os.path.join(self.chunkdir, 'meta.json.tmp')
+    with open(tmpfile, 'w') as f:
+      json.dump({'names': [name for (name, func) in self.converters], 'ragged': list(self.ragged), 'nchunks': self.nchunks}, f)
+    os.rename(tmpfile, os.path.join(self.chunkdir, 'meta.json'))
+
+  def append(self, **objects):
+    # Takes one output object for each name
+    assert(sorted(objects.keys()) == sorted(self.buffers.keys()))
+    for name, obj in objects.iteritems():
+      self.buffers[name].append(obj)
+    self.nrows += 1
+    if len(self.buffers[self.converters[0][0]]) >= self.chunk_size:
+      self.flush()
+
+  def extend(self, **objects):
+    # Takes a list of output objects for each name
+    assert(sorted(objects.keys()) == sorted(self.buffers.keys()))
+    nrows = set(len(lst) for lst in objects.itervalues())
+    assert(len(nrows) == 1)
+    for name, lst in objects.iteritems():
+      self.buffers[name].extend(lst)
+    self.nrows += nrows.pop()
+    if len(self.buffers[self.converters[0][0]]) >= self.chunk_size:
+      self.flush()
+
+  def flush(self):
+    for (name, func) in self.converters:
+      arr = func(self.buffers[name])
+      if name in self.ragged:
+        np.save(os.path.join(self.chunkdir, '%s_values.%i.npy' % (name, self.nchunks)), arr.values)
+        np.save(os.path.join(self.chunkdir, '%s_row_splits.%i.npy' % (name, self.nchunks)), arr.row_splits)
+      else:
+        np.save(os.path.join(self.chunkdir, '%s.%i.npy' % (name, self.nchunks)), arr)
+      del self.buffers[name][:]
+    self.nchunks += 1
+    self._write_meta()
+
+  def save_checkpoint(self, prefix):
+    # Only the rows since the last flush are saved, as a new chunk
+    if len(self.buffers[self.converters[0][0]]) > 0:
+      self.flush()
+    return {'nchunks': self.nchunks, 'nrows': self.nrows}
+
+  def load_checkpoint(self, prefix, meta):
+    # The chunks after the checkpoint (if any) are overwritten by the next flushes
+    self.nchunks = meta['nchunks']
+    self.nrows = meta['nrows']
+    for name in self.buffers:
+      del self.buffers[name][:]
+    self._write_meta()
+
+  def close(self):
+    import shutil
+    if self.nchunks == 0 or len(self.buffers[self.converters[0][0]]) > 0:
+      self.flush()
+    ChunkedOutputReader(self.chunkdir).write_npz(self.outfile)
+    shutil.rmtree(self.chunkdir)
+
+
+# ______________________________________________________________________________
+# Checkpoints
+# - the analyses save their accumulated state (histogram banks, output writers,
+#   track collectors and a few counters) every checkpoint_events events and/or
+#   checkpoint_seconds seconds, together with the index of the next event to
+#   process. With --resume, the state is restored from <checkpoint_dir>/<name>
+#   and the event loop continues from that event.
+# - the checkpoints are incremental: the output writers only flush the rows
+#   added since the last checkpoint as a new chunk, and the track collectors
+#   only save the events added since the last checkpoint. The histogram banks
+#   have a fixed size and are saved in full.
+# - the state file is written last (and atomically), so a crash while saving
+#   leaves the previous checkpoint valid.
+
+def make_checkpoint_name(name):
+  name = '%s_%i' % (name, jobid)
+  if shard_id != -1:
+    name = '%s_shard%i' % (name, shard_id)
+  return name
+
+class Checkpoint(object):
+  def __init__(self, name, objects, every_events=None, every_seconds=None):
+    # 'objects' is a list of (name, obj), where obj implements save_checkpoint(prefix)
+    # and load_checkpoint(prefix, meta)
+    import time
+    if every_events is None:
+      every_events = checkpoint_events
+    if every_seconds is None:
+      every_seconds = checkpoint_seconds
+    self.dirname = os.path.join(checkpoint_dir, make_checkpoint_name(name))
+    self.objects = objects
+    self.every_events = every_events
+    self.every_seconds = every_seconds
+    self.enabled = (every_events > 0 or every_seconds > 0)
+    self.next_entry = 0  # the state includes all the events before this one
+    self.last_entry = None
+    self.last_time = time.time()
+
+  def restore(self):
+    # Returns the saved counters, or an empty dict if not resuming
+    import json
+    statefile = os.path.join(self.dirname, 'state.json')
+    if not (resume and os.path.isfile(statefile)):
+      return {}
+    with open(statefile) as f:
+      state = json.load(f)
+    for (name, obj) in self.objects:
+      obj.load_checkpoint(os.path.join(self.dirname, name), state['objects'][name])
+    self.next_entry = self.last_entry = state['next_entry']
+    print('[INFO] Resuming from checkpoint: %s at entry %i' % (self.dirname, self.next_entry))
+    return {str(k): v for (k, v) in state['values'].iteritems()}
+
+  def is_due(self, ievt):
+    import time
+    if not self.enabled:
+      return False
+    if self.last_entry is None:
+      self.last_entry = ievt
+    if self.every_events > 0 and (ievt - self.last_entry) >= self.every_events:
+      return True
+    if self.every_seconds > 0 and (time.time() - self.last_time) >= self.every_seconds:
+      return True
+    return False
+
+  def save(self, ievt, **values):
+    # Saves the state, which must include all the events before ievt
+    import json, time
+    t0 = time.time()
+    if not os.path.isdir(self.dirname):
+      os.makedirs(self.dirname)
+    state = {'next_entry': ievt, 'values': values, 'objects': {}}
+    for (name, obj) in self.objects:
+      state['objects'][name] = obj.save_checkpoint(os.path.join(self.dirname, name))
+    tmpfile = os.path.join(self.dirname, 'state.json.tmp')
+    with open(tmpfile, 'w') as f:
+      json.dump(state, f)
+    os.rename(tmpfile, os.path.join(self.dirname, 'state.json'))
+    self.next_entry = self.last_entry = ievt
+    self.last_time = time.time()
+    print('[INFO] Saved checkpoint at entry %i (%.2f s)' % (ievt, self.last_time - t0))
+
+  def close(self):
+    # Removes the checkpoint, once the outputs are written
+    import shutil
+    if os.path.isdir(self.dirname):
+      shutil.rmtree(self.dirname)
+
+
+# ______________________________________________________________________________
+# Timing instrumentation
+# - with --timing (or TIMING=1), the run methods of the emulator stages
+#   (PatternRecognition, RoadCleaning, ...) are wrapped with monotonic timers
+#   when the analysis makes its workers (see instrument_stages()). When timing
+#   is disabled, the workers are left unchanged.
+# - enumerate_events() marks the start of each event and counts its legit hits.
+#   The time of each stage is accumulated per event, and the per-event latency
+#   (the sum of the stages) is histogrammed in bins of the number of legit hits.
+#   With the buffered pT assignment (rates), the stages after the buffer are
+#   counted in the event that flushes it.
+# - a json summary is written at the end of the job (timing.json), and the
+#   summaries of the shards are merged by the event-parallel driver.
+
+def make_monotonic_clock():
+  # Returns a monotonic clock in seconds (time.monotonic() is only in python 3)
+  import time
+  if hasattr(time, 'monotonic'):
+    return time.monotonic
+  try:
+    import ctypes, ctypes.util
+    class timespec(ctypes.Structure):
+      _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'))
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    ts = timespec()
+    CLOCK_MONOTONIC = 1
+    def monotonic():
+      clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+      return ts.tv_sec + ts.tv_nsec * 1e-9
+    monotonic()
+    return monotonic
+  except (OSError, AttributeError):
+    print('[WARNING] Cannot find a monotonic clock, using time.time()')
+    return time.time
+
+class StageTimer(object):
+  # Methods that are timed for each stage (given by the class name)
+  stage_methods = [
+    ('PatternRecognition', ('run', 'prepare', 'run_prepared')),
+    ('RoadCleaning', ('run',)),
+    ('RoadSlimming', ('run',)),
+    ('PtAssignment', ('run', 'run_many')),
+    ('TrackProducer', ('run',)),
+    ('GhostBusting', ('run',)),
+    ('TrackMuonCorrelation', ('run',)),
+  ]
+
+  # Lower edges of the bins of the number of legit hits
+  nhits_edges = [0, 10, 20, 50, 100, 200, 500, 1000, 2000]
+
+  # Edges of the latency bins in seconds (10 us to 10 s), plus underflow and overflow
+  latency_edges = (10. ** np.arange(-5., 1.01, 0.125)).tolist()
+
+  def __init__(self, info=None):
+    self.clock = make_monotonic_clock()
+    self.info = info or {}
+    self.stages = [stage for (stage, methods) in self.stage_methods]
+    self.total = {stage: 0. for stage in self.stages}
+    self.ncalls = {stage: 0 for stage in self.stages}
+    self.active = set()  # stages being timed, to skip the nested calls
+    self.event_nhits = None
+    self.event_times = {}
+    self.start_time = None
+    self.stop_time = None
+    self.nevents = 0
+    self.nevents_by_nhits = np.zeros(len(self.nhits_edges), dtype=np.int64)
+    self.latency_counts = np.zeros((len(self.nhits_edges), len(self.latency_edges)+1), dtype=np.int64)
+    self.latency_sum = np.zeros(len(self.nhits_edges), dtype=np.float64)
+    self.stage_sum_by_nhits = {stage: np.zeros(len(self.nhits_edges), dtype=np.float64) for stage in self.stages}
+
+  def instrument(self, worker):
+    stage = type(worker).__name__
+    methods = dict(self.stage_methods).get(stage)
+    if methods is None:
+      raise RuntimeError('Cannot time stage: {0}'.format(stage))
+    for method in methods:
+      setattr(worker, method, self._wrap(stage, getattr(worker, method)))
+    return worker
+
+  def _wrap(self, stage, func):
+    clock = self.clock
+    def timed(*args, **kwargs):
+      if stage in self.active:  # e.g. PtAssignment.run_many() calls run()
+        return func(*args, **kwargs)
+      self.active.add(stage)
+      t0 = clock()
+      try:
+        return func(*args, **kwargs)
+      finally:
+        dt = clock() - t0
+        self.active.discard(stage)
+        self.total[stage] += dt
+        self.ncalls[stage] += 1
+        self.event_times[stage] = self.event_times.get(stage, 0.) + dt
+    return timed
+
+  def begin_event(self, evt):
+    nhits = sum(1 for hit in evt.hits if is_emtf_legit_hit(hit))
+    self.end_event()
+    if self.start_time is None:
+      self.start_time = self.clock()
+    self.event_nhits = nhits
+
+  def end_event(self):
+    if self.event_nhits is None:
+      return
+    i = bisect.bisect_right(self.nhits_edges, self.event_nhits) - 1
+    latency = sum(self.event_times.itervalues())
+    j = bisect.bisect_right(self.latency_edges, latency)
+    self.nevents += 1
+    self.nevents_by_nhits[i] += 1
+    self.latency_counts[i, j] += 1
+    self.latency_sum[i] += latency
+    for (stage, dt) in self.event_times.iteritems():
+      self.stage_sum_by_nhits[stage][i] += dt
+    self.event_times.clear()
+    self.event_nhits = None
+    self.stop_time = self.clock()
+
+  def summary(self):
+    self.end_event()
+    wall_time = (self.stop_time - self.start_time) if self.nevents else 0.
+    summary = dict(self.info)
+    summary.update({
+      'nevents': self.nevents,
+      'wall_time': wall_time,
+      'events_per_second': (self.nevents / wall_time) if wall_time > 0. else 0.,
+      'stages': {},
+      'nhits_edges': self.nhits_edges,
+      'latency_edges': self.latency_edges,
+      'nevents_by_nhits': self.nevents_by_nhits.tolist(),
+      'latency_counts': self.latency_counts.tolist(),
+      'latency_sum': self.latency_sum.tolist(),
+    })
+    for stage in self.stages:
+      summary['stages'][stage] = {
+        'total': self.total[stage],
+        'ncalls': self.ncalls[stage],
+        'per_event': (self.total[stage] / self.nevents) if self.nevents else 0.,
+        'sum_by_nhits': self.stage_sum_by_nhits[stage].tolist(),
+      }
+    return summary
+
+  def write(self, outfile):
+    import json
+    print('[INFO] Creating file: %s' % outfile)
+    with open(outfile, 'w') as f:
+      json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+def start_stage_timer():
+  global stage_timer
+  import platform
+  stage_timer = StageTimer(info={'analysis': str(analysis), 'algo': algo, 'jobid': jobid, 'shard_id': shard_id,
+                                 'host': platform.node(), 'nn_backend': nn_backend})
+
+def instrument_stages(*workers):
+  # Times the run methods of the workers if timing is enabled
+  if stage_timer is not None:
+    for worker in workers:
+      stage_timer.instrument(worker)
+
+def save_stage_timer():
+  if stage_timer is None:
+    return
+  outfile = 'timing.json'
+  if use_condor:
+    outfile = 'timing_%i.json' % jobid
+  outfile = make_shard_outfile(outfile)
+  stage_timer.write(outfile)
+
+def merge_timing_files(infiles, outfile):
+  # Sums the timing summaries of the shards. The wall time is the longest one,
+  # as the shards run at the same time.
+  import json
+  print('[INFO] Creating file: %s' % outfile)
+  merged = None
+  for infile in infiles:
+    with open(infile) as f:
+      summary = json.load(f)
+    if merged is None:
+      merged = summary
+      merged['shard_id'] = -1
+      continue
+    merged['nevents'] += summary['nevents']
+    merged['wall_time'] = max(merged['wall_time'], summary['wall_time'])
+    for k in ('nevents_by_nhits', 'latency_counts', 'latency_sum'):
+      merged[k] = (np.asarray(merged[k]) + np.asarray(summary[k])).tolist()
+    for (stage, timing) in summary['stages'].iteritems():
+      merged_timing = merged['stages'][stage]
+      merged_timing['total'] += timing['total']
+      merged_timing['ncalls'] += timing['ncalls']
+      merged_timing['sum_by_nhits'] = (np.asarray(merged_timing['sum_by_nhits']) + np.asarray(timing['sum_by_nhits'])).tolist()
+  nevents = merged['nevents']
+  merged['events_per_second'] = (nevents / merged['wall_time']) if merged['wall_time'] > 0. else 0.
+  for timing in merged['stages'].itervalues():
+    timing['per_event'] = (timing['total'] / nevents) if nevents else 0.
+  with open(outfile, 'w') as f:
+    json.dump(merged, f, indent=2, sort_keys=True)
+
+
+# ______________________________________________________________________________
+# Event-parallel driver
+# - shards the tree by entry ranges across a multiprocessing pool. Each worker
+#   runs the full analysis on its range (building its own PatternBank,
+#   PtAssignment, etc. once) and writes its own output files.
+# - the outputs are then merged in the shard order: histograms are summed and
+#   npz arrays are concatenated.
+
+def iter_tree_range(tree, start=0, stop=-1):
+  # Yields (entry, event) for the entries of a single tree in [start, stop). The
+  # entries are read with GetEntry(), so the entries before 'start' are not read.
+  nentries = tree.GetEntries()
+  if stop != -1:
+    nentries = min(nentries, stop)
+  for ievt in xrange(start, nentries):
+    tree.GetEntry(ievt)
+    yield (ievt, tree)
+
+def enumerate_events(tree, start=0):
+  # Same as enumerate(tree), but only yields the events in [entry_start, entry_stop),
+  # and not before 'start' (e.g. when resuming from a checkpoint). The first event
+  # is read directly: the chains find the file that contains it from the number
+  # of entries of each file (see CachedTreeChain.iter_range()).
+  start = max(start, entry_start)
+  if isinstance(tree, CachedTreeChain):
+    events = tree.iter_range(start, entry_stop)
+  else:
+    events = iter_tree_range(tree, start, entry_stop)
+  for ievt, evt in events:
+    if stage_timer is not None:
+      stage_timer.begin_event(evt)
+    yield (ievt, evt)
+
+shard_outfiles = []  # output files written by the current shard
+
+def make_shard_outfile(outfile, shard_ext=None):
+  if shard_id == -1:
+    shard_outfiles.append((outfile, outfile))
+    return outfile
+  (root, ext) = os.path.splitext(outfile)
+  if shard_ext is not None:
+    ext = shard_ext
+  shard_outfile = '%s_shard%i%s' % (root, shard_id, ext)
+  shard_outfiles.append((outfile, shard_outfile))
+  return shard_outfile
+
+def save_histogram_bank(histograms, outfile):
+  # The shards save the histogram bank as a npz file, so that the merging is
+  # only an array add. The ROOT file is written after the merging.
+  if shard_id == -1:
+    shard_outfiles.append((outfile, outfile))
+    print('[INFO] Creating file: %s' % outfile)
+    histograms.write(outfile)
+  else:
+    outfile = make_shard_outfile(outfile, shard_ext='.npz')
+    print('[INFO] Creating file: %s' % outfile)
+    histograms.savez(outfile)
+
+def make_analysis(analysis):
+  # Returns the analysis object and its extra arguments
+  if analysis == 'dummy':
+    return (DummyAnalysis(), {})
+  elif analysis == 'converters':
+    return (ConvertersAnalysis(), {})
+  elif analysis == 'roads':
+    return (RoadsAnalysis(), {})
+  elif analysis == 'rates':
+    return (RatesAnalysis(), {'pileup': 200})
+  elif analysis == 'rates140':
+    return (RatesAnalysis(), {'pileup': 140})
+  elif analysis == 'rates250':
+    return (RatesAnalysis(), {'pileup': 250})
+  elif analysis == 'rates300':
+    return (RatesAnalysis(), {'pileup': 300})
+  elif analysis == 'effie':
+    return (EffieAnalysis(), {})
+  elif analysis == 'mixing':
+    return (MixingAnalysis(), {})
+  elif analysis == 'collusion':
+    return (CollusionAnalysis(), {})
+  elif analysis == 'images':
+    return (ImagesAnalysis(), {})
+  elif analysis == 'parallel':
+    return (ParallelCheckAnalysis(), {})
+  else:
+    raise RuntimeError('Cannot recognize analysis: {0}'.format(analysis))
+
+def load_analysis_tree(analysis, omtf_input=False):
+  # Same trees as used in the analyses
+  if analysis in ('roads', 'effie'):
+    if omtf_input:
+      return load_pgun_batch_omtf(jobid)
+    else:
+      return load_pgun_batch(jobid)
+  elif analysis.startswith('rates'):
+    (_, extra_kwargs) = make_analysis(analysis)
+    return load_minbias_batch(jobid, pileup=extra_kwargs['pileup'])
+  elif analysis == 'mixing':
+    return load_minbias_batch_for_mixing(jobid)
+  else:
+    raise RuntimeError('Cannot run analysis in parallel: {0}'.format(analysis))
+
+def run_shard(args):
+  (ishard, start, stop, analysis, omtf_input, run2_input) = args
+  global entry_start, entry_stop, shard_id
+  entry_start, entry_stop, shard_id = start, stop, ishard
+  del shard_outfiles[:]
+  if timing:
+    start_stage_timer()
+  (myanalysis, extra_kwargs) = make_analysis(analysis)
+  counters = myanalysis.run(omtf_input=omtf_input, run2_input=run2_input, **extra_kwargs)
+  save_stage_timer()
+  return (list(shard_outfiles), counters)
+
+def merge_root_files(infiles, outfile):
+  print('[INFO] Creating file: %s' % outfile)
+  hnames = []
+  histograms = {}
+  for infile in infiles:
+    with root_open(infile) as f:
+      for key in f.GetListOfKeys():
+        hname = key.GetName()
+        h = key.ReadObj()
+        if hname not in histograms:
+          hnames.append(hname)
+          histograms[hname] = h.Clone(hname)
+        else:
+          histograms[hname].Add(h)
+  with root_open(outfile, 'recreate') as f:
+    for hname in hnames:
+      h = histograms[hname]
+      h.Write()
+
+def merge_histogram_banks(infiles, outfile):
+  print('[INFO] Creating file: %s' % outfile)
+  histograms = None
+  for infile in infiles:
+    if histograms is None:
+      histograms = HistogramBank.loadz(infile)
+    else:
+      histograms.add(HistogramBank.loadz(infile))
+  histograms.write(outfile)
+
+def merge_npz_files(infiles, outfile):
+  print('[INFO] Creating file: %s' % outfile)
+  arrays = {}
+  for infile in infiles:
+    with np.load(infile) as data:
+      for k in data.files:
+        arrays.setdefault(k, []).append(data[k])
+  arrays = {k: np.concatenate(v) for (k, v) in arrays.iteritems()}
+  np.savez_compressed(outfile, **arrays)
+
+def run_parallel(analysis, omtf_input=False, run2_input=False, nprocesses=nprocesses, stop=-1):
+  # Returns the merged output files. Only the entries before 'stop' are used (default: all).
+  import multiprocessing
+
+  # Find the entry ranges
+  tree = load_analysis_tree(analysis, omtf_input=omtf_input)
+  nentries = tree.GetEntries()
+  unload_tree()
+  if stop != -1:
+    nentries = min(nentries, stop)
+  bounds = np.linspace(0, nentries, nprocesses+1).astype(np.int64)
+  print('[INFO] Using {0} processes for {1} events'.format(nprocesses, nentries))
+
+  # Run the shards
+  tasks = [(ishard, int(bounds[ishard]), int(bounds[ishard+1]), analysis, omtf_input, run2_input)
+           for ishard in xrange(nprocesses)]
+  pool = multiprocessing.Pool(processes=nprocesses)
+  try:
+    results = pool.map(run_shard, tasks, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+
+  # Report the counters summed over the shards
+  (myanalysis, extra_kwargs) = make_analysis(analysis)
+  if hasattr(myanalysis, 'report'):
+    counters = {}
+    for (_, shard_counters) in results:
+      for (k, v) in shard_counters.iteritems():
+        counters[k] = counters.get(k, 0) + v
+    print('[INFO] Total of {0} shards:'.format(len(results)))
+    myanalysis.report(counters)
+
+  # Merge the outputs in the shard order
+  amap = {}  # outfile -> shard outfiles
+  outfiles = []
+  for (result, _) in results:
+    for (outfile, shard_outfile) in result:
+      if outfile not in amap:
+        outfiles.append(outfile)
+      amap.setdefault(outfile, []).append(shard_outfile)
+  for outfile in outfiles:
+    infiles = amap[outfile]
+    if outfile.endswith('.root') and all(infile.endswith('.npz') for infile in infiles):
+      merge_histogram_banks(infiles, outfile)
+    elif outfile.endswith('.root'):
+      merge_root_files(infiles, outfile)
+    elif outfile.endswith('.npz'):
+      merge_npz_files(infiles, outfile)
+    elif outfile.endswith('.json'):
+      merge_timing_files(infiles, outfile)
+    else:
+      raise RuntimeError('Cannot merge file: {0}'.format(outfile))
+    for infile in infiles:
+      os.remove(infile)
+  return outfiles
+
+def compare_output_files(infile1, infile2):
+  # Compares the npz arrays or the ROOT histograms of two output files. Returns
+  # the number of mismatched values of each array or histogram. The histogram
+  # sums can differ in the last bits, as they are added in a different order.
+  nmismatched = []
+  if infile1.endswith('.npz'):
+    with np.load(infile1) as data1, np.load(infile2) as data2:
+      assert(sorted(data1.files) == sorted(data2.files))
+      for k in sorted(data1.files):
+        (a, b) = (data1[k], data2[k])
+        if a.shape != b.shape:
+          nmismatched.append((k, max(a.size, b.size)))
+          continue
+        same = (a == b)
+        if a.dtype.kind == 'f':
+          same |= (np.isnan(a) & np.isnan(b))
+        nmismatched.append((k, np.count_nonzero(~same)))
+  elif infile1.endswith('.root'):
+    def get_contents(h):
+      return np.array([(h.GetBinContent(i), h.GetBinError(i)) for i in xrange(h.GetSize())])
+    with root_open(infile1) as f1, root_open(infile2) as f2:
+      for key in f1.GetListOfKeys():
+        hname = key.GetName()
+        (h1, h2) = (key.ReadObj(), f2.Get(hname))
+        (a, b) = (get_contents(h1), get_contents(h2))
+        if a.shape != b.shape:
+          nmismatched.append((hname, max(a.size, b.size)))
+          continue
+        nmismatched.append((hname, np.count_nonzero(~np.isclose(a, b, rtol=1e-12, atol=0.))))
+  return nmismatched
+
+class ParallelCheckAnalysis(object):
+  def run(self, omtf_input=False, run2_input=False):
+    # Check that the event-parallel driver gives the same outputs as the sequential
+    # run. The analysis (parallel_check_analysis) is run on the first maxEvents
+    # events, first sequentially, then with nprocesses processes (4 if not set),
+    # and the npz arrays and histograms of the output files are compared. The
+    # outputs of the sequential run are kept with the '_sequential' suffix.
+    global entry_start, entry_stop
+    checked_nprocesses = nprocesses if nprocesses > 1 else 4
+    (myanalysis, extra_kwargs) = make_analysis(parallel_check_analysis)
+
+    # Sequential run
+    entry_start, entry_stop = 0, maxEvents
+    del shard_outfiles[:]
+    myanalysis.run(omtf_input=omtf_input, run2_input=run2_input, **extra_kwargs)
+    sequential_outfiles = {}
+    for (outfile, _) in shard_outfiles:
+      (root, ext) = os.path.splitext(outfile)
+      sequential_outfiles[outfile] = '%s_sequential%s' % (root, ext)
+      os.rename(outfile, sequential_outfiles[outfile])
+
+    # Parallel run
+    entry_start, entry_stop = 0, -1
+    outfiles = run_parallel(parallel_check_analysis, omtf_input=omtf_input, run2_input=run2_input,
+                            nprocesses=checked_nprocesses, stop=maxEvents)
+    assert(sorted(outfiles) == sorted(sequential_outfiles.keys()))
+
+    nmismatched = 0
+    for outfile in sorted(outfiles):
+      if outfile.endswith('.json'):  # timing summaries
+        continue
+      for (name, n) in compare_output_files(sequential_outfiles[outfile], outfile):
+        print('[INFO] {0}: {1}: {2} mismatched values'.format(outfile, name, n))
+        nmismatched += n
+    assert(nmismatched == 0)
+
+
 # ______________________________________________________________________________
 # Main
 
@@ -3064,6 +5435,9 @@ if __name__ == "__main__":
   print('[INFO] Using algo      : {0}'.format(algo))
   print('[INFO] Using analysis  : {0}'.format(analysis))
   print('[INFO] Using job id    : {0}'.format(jobid))
+  print('[INFO] Using processes : {0}'.format(nprocesses))
+  print('[INFO] Using resume    : {0}'.format(resume))
+  print('[INFO] Using timing    : {0}'.format(timing))
 
   if algo == 'run3':
     run2_input = True
@@ -3075,42 +5449,13 @@ if __name__ == "__main__":
   else:
     omtf_input = False
 
-  if analysis == 'dummy':
-    analysis = DummyAnalysis()
-    analysis.run(omtf_input=omtf_input, run2_input=run2_input)
-
-  elif analysis == 'roads':
-    analysis = RoadsAnalysis()
-    analysis.run(omtf_input=omtf_input, run2_input=run2_input)
-
-  elif analysis == 'rates':
-    analysis = RatesAnalysis()
-    analysis.run(omtf_input=omtf_input, run2_input=run2_input, pileup=200)
-  elif analysis == 'rates140':
-    analysis = RatesAnalysis()
-    analysis.run(omtf_input=omtf_input, run2_input=run2_input, pileup=140)
-  elif analysis == 'rates250':
-    analysis = RatesAnalysis()
-    analysis.run(omtf_input=omtf_input, run2_input=run2_input, pileup=250)
-  elif analysis == 'rates300':
-    analysis = RatesAnalysis()
-    analysis.run(omtf_input=omtf_input, run2_input=run2_input, pileup=300)
-
-  elif analysis == 'effie':
-    analysis = EffieAnalysis()
-    analysis.run(omtf_input=omtf_input, run2_input=run2_input)
-
-  elif analysis == 'mixing':
-    analysis = MixingAnalysis()
-    analysis.run(omtf_input=omtf_input, run2_input=run2_input)
-
-  elif analysis == 'collusion':
-    analysis = CollusionAnalysis()
-    analysis.run(omtf_input=omtf_input, run2_input=run2_input)
-
-  elif analysis == 'images':
-    analysis = ImagesAnalysis()
-    analysis.run(omtf_input=omtf_input, run2_input=run2_input)
+  if timing and nprocesses <= 1:
+    start_stage_timer()
 
+  if nprocesses > 1 and analysis != 'parallel':
+    run_parallel(analysis, omtf_input=omtf_input, run2_input=run2_input, nprocesses=nprocesses)
   else:
-    raise RunTimeError('Cannot recognize analysis: {0}'.format(analysis))
+    (myanalysis, extra_kwargs) = make_analysis(analysis)
+    myanalysis.run(omtf_input=omtf_input, run2_input=run2_input, **extra_kwargs)
+
+  save_stage_timer()
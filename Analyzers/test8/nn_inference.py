@@ -0,0 +1,281 @@
+import numpy as np
+
+
+# ______________________________________________________________________________
+# Activations
+def sigmoid(x):
+  return 1. / (1. + np.exp(-x))
+
+def linear(x):
+  return x
+
+activations = {
+  'linear': linear,
+  'tanh': np.tanh,
+  'NewTanh': np.tanh,  # see nn_models.NewTanh
+  'sigmoid': sigmoid,
+  'relu': lambda x: np.maximum(x, 0.),
+}
+
+# ______________________________________________________________________________
+# Fold the BatchNormalization layers into the Dense layers
+#
+# At inference time, BatchNormalization is an affine transform y = x * s + t,
+# with s = gamma / sqrt(moving_variance + epsilon) and t = beta - moving_mean * s.
+# - BN after a Dense layer:  W' = W * s,          b' = b * s + t
+# - BN before a Dense layer: W' = s[:,None] * W,  b' = b + t.dot(W)
+#
+# 'layers' is a list of (class_name, config, weights) in the Keras model order,
+# e.g. create_model_bn2(): BN -> (Dense -> BN -> tanh) x 3 -> regr, discr.
+# The output layers (given by 'output_names') are Dense layers that all take the
+# output of the last hidden layer. Returns the list of hidden layers and the
+# list of output layers, each as (kernel, bias, activation).
+def fold_batch_normalization(layers, output_names):
+
+  def get_bn_affine(config, weights):
+    weights = list(weights)
+    gamma = weights.pop(0) if config.get('scale', True) else 1.
+    beta = weights.pop(0) if config.get('center', True) else 0.
+    moving_mean, moving_variance = weights
+    s = gamma / np.sqrt(moving_variance + config['epsilon'])
+    t = beta - moving_mean * s
+    return (s.astype(np.float64), t.astype(np.float64))
+
+  def get_dense(config, weights):
+    kernel = weights[0].astype(np.float64)
+    if config.get('use_bias', True):
+      bias = weights[1].astype(np.float64)
+    else:
+      bias = np.zeros(kernel.shape[1], dtype=np.float64)
+    return (kernel, bias)
+
+  hidden_layers = []
+  output_layers = []
+
+  pending_affine = None  # BN waiting for the next Dense layer
+  current = None         # Dense layer waiting for its activation
+
+  for (class_name, config, weights) in layers:
+    if class_name == 'InputLayer':
+      continue
+
+    elif class_name == 'BatchNormalization':
+      (s, t) = get_bn_affine(config, weights)
+      if current is not None:
+        (kernel, bias) = current
+        current = (kernel * s, bias * s + t)
+      elif pending_affine is not None:
+        (s0, t0) = pending_affine
+        pending_affine = (s0 * s, t0 * s + t)
+      else:
+        pending_affine = (s, t)
+
+    elif class_name == 'Dense':
+      (kernel, bias) = get_dense(config, weights)
+      if pending_affine is not None:
+        (s, t) = pending_affine
+        (kernel, bias) = (s[:, np.newaxis] * kernel, bias + t.dot(kernel))
+      activation = config.get('activation', 'linear')
+
+      if config['name'] in output_names:
+        output_layers.append((config['name'], kernel, bias, activation))
+      else:
+        if current is not None:
+          raise Exception('Cannot fold two consecutive Dense layers')
+        pending_affine = None
+        current = (kernel, bias)
+        if activation != 'linear':
+          hidden_layers.append(current + (activation,))
+          current = None
+
+    elif class_name == 'Activation':
+      if current is None:
+        raise Exception('Cannot fold Activation without a Dense layer')
+      hidden_layers.append(current + (config['activation'],))
+      current = None
+
+    elif class_name == 'Dropout':
+      continue
+
+    else:
+      raise Exception('Cannot fold layer: {0}'.format(class_name))
+
+  if current is not None:
+    hidden_layers.append(current + ('linear',))
+
+  # Keep the order of the model outputs
+  output_layers.sort(key=lambda x: output_names.index(x[0]))
+  output_layers = [x[1:] for x in output_layers]
+  return (hidden_layers, output_layers)
+
+# ______________________________________________________________________________
+# Save/Load the folded weights
+def save_folded_weights(hidden_layers, output_layers, name='model_folded.npz'):
+  arrays = {}
+  for i, (kernel, bias, activation) in enumerate(hidden_layers):
+    arrays['kernel_%i' % i] = kernel.astype(np.float32)
+    arrays['bias_%i' % i] = bias.astype(np.float32)
+    arrays['activation_%i' % i] = np.array(activation)
+  for i, (kernel, bias, activation) in enumerate(output_layers):
+    arrays['output_kernel_%i' % i] = kernel.astype(np.float32)
+    arrays['output_bias_%i' % i] = bias.astype(np.float32)
+    arrays['output_activation_%i' % i] = np.array(activation)
+  arrays['nlayers'] = np.array(len(hidden_layers))
+  arrays['noutputs'] = np.array(len(output_layers))
+  np.savez_compressed(name, **arrays)
+  return
+
+def load_folded_weights(name='model_folded.npz'):
+  with np.load(name) as data:
+    hidden_layers = []
+    for i in xrange(int(data['nlayers'])):
+      hidden_layers.append((data['kernel_%i' % i], data['bias_%i' % i], str(data['activation_%i' % i])))
+    output_layers = []
+    for i in xrange(int(data['noutputs'])):
+      output_layers.append((data['output_kernel_%i' % i], data['output_bias_%i' % i], str(data['output_activation_%i' % i])))
+  return (hidden_layers, output_layers)
+
+# ______________________________________________________________________________
+# Inference with NumPy
+# - mimics keras.models.Model.predict(), returns a list of arrays with shape (n, 1)
+class NumpyModel(object):
+  def __init__(self, hidden_layers, output_layers):
+    self.hidden_layers = [(kernel.astype(np.float32), bias.astype(np.float32), activations[activation])
+                          for (kernel, bias, activation) in hidden_layers]
+    # The output layers are merged into one matrix
+    self.output_kernel = np.hstack([kernel for (kernel, bias, activation) in output_layers]).astype(np.float32)
+    self.output_bias = np.hstack([bias for (kernel, bias, activation) in output_layers]).astype(np.float32)
+    self.output_activations = [activations[activation] for (kernel, bias, activation) in output_layers]
+    self.output_splits = np.cumsum([0] + [kernel.shape[1] for (kernel, bias, activation) in output_layers])
+
+  def predict(self, x):
+    x = np.asarray(x, dtype=np.float32)
+    for (kernel, bias, activation) in self.hidden_layers:
+      x = activation(x.dot(kernel) + bias)
+    x = x.dot(self.output_kernel) + self.output_bias
+    y = []
+    for i, activation in enumerate(self.output_activations):
+      y.append(activation(x[:, self.output_splits[i]:self.output_splits[i+1]]))
+    return y
+
+def load_my_numpy_model(name='model_folded.npz'):
+  (hidden_layers, output_layers) = load_folded_weights(name)
+  return NumpyModel(hidden_layers, output_layers)
+
+# ______________________________________________________________________________
+# Fixed-point inference
+# - emulates the firmware arithmetic with integer matrices, using the folded
+#   weights (see fold_batch_normalization()).
+# - a fixed-point type is given as (bits, int_bits), including the sign bit,
+#   like ap_fixed<bits, int_bits>. The number of fractional bits is (bits - int_bits).
+# - tanh and sigmoid are implemented as LUTs, indexed by the pre-activation value.
+# - the values that overflow a fixed-point type are saturated, and counted for each layer.
+class QuantizedModel(object):
+  def __init__(self, hidden_layers, output_layers, input_type=(16,11), weight_bits=8,
+               preact_type=(16,6), act_type=(16,1), output_type=(16,8),
+               lut_bits=10, lut_range=8.):
+    if not (2 <= weight_bits <= 32):
+      raise Exception('Cannot quantize the weights with {0} bits'.format(weight_bits))
+    self.input_type = input_type
+    self.weight_bits = weight_bits
+    self.preact_type = preact_type
+    self.act_type = act_type
+    self.output_type = output_type
+    self.lut_bits = lut_bits
+    self.lut_range = lut_range
+
+    # Quantize the weights
+    self.hidden_layers = [self._quantize_layer(kernel, bias, activation) for (kernel, bias, activation) in hidden_layers]
+    self.output_layers = [self._quantize_layer(kernel, bias, activation) for (kernel, bias, activation) in output_layers]
+
+    # Activation LUTs, covering [-lut_range, lut_range)
+    nbins = (1 << self.lut_bits)
+    self.lut_step = (2. * self.lut_range) / nbins
+    lut_x = -self.lut_range + (np.arange(nbins) + 0.5) * self.lut_step  # bin centers
+    self.luts = {
+      'tanh': self._quantize_lut(np.tanh(lut_x), self.act_type),
+      'NewTanh': self._quantize_lut(np.tanh(lut_x), self.act_type),  # see nn_models.NewTanh
+      'sigmoid': self._quantize_lut(sigmoid(lut_x), self.act_type),
+    }
+
+    # Saturation counts for 'input', 'layer_0', ..., 'output_0', ...
+    self.saturation_names = ['input'] + ['layer_%i' % i for i in xrange(len(self.hidden_layers))] + \
+        ['output_%i' % i for i in xrange(len(self.output_layers))]
+    self.reset_saturation_counts()
+
+  def _quantize_layer(self, kernel, bias, activation):
+    # Use a power-of-two scale for each weight matrix, with enough integer bits for the largest weight
+    max_weight = np.max(np.abs(kernel))
+    int_bits = int(np.floor(np.log2(max_weight))) + 1 if max_weight > 0 else 0
+    frac_bits = (self.weight_bits - 1) - int_bits
+    dtype = np.int8 if self.weight_bits <= 8 else np.int16 if self.weight_bits <= 16 else np.int32
+    (qmin, qmax) = (-(1 << (self.weight_bits - 1)), (1 << (self.weight_bits - 1)) - 1)
+    kernel_q = np.clip(np.round(kernel * (2.**frac_bits)), qmin, qmax).astype(dtype)
+    return (kernel_q, bias, frac_bits, activation)
+
+  def _quantize_lut(self, values, fixed_type):
+    (bits, int_bits) = fixed_type
+    frac_bits = bits - int_bits
+    (qmin, qmax) = (-(1 << (bits - 1)), (1 << (bits - 1)) - 1)
+    return np.clip(np.round(values * (2.**frac_bits)), qmin, qmax).astype(np.int64)
+
+  def _requantize(self, x, frac_bits, fixed_type, name):
+    # Convert an integer array with frac_bits fractional bits into the fixed-point type (round half up)
+    (bits, int_bits) = fixed_type
+    shift = frac_bits - (bits - int_bits)
+    if shift > 0:
+      x = (x + (1 << (shift - 1))) >> shift
+    elif shift < 0:
+      x = x << (-shift)
+    (qmin, qmax) = (-(1 << (bits - 1)), (1 << (bits - 1)) - 1)
+    saturated = (x < qmin) | (x > qmax)
+    self.saturation_counts[name] += np.count_nonzero(saturated)
+    self.value_counts[name] += x.size
+    return np.clip(x, qmin, qmax)
+
+  def _apply_lut(self, x, frac_bits, activation):
+    lut = self.luts[activation]
+    index = np.floor((x * (2.**-frac_bits) + self.lut_range) / self.lut_step).astype(np.int64)
+    index = np.clip(index, 0, len(lut) - 1)
+    return lut[index]
+
+  def _apply_layer(self, x, x_frac_bits, layer, name, fixed_type):
+    (kernel_q, bias, w_frac_bits, activation) = layer
+    acc_frac_bits = x_frac_bits + w_frac_bits
+    bias_q = np.round(bias * (2.**acc_frac_bits)).astype(np.int64)
+    acc = x.dot(kernel_q.astype(np.int64)) + bias_q
+    if activation == 'linear':
+      x = self._requantize(acc, acc_frac_bits, fixed_type, name)
+      x_frac_bits = fixed_type[0] - fixed_type[1]
+    else:
+      x = self._requantize(acc, acc_frac_bits, self.preact_type, name)
+      x = self._apply_lut(x, self.preact_type[0] - self.preact_type[1], activation)
+      x_frac_bits = self.act_type[0] - self.act_type[1]
+    return (x, x_frac_bits)
+
+  def predict(self, x):
+    # Same as NumpyModel.predict()
+    x_frac_bits = self.input_type[0] - self.input_type[1]
+    x = np.round(np.asarray(x, dtype=np.float64) * (2.**x_frac_bits)).astype(np.int64)
+    x = self._requantize(x, x_frac_bits, self.input_type, 'input')
+
+    for i, layer in enumerate(self.hidden_layers):
+      (x, x_frac_bits) = self._apply_layer(x, x_frac_bits, layer, 'layer_%i' % i, self.preact_type)
+
+    y = []
+    for i, layer in enumerate(self.output_layers):
+      (y_i, y_frac_bits) = self._apply_layer(x, x_frac_bits, layer, 'output_%i' % i, self.output_type)
+      y.append((y_i * (2.**-y_frac_bits)).astype(np.float32))
+    return y
+
+  def reset_saturation_counts(self):
+    self.saturation_counts = dict((name, 0) for name in self.saturation_names)
+    self.value_counts = dict((name, 0) for name in self.saturation_names)
+
+  def print_saturation_counts(self):
+    for name in self.saturation_names:
+      print('[INFO] {0}: {1}/{2} values saturated'.format(name, self.saturation_counts[name], self.value_counts[name]))
+
+def load_my_quantized_model(name='model_folded.npz', **kwargs):
+  (hidden_layers, output_layers) = load_folded_weights(name)
+  return QuantizedModel(hidden_layers, output_layers, **kwargs)
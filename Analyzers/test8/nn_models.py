@@ -534,6 +534,15 @@ def load_my_model(name='model.json', weights_name='model_weights.h5'):
   model.load_weights(weights_name)
   return model
 
+def save_my_folded_model(model, name='model_folded.npz'):
+  # Fold the BatchNormalization layers into the Dense layers, and store the
+  # weights for the NumPy inference (see nn_inference.py)
+  from nn_inference import fold_batch_normalization, save_folded_weights
+  layers = [(layer.__class__.__name__, layer.get_config(), layer.get_weights()) for layer in model.layers]
+  (hidden_layers, output_layers) = fold_batch_normalization(layers, model.output_names)
+  save_folded_weights(hidden_layers, output_layers, name=name)
+  return
+
 
 # ______________________________________________________________________________
 # Scoring for cross-validation
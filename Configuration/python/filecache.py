@@ -0,0 +1,199 @@
+import os, shutil, subprocess, threading, time
+
+# ______________________________________________________________________________
+# Read-through file cache
+# - the input files are given by their logical file names (LFN, e.g.
+#   /store/group/...) or by their xrootd URLs (root://host//store/group/...).
+#   The local copy of a file is kept in <cachedir>/<LFN>, so the same copy is
+#   used whatever the redirector is.
+# - the cache is capped at max_size bytes. After a file is fetched, the least
+#   recently used files are removed. The last access time is kept as the mtime
+#   of the local copy, so the cache can be shared by several processes.
+# - the files can be prefetched by a background thread, e.g. the next file of a
+#   chain while the current one is being processed.
+# - the remote side is pluggable: XRootDRemote copies the files with xrdcp, and
+#   LocalRemote copies them from a local directory (e.g. for testing). Both
+#   also give the URL to read a file remotely without fetching it.
+#
+# Example:
+#   cache = FileCache('/tmp/filecache', max_size=50 << 30)
+#   infile = cache.get('root://cmsxrootd.fnal.gov//store/group/l1upgrades/ntuple_1.root')
+#   cache.prefetch(['root://cmsxrootd.fnal.gov//store/group/l1upgrades/ntuple_2.root'])
+
+def is_remote(name):
+  return name.startswith('root://') or name.startswith('/store/')
+
+def split_url(name):
+  # Returns (redirector, lfn). The redirector is None if the name is a LFN.
+  if name.startswith('root://'):
+    i = name.index('/', len('root://'))
+    return (name[:i+1], '/' + name[i:].lstrip('/'))
+  return (None, name)
+
+class XRootDRemote(object):
+  def __init__(self, redirector='root://cmsxrootd.fnal.gov/'):
+    self.redirector = redirector  # used for the LFNs
+
+  def url(self, redirector, lfn):
+    if redirector is None:
+      redirector = self.redirector
+    return redirector.rstrip('/') + '/' + lfn
+
+  def fetch(self, redirector, lfn, dst):
+    subprocess.check_call(['xrdcp', '--silent', '--force', self.url(redirector, lfn), dst])
+
+class LocalRemote(object):
+  def __init__(self, basedir):
+    self.basedir = basedir  # stands for the redirector
+
+  def url(self, redirector, lfn):
+    return os.path.join(self.basedir, lfn.lstrip('/'))
+
+  def fetch(self, redirector, lfn, dst):
+    src = self.url(redirector, lfn)
+    if not os.path.isfile(src):
+      raise IOError('File not found: %s' % src)
+    shutil.copyfile(src, dst)
+
+class FileCache(object):
+  def __init__(self, cachedir, max_size=50 << 30, remote=None):
+    if remote is None:
+      remote = XRootDRemote()
+    self.cachedir = cachedir
+    self.max_size = max_size
+    self.remote = remote
+    self.lock = threading.Lock()
+    self.pending = {}  # lfn -> threading.Event of the fetches in progress
+    self.queue = []    # files to prefetch
+    self.thread = None
+    if not os.path.isdir(self.cachedir):
+      try:
+        os.makedirs(self.cachedir)
+      except OSError:  # made by another process
+        pass
+
+  def make_path(self, lfn):
+    return os.path.join(self.cachedir, lfn.lstrip('/'))
+
+  def lookup(self, name):
+    # Returns the local copy, or None if the file is not in the cache
+    (redirector, lfn) = split_url(name)
+    path = self.make_path(lfn)
+    try:
+      os.utime(path, None)  # mark as recently used
+    except OSError:  # not in the cache, or removed by another process
+      return None
+    return path
+
+  def url(self, name):
+    # Returns the local copy of the file if it is in the cache, or else the URL
+    # to read the file remotely (e.g. for its metadata only). Does not fetch.
+    if not is_remote(name):
+      return name
+    path = self.lookup(name)
+    if path is not None:
+      return path
+    (redirector, lfn) = split_url(name)
+    return self.remote.url(redirector, lfn)
+
+  def get(self, name, keep=()):
+    # Returns the local copy of the file, and fetches it first if needed. The
+    # names that are not remote are returned as they are. The local copies in
+    # 'keep' are not evicted to make room for the file.
+    if not is_remote(name):
+      return name
+    (redirector, lfn) = split_url(name)
+    while True:
+      with self.lock:
+        event = self.pending.get(lfn)
+        if event is None:
+          path = self.lookup(name)
+          if path is not None:
+            return path
+          event = self.pending[lfn] = threading.Event()
+          owner = True
+        else:
+          owner = False
+      if owner:
+        try:
+          return self._fetch(redirector, lfn, keep=keep)
+        finally:
+          with self.lock:
+            del self.pending[lfn]
+          event.set()
+      else:
+        # Wait for the fetch in progress, then look again (it may have failed)
+        event.wait()
+
+  def _fetch(self, redirector, lfn, keep=()):
+    path = self.make_path(lfn)
+    if not os.path.isdir(os.path.dirname(path)):
+      try:
+        os.makedirs(os.path.dirname(path))
+      except OSError:  # made by another process
+        pass
+    tmppath = '%s.tmp%i_%i' % (path, os.getpid(), threading.current_thread().ident)
+    t0 = time.time()
+    try:
+      self.remote.fetch(redirector, lfn, tmppath)
+      os.rename(tmppath, path)
+    except:
+      if os.path.exists(tmppath):
+        os.remove(tmppath)
+      raise
+    print('[INFO] Fetched file: %s (%.1f MB in %.1f s)' % (lfn, os.path.getsize(path) / float(1 << 20), time.time() - t0))
+    self.evict(keep=set(keep) | set([path]))
+    return path
+
+  def evict(self, keep=()):
+    # Removes the least recently used files until the cache is below max_size.
+    # The files in 'keep' are never removed.
+    entries = []
+    for (dirpath, dirnames, filenames) in os.walk(self.cachedir):
+      for filename in filenames:
+        if '.tmp' in filename:  # being fetched
+          continue
+        path = os.path.join(dirpath, filename)
+        try:
+          st = os.stat(path)
+        except OSError:  # removed by another process
+          continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total_size = sum(size for (mtime, size, path) in entries)
+    for (mtime, size, path) in sorted(entries):
+      if total_size <= self.max_size:
+        break
+      if path in keep:
+        continue
+      try:
+        os.remove(path)
+      except OSError:  # removed by another process
+        pass
+      total_size -= size
+
+  def prefetch(self, names):
+    # Fetches the files in a background thread, in the given order
+    with self.lock:
+      self.queue.extend(name for name in names if is_remote(name))
+      if self.thread is None:
+        self.thread = threading.Thread(target=self._run_prefetch)
+        self.thread.daemon = True
+        self.thread.start()
+
+  def _run_prefetch(self):
+    while True:
+      with self.lock:
+        if not self.queue:
+          self.thread = None
+          return
+        name = self.queue.pop(0)
+      try:
+        self.get(name)
+      except Exception as e:
+        print('[WARNING] Cannot prefetch file: %s (%s)' % (name, e))
+
+  def wait(self):
+    # Waits for the prefetching to finish
+    thread = self.thread
+    if thread is not None:
+      thread.join()
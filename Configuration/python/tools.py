@@ -1,14 +1,40 @@
 import os
 
-def loadFromFile(filename, fmt=''):
+def loadFromFile(filename, fmt='', cache=None, fetch=False):
   """
   'filename' is the filename of the text file which contains the list of all the filenames.
   'fmt' is a formatting string to change the filenames. (default: '')
+  'cache' is a FileCache (see filecache.py). If given, the files that are in the cache are
+  replaced by their local copies, and the other files are fetched first if 'fetch' is True.
+  The files fetched first are not evicted by the next ones, so the cache can grow beyond
+  its maximum size if the list is larger. (default: None)
   """
   if not os.path.exists(filename):
     raise RuntimeError('Bad filename: %s' % filename)
   lines = tuple(open(filename))
   lines = [line.strip() for line in lines if not line.lstrip().startswith('#')]  # remove comment lines
   if fmt:  lines = [fmt % line for line in lines]
+  if cache is not None:
+    keep = set()  # local copies that must still exist when the list is returned
+    lines = [useCachedFile(cache, line, fetch=fetch, keep=keep) for line in lines]
   return lines
 
+def useCachedFile(cache, name, fetch=False, keep=None):
+  """
+  Returns the local copy of the file as a 'file:' URL, or the name unchanged if the file is
+  not in the cache and 'fetch' is False.
+  'keep' is a set of local copies that must not be evicted if the file is fetched. The local
+  copy is added to it. (default: None)
+  """
+  from filecache import is_remote
+  if not is_remote(name):
+    return name
+  if fetch:
+    path = cache.get(name, keep=(keep or ()))
+  else:
+    path = cache.lookup(name)
+  if path is None:
+    return name
+  if keep is not None:
+    keep.add(path)
+  return 'file:' + os.path.abspath(path)